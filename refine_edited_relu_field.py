@@ -142,6 +142,9 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
               help="value of gamma for exponential lr_decay (happens per stage)", show_default=True)
 @click.option("--kval", type=click.FLOAT, required=False, default=5.0,
               help="k value used in graphcut", show_default=True)
+@click.option("--new_frame_frequency", type=click.IntRange(min=1), required=False, default=1,
+              help="number of iterations where we work on the same pose (and its attention maps)",
+              show_default=True)
 
 # fmt: on
 # -------------------------------------------------------------------------------------
@@ -234,6 +237,7 @@ def main(**kwargs) -> None:
         directional_dataset=config.directional_dataset,
         attn_tv_weight=config.attn_tv_weight,
         kval=config.kval,
+        new_frame_frequency=config.new_frame_frequency,
     )
 
 
@@ -1,22 +1,29 @@
+import subprocess
 from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
 import click
 import imageio
 import torch
 
 from thre3d_atom.thre3d_reprs.sd_attn import StableDiffusion
 from thre3d_atom.modules.volumetric_model import (
-    create_volumetric_model_from_saved_model, create_volumetric_model_from_saved_model_attn
+    VolumetricModel,
+    create_volumetric_model_from_saved_model,
+    create_volumetric_model_from_saved_model_attn,
 )
-from thre3d_atom.thre3d_reprs.voxels import create_voxel_grid_from_saved_info_dict, \
-    create_voxel_grid_from_saved_info_dict_attn
+from thre3d_atom.thre3d_reprs.voxels import AxisAlignedBoundingBox, \
+    create_voxel_grid_from_saved_info_dict, create_voxel_grid_from_saved_info_dict_attn
 from thre3d_atom.utils.constants import HEMISPHERICAL_RADIUS, CAMERA_INTRINSICS
+from thre3d_atom.utils.logging import log
 from thre3d_atom.utils.imaging_utils import (
+    CameraIntrinsics,
+    CameraPose,
     get_thre360_animation_poses,
     get_thre360_spiral_animation_poses,
 )
 from thre3d_atom.visualizations.animations import (
     render_camera_path_for_volumetric_model,
-    render_camera_path_for_volumetric_model_attn,
     render_camera_path_for_volumetric_model_attn_blend
 )
 from easydict import EasyDict
@@ -24,6 +31,112 @@ from easydict import EasyDict
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
+# -------------------------------------------------------------------------------------
+#  Render paths (selected by (load_attention, use_sd))                                |
+# -------------------------------------------------------------------------------------
+def _nvenc_available() -> bool:
+    """checks (with a tiny test encode) whether ffmpeg can encode on the GPU with NVENC"""
+    try:
+        import imageio_ffmpeg
+
+        test_encode = subprocess.run(
+            [
+                imageio_ffmpeg.get_ffmpeg_exe(), "-hide_banner", "-loglevel", "error",
+                "-f", "lavfi", "-i", "color=size=256x256", "-frames:v", "1",
+                "-c:v", "h264_nvenc", "-f", "null", "-",
+            ],
+            capture_output=True,
+            timeout=30,
+        )
+        return test_encode.returncode == 0
+    except Exception:
+        return False
+
+
+def _get_video_writer_kwargs(config: EasyDict) -> Dict[str, Any]:
+    """ffmpeg writer settings: GPU (NVENC) encoding if requested and available, else the default (libx264)"""
+    writer_kwargs = {"fps": config.fps}
+    if config.use_nvenc and torch.cuda.is_available():
+        if _nvenc_available():
+            writer_kwargs.update(
+                codec="h264_nvenc",
+                ffmpeg_params=["-preset", "p4"],
+                pixelformat="yuv420p",
+            )
+        else:
+            log.info("NVENC is not available, encoding the video on the cpu")
+    return writer_kwargs
+
+
+def _render_attn_blend_video(
+    vol_mod: VolumetricModel,
+    camera_path: List[CameraPose],
+    camera_intrinsics: CameraIntrinsics,
+    config: EasyDict,
+    output_path: Path,
+    occupied_aabb: Optional[AxisAlignedBoundingBox],
+    save_images: bool,
+) -> None:
+    # the frames are streamed into the video writer (in a background thread)
+    # while the next frames are being rendered, instead of encoding them all at the end
+    with imageio.get_writer(
+        output_path / "rendered_video.mp4", **_get_video_writer_kwargs(config)
+    ) as video_writer:
+        render_camera_path_for_volumetric_model_attn_blend(
+            vol_mod=vol_mod,
+            camera_path=camera_path,
+            camera_intrinsics=camera_intrinsics,
+            overridden_num_samples_per_ray=config.overridden_num_samples_per_ray,
+            render_scale_factor=config.render_scale_factor,
+            image_save_freq=config.save_freq if save_images else None,
+            image_save_path=output_path if save_images else None,
+            occupied_aabb=occupied_aabb,
+            video_writer=video_writer,
+        )
+
+
+def _render_attn_blend(**kwargs) -> None:
+    _render_attn_blend_video(save_images=True, **kwargs)
+
+
+def _render_attn_blend_sd(**kwargs) -> None:
+    # note that the blend renderer has no notion of a diffusion timestamp,
+    # so `--timestamp' doesn't influence the render
+    _render_attn_blend_video(save_images=False, **kwargs)
+
+
+def _render_without_attn(
+    vol_mod: VolumetricModel,
+    camera_path: List[CameraPose],
+    camera_intrinsics: CameraIntrinsics,
+    config: EasyDict,
+    output_path: Path,
+    occupied_aabb: Optional[AxisAlignedBoundingBox],
+) -> None:
+    animation_frames = render_camera_path_for_volumetric_model(
+        vol_mod=vol_mod,
+        camera_path=camera_path,
+        camera_intrinsics=camera_intrinsics,
+        overridden_num_samples_per_ray=config.overridden_num_samples_per_ray,
+        render_scale_factor=config.render_scale_factor,
+        occupied_aabb=occupied_aabb,
+    )
+
+    imageio.mimwrite(
+        output_path / "rendered_video.mp4",
+        animation_frames,
+        **_get_video_writer_kwargs(config),
+    )
+
+
+RENDER_FNS: Dict[Tuple[bool, bool], Callable[..., None]] = {
+    (True, True): _render_attn_blend_sd,
+    (True, False): _render_attn_blend,
+    (False, True): _render_without_attn,
+    (False, False): _render_without_attn,
+}
+
+
 # -------------------------------------------------------------------------------------
 #  Command line configuration for the script                                          |
 # -------------------------------------------------------------------------------------
@@ -70,6 +183,14 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
               help="index to apply attention to", show_default=True)
 @click.option("--save_freq", type=click.INT, default=None,
               required=False, help="frames per second of the video")
+@click.option("--occupancy_threshold", type=click.FLOAT, default=1e-2,
+              required=False, help="density threshold for skipping the empty space around the object "
+                                   "(set to a negative value to disable)")
+@click.option("--use_nvenc", type=click.BOOL, default=True,
+              required=False, help="encode the video on the GPU (NVENC) when available")
+@click.option("--half_precision_grid", type=click.BOOL, default=False,
+              required=False, help="store the voxel grid in fp16 for (faster) inference-only rendering. "
+                                   "Note that this also lowers the precision of the sample coordinates")
 
 
 
@@ -102,6 +223,18 @@ def main(**kwargs) -> None:
             device=device
         )
 
+    # the grid is only rendered (never trained) here, so it can be stored in half precision
+    if config.half_precision_grid and device.type == "cuda":
+        vol_mod.thre3d_repr.cast_grid_storage_(torch.float16)
+    if config.load_attention:
+        # static grid: pack features, attn and densities into one channel-contiguous grid
+        vol_mod.thre3d_repr.pack_grid_for_inference_()
+
+    # the grid is static here, so the occupied region only needs to be computed once
+    occupied_aabb = None
+    if config.occupancy_threshold >= 0:
+        occupied_aabb = vol_mod.thre3d_repr.get_occupied_aabb(config.occupancy_threshold)
+
     # save prompt to text file if not None
     if config.sds_prompt != None:
         text_path = output_path / "prompt.txt"
@@ -128,6 +261,7 @@ def main(**kwargs) -> None:
             hemispherical_radius=hemispherical_radius,
             camera_pitch=camera_pitch,
             num_poses=num_frames,
+            device=device,
         )
     elif config.camera_path == "spiral":
         vertical_camera_height, num_frames = (
@@ -139,6 +273,7 @@ def main(**kwargs) -> None:
             vertical_camera_height=vertical_camera_height,
             num_rounds=config.num_spiral_rounds,
             num_poses=num_frames,
+            device=device,
         )
     else:
         raise ValueError(
@@ -146,44 +281,20 @@ def main(**kwargs) -> None:
             f"Only available options are: ['thre360' and 'spiral']"
         )
 
-    if config.load_attention:
-        if config.use_sd:
-            animation_frames, attn = render_camera_path_for_volumetric_model_attn_blend(
-                vol_mod=vol_mod,
-                camera_path=animation_poses,
-                camera_intrinsics=camera_intrinsics,
-                overridden_num_samples_per_ray=config.overridden_num_samples_per_ray,
-                render_scale_factor=config.render_scale_factor,
-                timestamp=config.timestamp
-            )
-        else:
-            animation_frames, attn = render_camera_path_for_volumetric_model_attn_blend(
-                vol_mod=vol_mod,
-                camera_path=animation_poses,
-                camera_intrinsics=camera_intrinsics,
-                overridden_num_samples_per_ray=config.overridden_num_samples_per_ray,
-                render_scale_factor=config.render_scale_factor,
-                image_save_freq=config.save_freq,
-                image_save_path=output_path,
-            )
-        #for i, f in enumerate(attn):
-        #    imageio.imwrite(output_path / "{}.png".format(i), f)
+    # the render path is fixed by the configuration, so it is resolved once from the table
+    render_fn = RENDER_FNS[(config.load_attention, config.use_sd)]
 
-    else:
-        animation_frames = render_camera_path_for_volumetric_model(
+    # pure inference: no autograd bookkeeping for the whole render
+    with torch.inference_mode():
+        render_fn(
             vol_mod=vol_mod,
             camera_path=animation_poses,
             camera_intrinsics=camera_intrinsics,
-            overridden_num_samples_per_ray=config.overridden_num_samples_per_ray,
-            render_scale_factor=config.render_scale_factor
+            config=config,
+            output_path=output_path,
+            occupied_aabb=occupied_aabb,
         )
 
-    imageio.mimwrite(
-        output_path / "rendered_video.mp4",
-        animation_frames,
-        fps=config.fps,
-    )
-
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -147,6 +147,9 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
               help="number of iterations where we work on the same pose", show_default=True)
 @click.option("--density_correlation_weight", type=click.FLOAT, required=False, default=0.0,
               help="weight for density correlation loss", show_default=True)
+@click.option("--accum_steps", type=click.IntRange(min=1), required=False, default=1,
+              help="number of iterations over which the gradients are accumulated per optimizer step",
+              show_default=True)
 
 
 # fmt: on
@@ -224,7 +227,8 @@ def main(**kwargs) -> None:
         directional_dataset=config.directional_dataset,
         use_uncertainty=config.use_uncertainty,
         new_frame_frequency=config.new_frame_frequency,
-        density_correlation_weight=config.density_correlation_weight
+        density_correlation_weight=config.density_correlation_weight,
+        accum_steps=config.accum_steps,
     )
 
 
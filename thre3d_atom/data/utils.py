@@ -1,5 +1,6 @@
-from typing import Any, Callable, Optional, Tuple
+from typing import Any, Callable, Iterator, Optional, Tuple
 
+import torch
 from PIL import Image
 from torch import Tensor
 from torch.utils.data import DataLoader
@@ -45,3 +46,46 @@ def infinite_dataloader(data_loader: DataLoader) -> Any:
     while True:
         for data in data_loader:
             yield data
+
+
+class CudaPrefetcher(object):
+    """Wraps an iterator of batches (tuples) and copies the floating point tensors of the next
+    batch to the (cuda) device on a side stream, while the current batch is being used.
+    The integer tensors (indices) are bookkeeping, so they are left where they are"""
+
+    def __init__(self, iterator: Iterator[Tuple[Any, ...]], device: torch.device) -> None:
+        self._iterator = iterator
+        self._device = torch.device(device)
+        self._stream = torch.cuda.Stream(self._device)
+        self._next_batch = None
+        self._preload()
+
+    def _preload(self) -> None:
+        try:
+            batch = next(self._iterator)
+        except StopIteration:
+            self._next_batch = None
+            return
+        with torch.cuda.stream(self._stream):
+            self._next_batch = tuple(
+                item.to(self._device, non_blocking=True)
+                if isinstance(item, Tensor) and item.is_floating_point()
+                else item
+                for item in batch
+            )
+
+    def __iter__(self) -> "CudaPrefetcher":
+        return self
+
+    def __next__(self) -> Tuple[Any, ...]:
+        if self._next_batch is None:
+            raise StopIteration
+        current_stream = torch.cuda.current_stream(self._device)
+        current_stream.wait_stream(self._stream)
+        batch = self._next_batch
+        for item in batch:
+            if isinstance(item, Tensor) and item.is_cuda:
+                # copied on the side stream, but used (and freed) on the current one
+                item.record_stream(current_stream)
+        self._preload()
+        return batch
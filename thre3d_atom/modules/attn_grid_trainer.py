@@ -1,7 +1,9 @@
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
 from datetime import timedelta
 from pathlib import Path
-from typing import Callable, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from PIL import Image
 
 import imageio
@@ -15,10 +17,12 @@ import wandb
 from thre3d_atom.data.datasets import PosedImagesDataset
 from thre3d_atom.data.utils import infinite_dataloader
 from thre3d_atom.modules.volumetric_model import VolumetricModel
+from thre3d_atom.rendering.volumetric.render_interface import Rays
 from thre3d_atom.rendering.volumetric.utils.misc import (
-    cast_rays,
+    RayCache,
+    cast_rays_batched,
+    get_camera_space_ray_directions,
     collate_rays_unflattened,
-    sample_rays_and_pixels_synchronously,
     flatten_rays,
 )
 
@@ -33,11 +37,12 @@ from thre3d_atom.utils.constants import (
     CAMERA_INTRINSICS,
     HEMISPHERICAL_RADIUS,
 )
-from thre3d_atom.utils.imaging_utils import CameraPose, to8b
+from thre3d_atom.utils.imaging_utils import CameraPose, get_dir_batch_from_poses, to8b
 
 # All the TrainProcedures below follow this function-type
 from thre3d_atom.utils.logging import log
-from thre3d_atom.utils.misc import compute_thre3d_grid_sizes
+from thre3d_atom.utils.metric_utils import tv_loss_on_grid
+from thre3d_atom.utils.misc import compute_thre3d_grid_sizes, maybe_compile
 from thre3d_atom.visualizations.static import (
     visualize_sh_vox_grid_vol_mod_rendered_feedback,
     visualize_sh_vox_grid_vol_mod_rendered_feedback_attn,
@@ -51,7 +56,6 @@ from thre3d_atom.modules.refinement_functions import (
 )
 
 dir_to_num_dict = {'side': 0, 'overhead': 1, 'back': 2, 'front': 3}
-mse_loss = torch.nn.MSELoss(reduction='none')
 
 # TrainProcedure = Callable[[VolumetricModel, Dataset, ...], VolumetricModel]
 
@@ -91,7 +95,8 @@ def refine_edited_relu_field(
         verbose_rendering: bool = True,
         directional_dataset: bool = False,
         attn_tv_weight: float = 0.001,
-        kval: float = 5.0
+        kval: float = 5.0,
+        new_frame_frequency: int = 1,
 ) -> VolumetricModel:
     """
     ------------------------------------------------------------------------------------------------------
@@ -125,6 +130,8 @@ def refine_edited_relu_field(
         fast_debug_mode: bool to control fast_debug_mode, skips testing and some other things
         diffuse_weight: weight for diffuse loss - used for regularization
         spcular_weight: weight for specular loss - used for regularization
+        new_frame_frequency: number of iterations for which the same pose (and its SD attention
+                             maps) is trained on, before a new one is drawn
 
     Returns: the trained version of the VolumetricModel. Also writes multiple assets to disk
     """
@@ -153,25 +160,32 @@ def refine_edited_relu_field(
         scale_factor=scale_factor,
     )
 
-    # create downsampled versions of the train_dataset for lower training stages
-    stagewise_train_datasets = [train_dataset]
+    # downsampled versions of the train_dataset for lower training stages. These are only
+    # created (i.e. their images loaded) when their stage begins, instead of all upfront
     dataset_config_dict = train_dataset.get_config_dict()
     data_downsample_factor = dataset_config_dict["downsample_factor"]
-    for stage in range(1, num_stages):
-        dataset_config_dict.update(
-            {"downsample_factor": data_downsample_factor * (scale_factor ** stage)}
+
+    def get_stage_train_dataset(stage: int) -> PosedImagesDataset:
+        if stage == num_stages:
+            return train_dataset
+        return PosedImagesDataset(
+            **{
+                **dataset_config_dict,
+                "downsample_factor": data_downsample_factor * (scale_factor ** (num_stages - stage)),
+            }
         )
-        stagewise_train_datasets.insert(0, PosedImagesDataset(**dataset_config_dict))
 
     # setup render_feedback_pose
     real_feedback_image = None
     if render_feedback_pose is None:
         feedback_dataset = train_dataset
+        # load the sample (and copy its pose to the host) only once
+        feedback_image, feedback_pose = feedback_dataset[-1][:2]
+        feedback_pose = feedback_pose.cpu().numpy()
         render_feedback_pose = CameraPose(
-            rotation=feedback_dataset[-1][1][:, :3].cpu().numpy(),
-            translation=feedback_dataset[-1][1][:, 3:].cpu().numpy(),
+            rotation=feedback_pose[:, :3], translation=feedback_pose[:, 3:]
         )
-        real_feedback_image = feedback_dataset[-1][0].permute(1, 2, 0).cpu().numpy()
+        real_feedback_image = feedback_image.permute(1, 2, 0).cpu().numpy()
 
     train_dl = _make_dataloader_from_dataset(
         train_dataset, image_batch_cache_size, num_workers
@@ -212,6 +226,29 @@ def refine_edited_relu_field(
     # setup tensorboard writer
     tensorboard_writer = SummaryWriter(str(tensorboard_dir))
 
+    # the SD attention maps are computed on a side stream, so that the UNet forward
+    # overlaps with the (independent) attn-grid renders of the same iteration
+    sd_stream = (
+        torch.cuda.Stream(device=vol_mod_edit.device)
+        if torch.device(vol_mod_edit.device).type == "cuda"
+        else None
+    )
+
+    # the (png encoding and upload of the) per-iteration input image logs run on a single
+    # background thread. A log is always waited for before the next step logs anything, so
+    # the steps reach wandb in order
+    log_executor = ThreadPoolExecutor(max_workers=1)
+    pending_image_log: Optional[Future] = None
+
+    # model snapshots are serialized to disk on another background thread. The save_info is
+    # copied to the cpu on the main thread first, so training can keep updating the grids.
+    # The pending saves are waited for at the end of every stage, which raises their errors (if any)
+    save_executor = ThreadPoolExecutor(max_workers=1)
+    pending_saves: List[Future] = []
+
+    # host-side CameraPoses of the dataset indices selected for the input renders
+    pose_cache: Dict[int, CameraPose] = {}
+
     # start actual training
     log.info("beginning training")
     time_spent_actually_training = 0
@@ -221,22 +258,49 @@ def refine_edited_relu_field(
     # -----------------------------------------------------------------------------------------
     for stage in range(1, num_stages + 1):
         # setup the dataset for the current training stage
-        # followed by creating an infinite training data-loader
-        current_stage_train_dataset = stagewise_train_datasets[stage - 1]
-        train_dl = _make_dataloader_from_dataset(
-            current_stage_train_dataset, image_batch_cache_size, num_workers
+        # followed by creating an infinite training data-loader. The loader of the previous
+        # stage (and its persistent workers) is released before the new one is created, and
+        # the full resolution stage reuses the train_dl built above
+        infinite_train_dl, stage_train_dl = None, None
+        current_stage_train_dataset = get_stage_train_dataset(stage)
+        if current_stage_train_dataset is train_dataset:
+            stage_train_dl = train_dl
+        else:
+            stage_train_dl = _make_dataloader_from_dataset(
+                current_stage_train_dataset, image_batch_cache_size, num_workers
+            )
+        infinite_train_dl = iter(infinite_dataloader(stage_train_dl))
+
+        # per-dataset-index cache of the casted (unflattened) rays; the camera
+        # intrinsics change with the stage, so the cache is rebuilt for every stage
+        ray_cache = RayCache()
+        camera_space_directions = get_camera_space_ray_directions(
+            current_stage_train_dataset.camera_intrinsics, device=vol_mod_edit.device
         )
-        infinite_train_dl = iter(infinite_dataloader(train_dl))
 
         # setup volumetric_model's optimizer
         current_stage_lr = learning_rate * (stagewise_lr_decay_gamma ** (stage - 1))
 
+        # the edit and object grids are loaded from the same model (only their attn is trained),
+        # so as long as they have the same resolution, both are rendered in a single pass
+        render_attn_pair = (
+            vol_mod_edit.thre3d_repr.attn.shape == vol_mod_object.thre3d_repr.attn.shape
+            and vol_mod_edit.thre3d_repr.aabb == vol_mod_object.thre3d_repr.aabb
+            and torch.equal(
+                vol_mod_edit.thre3d_repr.densities, vol_mod_object.thre3d_repr.densities
+            )
+        )
+
+        # the Adam updates are done by a single fused kernel when training on the GPU
+        use_fused_adam = torch.device(vol_mod_edit.device).type == "cuda"
+
         # set optimizer edit
         params_edit = [{"params": vol_mod_edit.thre3d_repr.attn, "lr": current_stage_lr}]
 
         optimizer_edit = torch.optim.Adam(
             params=params_edit,
             betas=(0.9, 0.999),
+            fused=use_fused_adam,
         )
 
         # setup learning rate schedulers for the optimizer
@@ -250,6 +314,7 @@ def refine_edited_relu_field(
         optimizer_object = torch.optim.Adam(
             params=params_object,
             betas=(0.9, 0.999),
+            fused=use_fused_adam,
         )
 
         # display logs related to this training stage:
@@ -281,155 +346,192 @@ def refine_edited_relu_field(
 
             total_loss_edit = 0
             total_loss_object = 0
+            # the scalar logs of the iteration are sent to wandb with a single call
+            log_dict = {}
 
             global_step = ((stage - 1) * num_iterations_per_stage) + stage_iteration
-            images, poses, indices = next(infinite_train_dl)
-            # cast rays for all the loaded images:
-            rays_list = []
-            unflattened_rays_list = []
-            for pose in poses:
-                unflattened_rays = cast_rays(
-                    current_stage_train_dataset.camera_intrinsics,
-                    CameraPose(rotation=pose[:, :3], translation=pose[:, 3:]),
-                    device=vol_mod_edit.device,
+            if pending_image_log is not None:
+                pending_image_log.result()
+                pending_image_log = None
+            # a new frame (batch of rays and its SD attention maps) is only drawn every
+            # `new_frame_frequency` iterations; in between, the grids keep training on the same one
+            new_frame = global_step % new_frame_frequency == 0 or stage_iteration == 1
+            if new_frame:
+                images, poses, indices = next(infinite_train_dl)
+                index_list = indices.tolist()
+                # images are of shape [B x C x H x W]
+                _, _, im_h, im_w = images.shape
+                # the images (poses) whose rays are used are drawn first (the rays are only a
+                # function of the pose and the intrinsics, and the pixels aren't needed here),
+                # so that the rays are only cast for those and not for the whole image batch
+                batch_size_in_images = int(ray_batch_size / (im_h * im_w))
+                selected_idx_in_batch = torch.randperm(len(index_list))[:batch_size_in_images].tolist()
+                index_batch = [index_list[i] for i in selected_idx_in_batch]
+                # the rays of a dataset index never change within a stage, so they are only cast
+                # the first time the index is selected. The rays of all the newly selected images
+                # are cast together in a single batched call:
+                uncached = [i for i in selected_idx_in_batch if index_list[i] not in ray_cache]
+                casted_rays = {}
+                if len(uncached) > 0:
+                    batch_rays = cast_rays_batched(
+                        current_stage_train_dataset.camera_intrinsics,
+                        poses[uncached],
+                        device=vol_mod_edit.device,
+                        camera_space_directions=camera_space_directions,
+                    )
+                    for i, origins, directions in zip(uncached, batch_rays.origins, batch_rays.directions):
+                        casted_rays[i] = Rays(origins, directions)
+                        ray_cache.put(index_list[i], casted_rays[i])
+                selected_rays = [
+                    casted_rays[i] if i in casted_rays else ray_cache.get(index_list[i])
+                    for i in selected_idx_in_batch
+                ]
+                # a single selected image (the usual case) needs no collation
+                rays_batch = flatten_rays(
+                    selected_rays[0] if len(selected_rays) == 1 else collate_rays_unflattened(selected_rays)
                 )
-                casted_rays = flatten_rays(unflattened_rays)
-                rays_list.append(casted_rays)
-                unflattened_rays_list.append(unflattened_rays)
-            unflattened_rays = collate_rays_unflattened(unflattened_rays_list)
-            # images are of shape [B x C x H x W] and pixels are [B * H * W x C]
-            _, _, im_h, im_w = images.shape
-            # sample a subset of rays and pixels synchronously
-            batch_size_in_images = int(ray_batch_size / (im_h * im_w))
-            rays_batch, pixels_batch, index_batch, selected_idx_in_batch = sample_rays_and_pixels_synchronously(
-                unflattened_rays, images, indices, batch_size_in_images
-            )
-            pose = poses[selected_idx_in_batch]
-            pose = CameraPose(
-                rotation=pose[-1][:, :3].cpu().numpy(),
-                translation=pose[-1][:, 3:].cpu().numpy(),
-            )
-            rendered_output = vol_mod_edit.render(
-                pose,
-                camera_intrinsics,
-                gpu_render=False,
-                verbose=False,
-            )
+                # the host-side CameraPose of a dataset index is only built (with a
+                # device -> host copy of its [3 x 4] pose) the first time the index is selected
+                selected_index = index_list[selected_idx_in_batch[-1]]
+                pose = pose_cache.get(selected_index)
+                if pose is None:
+                    pose_np = poses[selected_idx_in_batch[-1]].detach().cpu().numpy()
+                    pose = CameraPose(rotation=pose_np[:, :3], translation=pose_np[:, 3:])
+                    pose_cache[selected_index] = pose
+                # rendered (and kept) on the GPU: it's only needed on the host for the image logs
+                rendered_output = vol_mod_edit.render(
+                    pose,
+                    camera_intrinsics,
+                    gpu_render=True,
+                    verbose=False,
+                )
+                rendered_colour = rendered_output.colour
+
+                # log inputs
+                if directional_dataset:
+                    direction_batch = get_dir_batch_from_poses(poses[selected_idx_in_batch])
+                    log_dict["Input Direction"] = dir_to_num_dict[direction_batch[0]]
+
+                # Get attention Maps
+                # (the render already lives on the model's device)
+                out_imgs = rendered_colour.permute(2, 0, 1).unsqueeze(0)
+                m_prompt = prompt + f", {direction_batch[0]} view" if directional_dataset else prompt
+                if global_step % feedback_freq == 0 or stage_iteration == 1:
+                    pending_image_log = log_executor.submit(
+                        _log_image_to_wandb, "Input Image", rendered_colour.cpu().numpy(), global_step
+                    )
 
-            # log inputs
-            if directional_dataset:
-                direction_batch = get_dir_batch_from_poses(poses[selected_idx_in_batch])
-                wandb.log({"Input Direction": dir_to_num_dict[direction_batch[0]]}  , step=global_step)
-
-            # Get attention Maps
-            out_imgs = rendered_output.colour.unsqueeze(0)
-            out_imgs = out_imgs.permute((0, 3, 1, 2)).to(vol_mod_edit.device)
-            m_prompt = prompt + f", {direction_batch[0]} view"
-            wandb.log({"Input Image": wandb.Image(rendered_output.colour.numpy())}, step=global_step)
-
-            # if no object idx is given (default) take the maximum between all non-edit tokens
-            if object_idx == None:
-                indices_to_fetch = list(range(1, edit_idx + 1))
-            else:
-                indices_to_fetch = [edit_idx, object_idx]
+                # if no object idx is given (default) take the maximum between all non-edit tokens
+                if object_idx == None:
+                    indices_to_fetch = list(range(1, edit_idx + 1))
+                else:
+                    indices_to_fetch = [edit_idx, object_idx]
                 
-            gt, t = sd_model.get_attn_map(prompt=m_prompt, pred_rgb=out_imgs, timestamp=timestamp,
-                                          indices_to_fetch=indices_to_fetch)
-            visualize_and_log_attention_maps(gt, global_step)
-
-            if object_idx == None:
-                edit_attn_map = gt.pop(edit_idx - 1)
-                rest_of_attn_maps = [t.unsqueeze(dim=-1) for t in gt]
-                object_attn_map = torch.cat(rest_of_attn_maps, dim=-1)
-                object_attn_map, _ = torch.max(object_attn_map, dim=-1)
-                object_attn_map = object_attn_map.squeeze()
-            else:
-                edit_attn_map = gt[0]
-                object_attn_map = gt[1]
-
-            # render a small chunk of rays and compute a loss on it
-            edit_attn_rendered_batch = vol_mod_edit.render_rays_attn(rays_batch)
-            edit_attn_rendered_batch = edit_attn_rendered_batch.attn
-
-            object_attn_rendered_batch = vol_mod_object.render_rays_attn(rays_batch)
-            object_attn_rendered_batch = object_attn_rendered_batch.attn
+                if sd_stream is not None:
+                    # the side stream has to see the finished input render
+                    sd_stream.wait_stream(torch.cuda.current_stream())
+                    out_imgs.record_stream(sd_stream)
+                with torch.cuda.stream(sd_stream) if sd_stream is not None else nullcontext():
+                    gt, t = sd_model.get_attn_map(prompt=m_prompt, pred_rgb=out_imgs, timestamp=timestamp,
+                                                  indices_to_fetch=indices_to_fetch)
+
+            # render a small chunk of rays (while the attention maps are being computed)
+            # and compute the TV losses of the attn grids
+            (
+                edit_attn_rendered_batch,
+                object_attn_rendered_batch,
+                tv_loss_edit,
+                tv_loss_object,
+            ) = _attn_step(vol_mod_edit, vol_mod_object, rays_batch, render_attn_pair)
+
+            if new_frame:
+                if sd_stream is not None:
+                    torch.cuda.current_stream().wait_stream(sd_stream)
+                visualize_and_log_attention_maps(gt, global_step, log_freq=feedback_freq)
+
+                if object_idx == None:
+                    edit_attn_map = gt.pop(edit_idx - 1)
+                    # amax is a single reduction (no argmax indices are computed)
+                    object_attn_map = torch.stack(gt, dim=-1).amax(dim=-1).squeeze()
+                else:
+                    edit_attn_map = gt[0]
+                    object_attn_map = gt[1]
 
             # calc losses
             edit_attn_loss = calc_loss_on_attn_grid(attn_render=edit_attn_rendered_batch, 
                                                     attn_map=edit_attn_map, 
                                                     token="edit", 
-                                                    global_step=global_step)
+                                                    global_step=global_step,
+                                                    log_freq=feedback_freq)
             
             object_attn_loss = calc_loss_on_attn_grid(attn_render=object_attn_rendered_batch, 
                                                       attn_map=object_attn_map, 
                                                       token="object", 
-                                                      global_step=global_step)
+                                                      global_step=global_step,
+                                                      log_freq=feedback_freq)
             
+            # the attention map visualizations above and below are only logged at the feedback frequency
             edit_attn_render = edit_attn_rendered_batch.reshape(edit_attn_map.shape)
             object_attn_render = object_attn_rendered_batch.reshape(edit_attn_map.shape)
-            log_and_vis_render_diff(edit_attn_render, object_attn_render, global_step)
+            log_and_vis_render_diff(edit_attn_render, object_attn_render, global_step, log_freq=feedback_freq)
             
 
             total_loss_edit = total_loss_edit + edit_attn_loss
-            tv_loss_edit =_tv_loss_on_grid(vol_mod_edit.thre3d_repr.attn)
             total_loss_edit = total_loss_edit + tv_loss_edit * attn_tv_weight
 
             total_loss_object = total_loss_object + object_attn_loss
-            tv_loss_object =_tv_loss_on_grid(vol_mod_object.thre3d_repr.attn)
             total_loss_object = total_loss_object + tv_loss_object * attn_tv_weight
 
-            # optimization steps:
-            total_loss_edit.backward()
+            # optimization steps (the edit and object grids don't share any parameters, so
+            # a single backward pass over the summed losses yields the same gradients):
+            (total_loss_edit + total_loss_object).backward()
             optimizer_edit.step()
-            optimizer_edit.zero_grad()
-
-            total_loss_object.backward()
             optimizer_object.step()
-            optimizer_object.zero_grad()
-
-            # wandb logging:
-            wandb.log({"attn_loss_edit": edit_attn_loss}, step=global_step)
-            wandb.log({"tv_loss_edit": tv_loss_edit}, step=global_step)
-            wandb.log({"total_loss_edit": total_loss_edit}, step=global_step)
-
-            wandb.log({"attn_loss_object": object_attn_loss}, step=global_step)
-            wandb.log({"tv_loss_object": tv_loss_object}, step=global_step)
-            wandb.log({"total_loss_object": total_loss_object}, step=global_step)
-
-            wandb.log({"first selected indx in batch": index_batch[0]}, step=global_step)
+            optimizer_edit.zero_grad(set_to_none=True)
+            optimizer_object.zero_grad(set_to_none=True)
 
             # ---------------------------------------------------------------------------------
 
             # rest of the code per iteration is related to saving/logging/feedback/testing
             time_spent_actually_training += time.perf_counter() - last_time
 
-            # tensorboard summaries feedback
+            # wandb, tensorboard summaries and console loss feedback (the losses are
+            # only copied to the host on these steps, and then together, i.e. with a single sync)
             if (
                     global_step % summary_freq == 0
                     or stage_iteration == 1
                     or stage_iteration == num_iterations_per_stage
             ):
+                losses = {
+                    "attn_loss_edit": edit_attn_loss,
+                    "tv_loss_edit": tv_loss_edit,
+                    "total_loss_edit": total_loss_edit,
+                    "attn_loss_object": object_attn_loss,
+                    "tv_loss_object": tv_loss_object,
+                    "total_loss_object": total_loss_object,
+                }
+                loss_values = dict(
+                    zip(losses, torch.stack([loss.detach() for loss in losses.values()]).tolist())
+                )
+
+                log_dict.update(loss_values)
+                log_dict["first selected indx in batch"] = index_batch[0]
+                wandb.log(log_dict, step=global_step)
+
                 for summary_name, summary_value in (
-                        ("attn_loss", edit_attn_loss),
-                        ("total_loss", total_loss_edit),
+                        ("attn_loss", loss_values["attn_loss_edit"]),
+                        ("total_loss", loss_values["total_loss_edit"]),
                         ("num_epochs", (ray_batch_size * global_step) / dataset_size),
                 ):
-                    if summary_value is not None:
-                        tensorboard_writer.add_scalar(
-                            summary_name, summary_value, global_step=global_step
-                        )
+                    tensorboard_writer.add_scalar(
+                        summary_name, summary_value, global_step=global_step
+                    )
 
-            # console loss feedback
-            if (
-                    global_step % summary_freq == 0
-                    or stage_iteration == 1
-                    or stage_iteration == num_iterations_per_stage
-            ):
                 loss_info_string = (
                     f"Stage: {stage} "
                     f"Global Iteration: {global_step} "
                     f"Stage Iteration: {stage_iteration} "
-                    f"attn_loss: {edit_attn_loss.item(): .3f} "
+                    f"attn_loss: {loss_values['attn_loss_edit']: .3f} "
                 )
                 log.info(loss_info_string)
 
@@ -451,10 +553,14 @@ def refine_edited_relu_field(
                     f"till now: {timedelta(seconds=time_spent_actually_training)}"
                 )
                 with torch.no_grad():
-                    render_feedback_pose = CameraPose(
-                        rotation=train_dataset[index_batch[0]][1][:, :3].cpu().numpy(),
-                        translation=train_dataset[index_batch[0]][1][:, 3:].cpu().numpy(),
-                    )
+                    # the poses don't change with the stage's resolution, so the cached ones are reused
+                    feedback_index = index_list[selected_idx_in_batch[0]]
+                    render_feedback_pose = pose_cache.get(feedback_index)
+                    if render_feedback_pose is None:
+                        feedback_pose = train_dataset[feedback_index][1].cpu().numpy()
+                        render_feedback_pose = CameraPose(
+                            rotation=feedback_pose[:, :3], translation=feedback_pose[:, 3:]
+                        )
 
                     visualize_sh_vox_grid_vol_mod_rendered_feedback_attn(
                         vol_mod=vol_mod_edit,
@@ -481,26 +587,32 @@ def refine_edited_relu_field(
                 log.info(
                     f"saving model-snapshot at stage {stage}, global step {global_step}"
                 )
-                torch.save(
-                    vol_mod_edit.get_save_info(
-                        extra_info={
-                            CAMERA_BOUNDS: camera_bounds,
-                            CAMERA_INTRINSICS: camera_intrinsics,
-                            HEMISPHERICAL_RADIUS: train_dataset.get_hemispherical_radius_estimate(),
-                        }
+                pending_saves.append(save_executor.submit(
+                    torch.save,
+                    _detached_cpu_copy(
+                        vol_mod_edit.get_save_info(
+                            extra_info={
+                                CAMERA_BOUNDS: camera_bounds,
+                                CAMERA_INTRINSICS: camera_intrinsics,
+                                HEMISPHERICAL_RADIUS: train_dataset.get_hemispherical_radius_estimate(),
+                            }
+                        )
                     ),
                     model_dir / f"model_edit_stage_{stage}_iter_{global_step}.pth",
-                )
-                torch.save(
-                    vol_mod_object.get_save_info(
-                        extra_info={
-                            CAMERA_BOUNDS: camera_bounds,
-                            CAMERA_INTRINSICS: camera_intrinsics,
-                            HEMISPHERICAL_RADIUS: train_dataset.get_hemispherical_radius_estimate(),
-                        }
+                ))
+                pending_saves.append(save_executor.submit(
+                    torch.save,
+                    _detached_cpu_copy(
+                        vol_mod_object.get_save_info(
+                            extra_info={
+                                CAMERA_BOUNDS: camera_bounds,
+                                CAMERA_INTRINSICS: camera_intrinsics,
+                                HEMISPHERICAL_RADIUS: train_dataset.get_hemispherical_radius_estimate(),
+                            }
+                        )
                     ),
                     model_dir / f"model_pbject_stage_{stage}_iter_{global_step}.pth",
-                )
+                ))
 
             # ignore all the time spent doing verbose stuff :) and update
             # the last_time clock event
@@ -508,6 +620,11 @@ def refine_edited_relu_field(
 
         # -------------------------------------------------------------------------------------
 
+        # make sure the snapshots of this stage made it to disk
+        for pending_save in pending_saves:
+            pending_save.result()
+        pending_saves.clear()
+
         log.info(f"Starting Grid Refinement!")
         get_edit_region(vol_mod_edit=vol_mod_edit, 
                         vol_mod_object=vol_mod_object,
@@ -521,15 +638,15 @@ def refine_edited_relu_field(
         # change densities and features without optimization:
         regular_density = vol_mod_ref.thre3d_repr._densities.detach()
         regular_features = vol_mod_ref.thre3d_repr._features.detach()
+        # [X x Y x Z x 1] mask, broadcast over the channels of both the grids
         keep_mask = vol_mod_output.thre3d_repr.attn != 0
 
-        new_density = vol_mod_output.thre3d_repr._densities.detach()
-        new_density[keep_mask.squeeze()] = regular_density[keep_mask.squeeze()]
-        vol_mod_output.thre3d_repr._densities = torch.nn.Parameter(new_density)
-
-        new_features = vol_mod_output.thre3d_repr.features.detach()
-        new_features[keep_mask.squeeze()] = regular_features[keep_mask.squeeze()]
-        vol_mod_output.thre3d_repr._features = torch.nn.Parameter(new_features)
+        # the parameters are updated in place (no new Parameters are created)
+        with torch.no_grad():
+            output_densities = vol_mod_output.thre3d_repr._densities
+            output_densities.copy_(torch.where(keep_mask, regular_density, output_densities))
+            output_features = vol_mod_output.thre3d_repr._features
+            output_features.copy_(torch.where(keep_mask, regular_features, output_features))
 
         visualize_sh_vox_grid_vol_mod_rendered_feedback(
                     vol_mod=vol_mod_output,
@@ -560,6 +677,8 @@ def refine_edited_relu_field(
                     mode="trilinear",
                 )
     # -----------------------------------------------------------------------------------------
+    log_executor.shutdown(wait=True)
+    save_executor.shutdown(wait=True)
 
     # save the final trained model
     log.info(f"Saving the final model-snapshot :)! Almost there ... yay!")
@@ -612,50 +731,62 @@ def _make_dataloader_from_dataset(
     # dataloader -> https://pytorch.org/docs/stable/data.html#torch.utils.data.DataLoader
     # And, read the book titled "CUDA_BY_EXAMPLE" https://developer.nvidia.com/cuda-example
     # Takes not long, just about 1-2 weeks :). But worth it :+1: :+1: :smile:!
+    # in the cached_data_mode all the data already lives on the device, so no
+    # worker processes (or pinned host memory) are needed
+    use_workers = not dataset.cached_data_mode and num_workers > 0
     return DataLoader(
         dataset,
         batch_size=batch_size,
         shuffle=True,
         drop_last=True,
-        num_workers=0 if dataset.cached_data_mode else dataset,
-        pin_memory=not dataset.cached_data_mode and num_workers > 0,
-        prefetch_factor=num_workers
-        if not dataset.cached_data_mode and num_workers > 0
-        else 2,
-        persistent_workers=not dataset.cached_data_mode and num_workers > 0,
+        num_workers=num_workers if use_workers else 0,
+        pin_memory=use_workers,
+        # prefetching more than a few batches per worker has diminishing returns
+        prefetch_factor=min(max(2, num_workers), 4) if use_workers else 2,
+        persistent_workers=use_workers,
     )
 
-def get_dir_batch_from_poses(poses: Tensor):
-    dir_batch = []
-    num_poses = poses.shape[0]
-    for i in range(num_poses):
-        Rt = poses[i]
-        pitch, yaw = _pitch_yaw_from_Rt(Rt)
-
-        # determine view direction according to pitch, yaw
-        dir = 'front'
-        if yaw > 60.0:
-            dir = 'side'
-        if yaw > 120.0:
-            dir = 'back'
-        if pitch > 55.0:
-            dir = 'overhead'
-
-        dir_batch.append(dir)
-
-    return dir_batch
-
-
-def _pitch_yaw_from_Rt(rotation: Tensor):
-    # pitch = np.arccos(rotation[1, 1].cpu().numpy()) * 180.0 / np.pi
-    tx, ty, tz = rotation[:, -1].cpu().numpy()
-    tr = np.sqrt(tx ** 2 + ty ** 2)
-    pitch = np.arctan(tz / tr) * 180 / np.pi
-    yaw = np.arccos(rotation[0, 0].cpu().numpy()) * 180.0 / np.pi
-    return pitch, yaw
-
-def _tv_loss_on_grid(grid: Tensor):
-    tv0 = grid.diff(dim=0).abs()
-    tv1 = grid.diff(dim=1).abs()
-    tv2 = grid.diff(dim=2).abs()
-    return (tv0.mean() + tv1.mean() + tv2.mean()) / 3
+
+def _log_image_to_wandb(name: str, image: np.ndarray, step: int) -> None:
+    wandb.log({name: wandb.Image(image)}, step=step)
+
+
+def _detached_cpu_copy(obj: Any) -> Any:
+    """recursively copies all the tensors in (the nested dicts / lists of) obj to the cpu,
+    so that obj stays valid while the originals keep getting updated by the optimizer"""
+    if isinstance(obj, Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, _detached_cpu_copy(value)) for key, value in obj.items())
+    if type(obj) in (list, tuple):
+        return type(obj)(_detached_cpu_copy(value) for value in obj)
+    return obj
+
+
+def _attn_step_eager(
+        vol_mod_edit: VolumetricModel,
+        vol_mod_object: VolumetricModel,
+        rays_batch: Rays,
+        render_attn_pair: bool,
+) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
+    """renders the attn of the edit and object grids for the rays_batch and computes the
+    TV losses of both the grids. Returns (edit_attn, object_attn, tv_loss_edit, tv_loss_object)"""
+    if render_attn_pair:
+        edit_attn_rendered, object_attn_rendered = vol_mod_edit.render_rays_attn_pair(
+            rays_batch, vol_mod_object.thre3d_repr.attn
+        )
+    else:
+        edit_attn_rendered = vol_mod_edit.render_rays_attn(rays_batch)
+        object_attn_rendered = vol_mod_object.render_rays_attn(rays_batch)
+    return (
+        edit_attn_rendered.attn,
+        object_attn_rendered.attn,
+        tv_loss_on_grid(vol_mod_edit.thre3d_repr.attn),
+        tv_loss_on_grid(vol_mod_object.thre3d_repr.attn),
+    )
+
+
+# the ray batch and grid shapes are fixed within a stage, so the compiled step is specialized
+# to them and only recompiled when the grids are upsampled. The sd-attention-map
+# losses are kept out of it, since they log images (at the feedback frequency) from python
+_attn_step = maybe_compile(_attn_step_eager, dynamic=False)
@@ -12,7 +12,6 @@ import torch
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import cm, colors
-from torch import Tensor
 from torch.nn.functional import l1_loss, mse_loss
 from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
@@ -23,6 +22,7 @@ from thre3d_atom.data.utils import infinite_dataloader
 from thre3d_atom.modules.testers import test_sh_vox_grid_vol_mod_with_posed_images
 from thre3d_atom.modules.volumetric_model import VolumetricModel
 from thre3d_atom.rendering.volumetric.utils.misc import (
+    RayCache,
     cast_rays,
     collate_rays_unflattened,
     sample_rays_and_pixels_synchronously,
@@ -45,7 +45,7 @@ from thre3d_atom.utils.imaging_utils import CameraPose, to8b
 # All the TrainProcedures below follow this function-type
 from thre3d_atom.utils.logging import log
 from thre3d_atom.utils.metric_utils import mse2psnr
-from thre3d_atom.utils.misc import compute_thre3d_grid_sizes
+from thre3d_atom.utils.misc import compute_thre3d_grid_sizes, maybe_compile
 from thre3d_atom.visualizations.static import (
     visualize_camera_rays,
     visualize_sh_vox_grid_vol_mod_rendered_feedback, visualize_sh_vox_grid_vol_mod_rendered_feedback_attn,
@@ -53,6 +53,9 @@ from thre3d_atom.visualizations.static import (
 
 dir_to_num_dict = {'side': 0, 'overhead': 1, 'back': 2, 'front': 3}
 
+# looked up once instead of on every (logged) training iteration
+_JET_CMAP = cm.get_cmap('jet')
+
 
 # TrainProcedure = Callable[[VolumetricModel, Dataset, ...], VolumetricModel]
 
@@ -88,7 +91,8 @@ def train_dcl(
         directional_dataset: bool = False,
         use_uncertainty: bool = False,
         new_frame_frequency: int = 1,
-        density_correlation_weight: float = 0.0
+        density_correlation_weight: float = 0.0,
+        accum_steps: int = 1,
 ) -> VolumetricModel:
     """
     ------------------------------------------------------------------------------------------------------
@@ -122,6 +126,8 @@ def train_dcl(
         fast_debug_mode: bool to control fast_debug_mode, skips testing and some other things
         diffuse_weight: weight for diffuse loss - used for regularization
         spcular_weight: weight for specular loss - used for regularization
+        accum_steps: number of iterations over which the gradients are accumulated before
+                     an optimizer step (the Adam update touches the whole grid every step)
 
     Returns: the trained version of the VolumetricModel. Also writes multiple assets to disk
     """
@@ -136,25 +142,32 @@ def train_dcl(
         scale_factor=scale_factor,
     )
 
-    # create downsampled versions of the train_dataset for lower training stages
-    stagewise_train_datasets = [train_dataset]
+    # downsampled versions of the train_dataset for lower training stages. These are only
+    # created (i.e. their images loaded) when their stage begins, instead of all upfront
     dataset_config_dict = train_dataset.get_config_dict()
     data_downsample_factor = dataset_config_dict["downsample_factor"]
-    for stage in range(1, num_stages):
-        dataset_config_dict.update(
-            {"downsample_factor": data_downsample_factor * (scale_factor ** stage)}
+
+    def get_stage_train_dataset(stage: int) -> PosedImagesDataset:
+        if stage == num_stages:
+            return train_dataset
+        return PosedImagesDataset(
+            **{
+                **dataset_config_dict,
+                "downsample_factor": data_downsample_factor * (scale_factor ** (num_stages - stage)),
+            }
         )
-        stagewise_train_datasets.insert(0, PosedImagesDataset(**dataset_config_dict))
 
     # setup render_feedback_pose
     real_feedback_image = None
     if render_feedback_pose is None:
         feedback_dataset = train_dataset
+        # load the sample (and copy its pose to the host) only once
+        feedback_image, feedback_pose = feedback_dataset[-1][:2]
+        feedback_pose = feedback_pose.cpu().numpy()
         render_feedback_pose = CameraPose(
-            rotation=feedback_dataset[-1][1][:, :3].cpu().numpy(),
-            translation=feedback_dataset[-1][1][:, 3:].cpu().numpy(),
+            rotation=feedback_pose[:, :3], translation=feedback_pose[:, 3:]
         )
-        real_feedback_image = feedback_dataset[-1][0].permute(1, 2, 0).cpu().numpy()
+        real_feedback_image = feedback_image.permute(1, 2, 0).cpu().numpy()
 
     train_dl = _make_dataloader_from_dataset(
         train_dataset, image_batch_cache_size, num_workers
@@ -207,6 +220,10 @@ def train_dcl(
             num_rays_per_image=1,
         )
 
+    # the frozen models' renders are compiled (when supported) for the fixed ray-batch size
+    render_pretrained_rays = maybe_compile(pretrained_vol_mod.render_rays, dynamic=False)
+    render_attn_rays = maybe_compile(attn_mod.render_rays_attn, dynamic=False)
+
     # start actual training
     log.info("beginning training")
     time_spent_actually_training = 0
@@ -217,12 +234,16 @@ def train_dcl(
     for stage in range(1, num_stages + 1):
         # setup the dataset for the current training stage
         # followed by creating an infinite training data-loader
-        current_stage_train_dataset = stagewise_train_datasets[stage - 1]
+        current_stage_train_dataset = get_stage_train_dataset(stage)
         train_dl = _make_dataloader_from_dataset(
             current_stage_train_dataset, image_batch_cache_size, num_workers
         )
         infinite_train_dl = iter(infinite_dataloader(train_dl))
 
+        # per-dataset-index cache of the casted (unflattened) rays; the camera
+        # intrinsics change with the stage, so the cache is rebuilt for every stage
+        ray_cache = RayCache()
+
         # setup volumetric_model's optimizer
         current_stage_lr = learning_rate * (stagewise_lr_decay_gamma ** (stage - 1))
 
@@ -233,7 +254,7 @@ def train_dcl(
         if use_uncertainty:
             num_poses = len(train_dataset)
             logvars = torch.nn.Parameter(torch.zeros(num_poses, device=sds_attn_vol_mod.device))
-            params.append({{"params": logvars, "lr": current_stage_lr}})
+            params.append({"params": [logvars], "lr": current_stage_lr})
 
         optimizer = torch.optim.Adam(
             params=params,
@@ -276,17 +297,18 @@ def train_dcl(
             if global_step % new_frame_frequency == 0 or global_step == 1:
                 images, poses, indices = next(infinite_train_dl)
 
-                # cast rays for all the loaded images:
-                rays_list = []
+                # cast rays for all the loaded images (the rays of a dataset index never change
+                # within a stage, so they are only cast the first time the index is seen):
                 unflattened_rays_list = []
-                for pose in poses:
-                    unflattened_rays = cast_rays(
-                        current_stage_train_dataset.camera_intrinsics,
-                        CameraPose(rotation=pose[:, :3], translation=pose[:, 3:]),
-                        device=sds_attn_vol_mod.device,
-                    )
-                    casted_rays = flatten_rays(unflattened_rays)
-                    rays_list.append(casted_rays)
+                for pose, index in zip(poses, indices.tolist()):
+                    unflattened_rays = ray_cache.get(index)
+                    if unflattened_rays is None:
+                        unflattened_rays = cast_rays(
+                            current_stage_train_dataset.camera_intrinsics,
+                            CameraPose(rotation=pose[:, :3], translation=pose[:, 3:]),
+                            device=sds_attn_vol_mod.device,
+                        )
+                        ray_cache.put(index, unflattened_rays)
                     unflattened_rays_list.append(unflattened_rays)
 
                 unflattened_rays = collate_rays_unflattened(unflattened_rays_list)
@@ -300,45 +322,53 @@ def train_dcl(
                     unflattened_rays, images, indices, batch_size_in_images
                 )
 
+                # the pretrained and the attn models are frozen (their renders are only used as
+                # targets), so they are rendered without building any autograd graph. Their renders
+                # (and the mask) only depend on the rays, so they are reused until a new frame is drawn
+                with torch.no_grad():
+                    specular_rendered_batch_pretrained = render_pretrained_rays(rays_batch)
+                    specular_rendered_pixels_batch_pretrained = specular_rendered_batch_pretrained.colour
+                    specular_rendered_batch = render_attn_rays(rays_batch)
+                    specular_rendered_pixels_batch_attn = specular_rendered_batch.attn
+
+                    pretrained_im = torch.reshape(specular_rendered_pixels_batch_pretrained, (-1, im_h, im_w, 3)).squeeze(0)
+                    attn_im = 1 - specular_rendered_pixels_batch_attn.reshape((im_h, im_w))
+
+                    filtered_idxs = torch.nonzero(
+                        torch.where(attn_im > 0.1, attn_im, 0),
+                        as_tuple=True)
+                    mask = torch.ones_like(pretrained_im)
+                    mask[filtered_idxs] = 0
+                    trans = T.GaussianBlur(kernel_size=(3, 3))
+                    mask = trans(mask.unsqueeze(0).permute(0,3,1,2)).squeeze(0).permute(1,2,0)
 
             specular_rendered_batch_sds = sds_attn_vol_mod.render_rays(rays_batch)
             specular_rendered_pixels_batch_sds = specular_rendered_batch_sds.colour
-            specular_rendered_batch_pretrained = pretrained_vol_mod.render_rays(rays_batch)
-            specular_rendered_pixels_batch_pretrained = specular_rendered_batch_pretrained.colour.detach()
-            specular_rendered_batch = attn_mod.render_rays_attn(rays_batch)
-            specular_rendered_pixels_batch_attn = specular_rendered_batch.attn.detach()
-
             sds_im = torch.reshape(specular_rendered_pixels_batch_sds, (-1, im_h, im_w, 3)).squeeze(0)
-            wandb.log({"SDS Image": wandb.Image(sds_im.detach().cpu().numpy())}, step=global_step)
-            pretrained_im = torch.reshape(specular_rendered_pixels_batch_pretrained, (-1, im_h, im_w, 3)).squeeze(0)
-            wandb.log({"Pretrained Image": wandb.Image(pretrained_im.detach().cpu().numpy())}, step=global_step)
-            attn_im = 1 - specular_rendered_pixels_batch_attn.reshape((im_h, im_w))
-            attn_frame = attn_im.cpu().numpy()
-            cmp = cm.get_cmap('jet')
-            norm = colors.Normalize(vmin=np.min(attn_frame), vmax=np.max(attn_frame))
-            attn_frame = cmp(norm(attn_frame))[:, :, :3]
-            wandb.log({"Attn_im": wandb.Image(attn_frame)}, step=global_step)
-
-            filtered_idxs = torch.nonzero(
-                torch.where(attn_im > 0.1, attn_im, 0),
-                as_tuple=True)
-            mask = torch.ones_like(sds_im)
-            mask[filtered_idxs] = 0
-            trans = T.GaussianBlur(kernel_size=(3, 3))
-            mask = trans(mask.unsqueeze(0).permute(0,3,1,2)).squeeze(0).permute(1,2,0)
-
-            wandb.log({"Mask": wandb.Image(mask.cpu().numpy())},step=global_step)
+
             diff = torch.abs(sds_im - pretrained_im)
-            wandb.log({"Diff": wandb.Image(diff.detach().cpu().numpy())},step=global_step)
             diff_masked = torch.mul(diff, mask)
-            wandb.log({"Diff Masked": wandb.Image(diff_masked.detach().cpu().numpy())},step=global_step)
             attn_loss = torch.mean(diff_masked) * (torch.numel(sds_im) / mask.sum())
+
+            # the image logs pull the maps to the cpu (and colormap them there), which stalls
+            # the training step, so they are only logged at the feedback frequency
+            if global_step % feedback_freq == 0 or stage_iteration == 1:
+                wandb.log({"SDS Image": wandb.Image(sds_im.detach().cpu().numpy())}, step=global_step)
+                wandb.log({"Pretrained Image": wandb.Image(pretrained_im.detach().cpu().numpy())}, step=global_step)
+                attn_frame = attn_im.cpu().numpy()
+                norm = colors.Normalize(vmin=np.min(attn_frame), vmax=np.max(attn_frame))
+                attn_frame = _JET_CMAP(norm(attn_frame))[:, :, :3]
+                wandb.log({"Attn_im": wandb.Image(attn_frame)}, step=global_step)
+                wandb.log({"Mask": wandb.Image(mask.cpu().numpy())},step=global_step)
+                wandb.log({"Diff": wandb.Image(diff.detach().cpu().numpy())},step=global_step)
+                wandb.log({"Diff Masked": wandb.Image(diff_masked.detach().cpu().numpy())},step=global_step)
             total_loss = total_loss + attn_loss
 
-            # optimization steps:
-            total_loss.backward()
-            optimizer.step()
-            optimizer.zero_grad()
+            # optimization steps (with gradients accumulated over `accum_steps` iterations):
+            (total_loss / accum_steps).backward()
+            if global_step % accum_steps == 0 or stage_iteration == num_iterations_per_stage:
+                optimizer.step()
+                optimizer.zero_grad(set_to_none=True)
 
             # wandb logging:
             if use_uncertainty:
@@ -352,33 +382,30 @@ def train_dcl(
             # rest of the code per iteration is related to saving/logging/feedback/testing
             time_spent_actually_training += time.perf_counter() - last_time
 
-            # tensorboard summaries feedback
+            # tensorboard summaries and console loss feedback (the losses are
+            # copied to the host together, i.e. with a single sync)
             if (
                     global_step % summary_freq == 0
                     or stage_iteration == 1
                     or stage_iteration == num_iterations_per_stage
             ):
+                attn_loss_value, total_loss_value = (
+                    torch.stack([attn_loss.detach(), total_loss.detach()]).tolist()
+                )
                 for summary_name, summary_value in (
-                        ("attn_loss", attn_loss),
-                        ("total_loss", total_loss),
+                        ("attn_loss", attn_loss_value),
+                        ("total_loss", total_loss_value),
                         ("num_epochs", (ray_batch_size * global_step) / dataset_size),
                 ):
-                    if summary_value is not None:
-                        tensorboard_writer.add_scalar(
-                            summary_name, summary_value, global_step=global_step
-                        )
+                    tensorboard_writer.add_scalar(
+                        summary_name, summary_value, global_step=global_step
+                    )
 
-            # console loss feedback
-            if (
-                    global_step % summary_freq == 0
-                    or stage_iteration == 1
-                    or stage_iteration == num_iterations_per_stage
-            ):
                 loss_info_string = (
                     f"Stage: {stage} "
                     f"Global Iteration: {global_step} "
                     f"Stage Iteration: {stage_iteration} "
-                    f"attn_loss: {attn_loss.item(): .3f} "
+                    f"attn_loss: {attn_loss_value: .3f} "
                 )
                 log.info(loss_info_string)
 
@@ -401,9 +428,9 @@ def train_dcl(
                 )
                 with torch.no_grad():
                     index = np.random.randint(len(train_dataset))
+                    feedback_pose = train_dataset[index][1].cpu().numpy()
                     render_feedback_pose = CameraPose(
-                        rotation=train_dataset[index][1][:, :3].cpu().numpy(),
-                        translation=train_dataset[index][1][:, 3:].cpu().numpy(),
+                        rotation=feedback_pose[:, :3], translation=feedback_pose[:, 3:]
                     )
 
                     visualize_sh_vox_grid_vol_mod_rendered_feedback_attn(
@@ -490,17 +517,19 @@ def _make_dataloader_from_dataset(
     # dataloader -> https://pytorch.org/docs/stable/data.html#torch.utils.data.DataLoader
     # And, read the book titled "CUDA_BY_EXAMPLE" https://developer.nvidia.com/cuda-example
     # Takes not long, just about 1-2 weeks :). But worth it :+1: :+1: :smile:!
+    # in the cached_data_mode all the data already lives on the device, so no
+    # worker processes (or pinned host memory) are needed
+    use_workers = not dataset.cached_data_mode and num_workers > 0
     return DataLoader(
         dataset,
         batch_size=batch_size,
         shuffle=True,
         drop_last=True,
-        num_workers=0 if dataset.cached_data_mode else dataset,
-        pin_memory=not dataset.cached_data_mode and num_workers > 0,
-        prefetch_factor=num_workers
-        if not dataset.cached_data_mode and num_workers > 0
-        else 2,
-        persistent_workers=not dataset.cached_data_mode and num_workers > 0,
+        num_workers=num_workers if use_workers else 0,
+        pin_memory=use_workers,
+        # prefetching more than a few batches per worker has diminishing returns
+        prefetch_factor=min(max(2, num_workers), 4) if use_workers else 2,
+        persistent_workers=use_workers,
     )
 
 
@@ -545,33 +574,3 @@ def attended_density_correlation_loss(sds_vol_mod: VolumetricModel,
     # Return Result:
     correlation = covariance / (denominator + eps)
     return 1.0 - correlation
-
-
-def get_dir_batch_from_poses(poses: Tensor):
-    dir_batch = []
-    num_poses = poses.shape[0]
-    for i in range(num_poses):
-        Rt = poses[i]
-        pitch, yaw = _pitch_yaw_from_Rt(Rt)
-
-        # determine view direction according to pitch, yaw
-        dir = 'front'
-        if yaw > 60.0:
-            dir = 'side'
-        if yaw > 120.0:
-            dir = 'back'
-        if pitch > 55.0:
-            dir = 'overhead'
-
-        dir_batch.append(dir)
-
-    return dir_batch
-
-
-def _pitch_yaw_from_Rt(rotation: Tensor):
-    # pitch = np.arccos(rotation[1, 1].cpu().numpy()) * 180.0 / np.pi
-    tx, ty, tz = rotation[:, -1].cpu().numpy()
-    tr = np.sqrt(tx ** 2 + ty ** 2)
-    pitch = np.arctan(tz / tr) * 180 / np.pi
-    yaw = np.arccos(rotation[0, 0].cpu().numpy()) * 180.0 / np.pi
-    return pitch, yaw
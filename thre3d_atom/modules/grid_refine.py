@@ -6,8 +6,6 @@ from PIL import Image
 
 import imageio
 import torch
-import numpy as np
-from torch import Tensor
 from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 import wandb
@@ -33,11 +31,12 @@ from thre3d_atom.utils.constants import (
     CAMERA_INTRINSICS,
     HEMISPHERICAL_RADIUS,
 )
-from thre3d_atom.utils.imaging_utils import CameraPose, to8b
+from thre3d_atom.utils.imaging_utils import CameraPose, get_dir_batch_from_poses, to8b
 
 # All the TrainProcedures below follow this function-type
 from thre3d_atom.utils.logging import log
-from thre3d_atom.utils.misc import compute_thre3d_grid_sizes
+from thre3d_atom.utils.metric_utils import tv_loss_on_grid
+from thre3d_atom.utils.misc import compute_thre3d_grid_sizes, maybe_compile
 from thre3d_atom.visualizations.static import (
     visualize_camera_rays,
     visualize_sh_vox_grid_vol_mod_rendered_feedback,
@@ -52,7 +51,6 @@ from thre3d_atom.modules.refinement_functions import (
 )
 
 dir_to_num_dict = {'side': 0, 'overhead': 1, 'back': 2, 'front': 3}
-mse_loss = torch.nn.MSELoss(reduction='none')
 
 # TrainProcedure = Callable[[VolumetricModel, Dataset, ...], VolumetricModel]
 
@@ -677,37 +675,6 @@ def _make_dataloader_from_dataset(
         persistent_workers=not dataset.cached_data_mode and num_workers > 0,
     )
 
-def get_dir_batch_from_poses(poses: Tensor):
-    dir_batch = []
-    num_poses = poses.shape[0]
-    for i in range(num_poses):
-        Rt = poses[i]
-        pitch, yaw = _pitch_yaw_from_Rt(Rt)
-
-        # determine view direction according to pitch, yaw
-        dir = 'front'
-        if yaw > 60.0:
-            dir = 'side'
-        if yaw > 120.0:
-            dir = 'back'
-        if pitch > 55.0:
-            dir = 'overhead'
-
-        dir_batch.append(dir)
-
-    return dir_batch
-
-
-def _pitch_yaw_from_Rt(rotation: Tensor):
-    # pitch = np.arccos(rotation[1, 1].cpu().numpy()) * 180.0 / np.pi
-    tx, ty, tz = rotation[:, -1].cpu().numpy()
-    tr = np.sqrt(tx ** 2 + ty ** 2)
-    pitch = np.arctan(tz / tr) * 180 / np.pi
-    yaw = np.arccos(rotation[0, 0].cpu().numpy()) * 180.0 / np.pi
-    return pitch, yaw
-
-def _tv_loss_on_grid(grid: Tensor):
-    tv0 = grid.diff(dim=0).abs()
-    tv1 = grid.diff(dim=1).abs()
-    tv2 = grid.diff(dim=2).abs()
-    return (tv0.mean() + tv1.mean() + tv2.mean()) / 3
\ No newline at end of file
+
+# the grid shape only changes between stages, so the compiled graph is specialized to it
+_tv_loss_on_grid = maybe_compile(tv_loss_on_grid, dynamic=False)
\ No newline at end of file
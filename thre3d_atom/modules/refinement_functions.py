@@ -13,72 +13,78 @@ import maxflow
 g_neighbor_offsets = [[-1, 0, 0], [0,  -1, 0], [0, 0, -1], 
                       [1, 0, 0], [0,  1, 0], [0, 0, 1]]
 
+# looked up once instead of on every (logged) training iteration
+_JET_CMAP = cm.get_cmap('jet')
+
 def visualize_and_log_attention_maps(attn_maps: tuple, global_step: int, log_freq: int=50):
     if (global_step % log_freq == 0) or (global_step == 0):
         edit_attn_map = attn_maps[0]
         object_attn_map = attn_maps[1]
-        cmp = cm.get_cmap('jet')
+        diff_map = edit_attn_map - object_attn_map
+
+        # the normalization ranges of all the maps are fetched together (a single sync)
+        edit_max, object_max, diff_min, diff_max = torch.stack(
+            [edit_attn_map.max(), object_attn_map.max(), diff_map.min(), diff_map.max()]
+        ).tolist()
 
         # vis and log edit attn map:
-        norm = colors.Normalize(vmin=0, vmax=torch.max(edit_attn_map).item())
-        attn_frame = cmp(norm(edit_attn_map.cpu()))[:, :, :3]
+        norm = colors.Normalize(vmin=0, vmax=edit_max)
+        attn_frame = _JET_CMAP(norm(edit_attn_map.cpu()))[:, :, :3]
         wandb.log({"Edit Attn Map": wandb.Image(attn_frame)}, step=global_step)
 
         # vis and log object attn map:
-        norm = colors.Normalize(vmin=0, vmax=torch.max(object_attn_map).item())
-        attn_frame = cmp(norm(object_attn_map.cpu()))[:, :, :3]
+        norm = colors.Normalize(vmin=0, vmax=object_max)
+        attn_frame = _JET_CMAP(norm(object_attn_map.cpu()))[:, :, :3]
         wandb.log({"Object Attn Map": wandb.Image(attn_frame)}, step=global_step)
 
         # vis and log diff_map:
-        diff_map = edit_attn_map - object_attn_map
-        norm = colors.Normalize(vmin=torch.min(diff_map).item(), vmax=torch.max(diff_map).item())
-        attn_frame = cmp(norm(diff_map.cpu()))[:, :, :3]
+        norm = colors.Normalize(vmin=diff_min, vmax=diff_max)
+        attn_frame = _JET_CMAP(norm(diff_map.cpu()))[:, :, :3]
         wandb.log({"Diff Map": wandb.Image(attn_frame)}, step=global_step)
     
 
 def calc_loss_on_attn_grid(attn_render: Tensor, attn_map: Tensor, token: str, 
                            global_step: int, log_freq: int=50):
-    cmp = cm.get_cmap('jet')
     attn_render = attn_render.reshape(attn_map.shape)    
             
     # get mask where attn grid render is not negative, i.e. where there is density
-    non_zero_mask = attn_render > 0.0
-    mask = torch.zeros_like(attn_map)
-    mask[non_zero_mask] = 1.0
+    mask = attn_render > 0.0
 
-    # calc loss:
-    diff = torch.abs(attn_render - attn_map)
-    
-    # calc masked diff
-    diff_masked = diff * mask.float()
+    # calc masked diff (the mask is applied directly instead of materializing a float copy of it)
+    diff_masked = torch.abs(attn_render - attn_map).masked_fill(~mask, 0.0)
 
     # visualize mask
     if (global_step % log_freq == 0) or (global_step == 0):
-        norm = colors.Normalize(vmin=0, vmax=torch.max(mask).item())
-        mask_frame = cmp(norm(mask.cpu()))[:, :, :3]
+        mask_vis = mask.float()
+        # the normalization ranges of all the maps are fetched together (a single sync)
+        mask_max, attn_max, diff_masked_max = torch.stack(
+            [mask_vis.max(), attn_render.detach().max(), diff_masked.detach().max()]
+        ).tolist()
+        norm = colors.Normalize(vmin=0, vmax=mask_max)
+        mask_frame = _JET_CMAP(norm(mask_vis.cpu()))[:, :, :3]
         wandb.log({f"Mask {token}": wandb.Image(mask_frame)}, step=global_step)
 
         ## get rid of large difference between background and foreground caused by -1
         attn_vis = attn_render
-        norm = colors.Normalize(vmin=0, vmax=torch.max(attn_vis).item())
-        attn_vis = cmp(norm(attn_vis.cpu().detach().numpy()))[:, :, :3]
+        norm = colors.Normalize(vmin=0, vmax=attn_max)
+        attn_vis = _JET_CMAP(norm(attn_vis.cpu().detach().numpy()))[:, :, :3]
         wandb.log({f"Pred Attn Map {token}": wandb.Image(attn_vis)}, step=global_step)
  
         # visualize diff mask
-        norm = colors.Normalize(vmin=0, vmax=torch.max(diff_masked).item())
-        diff_mask_frame = cmp(norm(diff_masked.cpu().detach().numpy()))[:, :, :3]
+        norm = colors.Normalize(vmin=0, vmax=diff_masked_max)
+        diff_mask_frame = _JET_CMAP(norm(diff_masked.cpu().detach().numpy()))[:, :, :3]
         wandb.log({f"Diff Masked {token}": wandb.Image(diff_mask_frame)}, step=global_step)
 
-    attn_loss = diff_masked.sum() / mask.sum()
+    attn_loss = diff_masked.sum() / mask.sum().clamp_min(1)
     return attn_loss
 
 
 def log_and_vis_render_diff(edit_attn_render: Tensor, object_attn_render: Tensor, step: int, log_freq: int=50):
     if (step % log_freq == 0) or (step == 0):
-        cmp = cm.get_cmap('jet')
         diff_render = edit_attn_render - object_attn_render
-        norm = colors.Normalize(vmin=diff_render.min(), vmax=torch.max(diff_render).item())
-        diff_frame = cmp(norm(diff_render.cpu().detach().numpy()))[:, :, :3]
+        diff_min, diff_max = torch.stack([diff_render.min(), diff_render.max()]).tolist()
+        norm = colors.Normalize(vmin=diff_min, vmax=diff_max)
+        diff_frame = _JET_CMAP(norm(diff_render.cpu().detach().numpy()))[:, :, :3]
         wandb.log({f"Render Diff": wandb.Image(diff_frame)}, step=step)
 
 
@@ -333,11 +339,10 @@ def set_and_visualize_refined_grid(vol_mod_edit: VolumetricModel,
     attn_rendered_batch = attn_rendered_batch.attn
     attn_render = attn_rendered_batch.reshape((img_height, img_width))
 
-    cmp = cm.get_cmap('jet')
 
     # vis and log greater than attn map:
     norm = colors.Normalize(vmin=0, vmax=torch.max(attn_render).item())
-    attn_frame = cmp(norm(attn_render.cpu()))[:, :, :3]
+    attn_frame = _JET_CMAP(norm(attn_render.cpu()))[:, :, :3]
     wandb.log({"GT Attn Map": wandb.Image(attn_frame)}, step=step)
 
     # then visualize id based grid (graphcut output):
@@ -353,7 +358,7 @@ def set_and_visualize_refined_grid(vol_mod_edit: VolumetricModel,
 
     # vis and log greater than attn map:
     norm = colors.Normalize(vmin=0, vmax=torch.max(attn_render).item())
-    attn_frame = cmp(norm(attn_render.cpu()))[:, :, :3]
+    attn_frame = _JET_CMAP(norm(attn_render.cpu()))[:, :, :3]
     wandb.log({"GraphCut result Attn Map": wandb.Image(attn_frame)}, step=step)
 
 
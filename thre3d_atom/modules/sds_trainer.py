@@ -1,4 +1,5 @@
 import time
+from contextlib import nullcontext
 from datetime import timedelta
 from functools import partial
 from pathlib import Path
@@ -7,7 +8,6 @@ from typing import Callable, Optional
 import imageio
 import torch
 import numpy as np
-import matplotlib.pyplot as plt
 from torch import Tensor
 from torch.nn.functional import l1_loss, mse_loss
 from torch.utils.data import DataLoader
@@ -15,13 +15,12 @@ from torch.utils.tensorboard import SummaryWriter
 import wandb
 
 from thre3d_atom.data.datasets import PosedImagesDataset
-from thre3d_atom.data.utils import infinite_dataloader
+from thre3d_atom.data.utils import CudaPrefetcher, infinite_dataloader
 from thre3d_atom.modules.testers import test_sh_vox_grid_vol_mod_with_posed_images
 from thre3d_atom.modules.volumetric_model import VolumetricModel
 from thre3d_atom.rendering.volumetric.utils.misc import (
-    cast_rays,
-    collate_rays_unflattened,
-    sample_rays_and_pixels_synchronously,
+    cast_rays_batched,
+    get_camera_space_ray_directions,
     sample_rays_directions_and_pixels_synchronously,
     flatten_rays,
 )
@@ -36,12 +35,12 @@ from thre3d_atom.utils.constants import (
     CAMERA_INTRINSICS,
     HEMISPHERICAL_RADIUS,
 )
-from thre3d_atom.utils.imaging_utils import CameraPose, to8b
+from thre3d_atom.utils.imaging_utils import CameraPose, get_dir_batch_from_poses, to8b
 
 # All the TrainProcedures below follow this function-type
 from thre3d_atom.utils.logging import log
-from thre3d_atom.utils.metric_utils import mse2psnr
-from thre3d_atom.utils.misc import compute_thre3d_grid_sizes
+from thre3d_atom.utils.metric_utils import mse2psnr, tv_loss_on_grid
+from thre3d_atom.utils.misc import compute_thre3d_grid_sizes, maybe_compile
 from thre3d_atom.visualizations.static import (
     visualize_camera_rays,
     visualize_sh_vox_grid_vol_mod_rendered_feedback,
@@ -154,6 +153,27 @@ def train_sh_vox_grid_vol_mod_with_posed_images_and_sds(
         regular_density = pretrained_vol_mod.thre3d_repr._densities.detach()
         regular_features = pretrained_vol_mod.thre3d_repr._features.detach()
 
+    # the regular density is constant too, so it is centered (and its variance reduced) only once
+    if not uncoupled_mode:
+        regular_density_centered = regular_density - regular_density.mean()
+        regular_density_var = regular_density_centered.square().mean()
+    else:
+        regular_density_centered, regular_density_var = None, None
+
+    # the regular features are constant, so their (sigmoid) colours are only computed once
+    regular_features_colors = (
+        torch.sigmoid(regular_features) if feature_correlation_weight > 0.0 else None
+    )
+
+    # the constant (never backpropagated through) regular grids are only streamed through by
+    # the correlation losses, so they are kept in bf16 on the GPU to halve the bytes read.
+    # The sds side stays in fp32 (the losses are computed in fp32 through type promotion)
+    if torch.device(sds_vol_mod.device).type == "cuda" and torch.cuda.is_bf16_supported():
+        if regular_density_centered is not None:
+            regular_density_centered = regular_density_centered.to(torch.bfloat16)
+        if regular_features_colors is not None:
+            regular_features_colors = regular_features_colors.to(torch.bfloat16)
+
     # init sds loss class
     sds_loss = scoreDistillationLoss(sds_vol_mod.device, 
                                      sds_prompt, 
@@ -248,6 +268,38 @@ def train_sh_vox_grid_vol_mod_with_posed_images_and_sds(
             num_rays_per_image=1,
         )
 
+    # the render of the trained grid is compiled (when supported) for the fixed ray-batch size.
+    # The SDS step itself stays eager (the diffusion unet and its timestep schedule)
+    render_sds_rays = maybe_compile(sds_vol_mod.render_rays, dynamic=False)
+
+    # mixed precision (bf16 keeps fp32's range, so no grad scaling is needed) for the
+    # forward passes, when the GPU supports it. The optimizer keeps updating the fp32 grids
+    if torch.device(sds_vol_mod.device).type == "cuda" and torch.cuda.is_bf16_supported():
+        sds_autocast = partial(torch.autocast, "cuda", dtype=torch.bfloat16)
+    else:
+        sds_autocast = nullcontext
+
+    # setup volumetric_model's optimizer. It is only built once: between the stages, the grid's
+    # param group is pointed to the parameters of the upsampled grid, while the rest of the
+    # groups (and their adam states) carry over
+    params = [{"params": list(sds_vol_mod.thre3d_repr.parameters()), "lr": learning_rate}]
+
+    ## add logvars to optimizeable parameters if required
+    if use_uncertainty:
+        num_poses = len(train_dataset)
+        logvars = torch.nn.Parameter(torch.zeros(num_poses, device=sds_vol_mod.device))
+        params.append({"params": [logvars], "lr": learning_rate})
+
+    optimizer = torch.optim.Adam(
+        params=params,
+        betas=(0.9, 0.999),
+    )
+
+    # setup learning rate schedulers for the optimizer
+    lr_scheduler = torch.optim.lr_scheduler.ExponentialLR(
+        optimizer, gamma=lr_gamma
+    )
+
     # start actual training
     log.info("beginning training")
     time_spent_actually_training = 0
@@ -263,27 +315,19 @@ def train_sh_vox_grid_vol_mod_with_posed_images_and_sds(
             current_stage_train_dataset, image_batch_cache_size, num_workers
         )
         infinite_train_dl = iter(infinite_dataloader(train_dl))
+        if torch.device(sds_vol_mod.device).type == "cuda":
+            # the next batch is copied to the gpu while the current one is being trained on
+            infinite_train_dl = CudaPrefetcher(infinite_train_dl, sds_vol_mod.device)
 
-        # setup volumetric_model's optimizer
-        current_stage_lr = learning_rate
-
-        params=[{"params": sds_vol_mod.thre3d_repr.parameters(), "lr": current_stage_lr}]
-                    
-        ## add logvars to optimizeable parameters if required
-        if use_uncertainty:
-            num_poses = len(train_dataset)
-            logvars = torch.nn.Parameter(torch.zeros(num_poses, device=sds_vol_mod.device))
-            params.append({{"params": logvars, "lr": current_stage_lr}})
-    
-        optimizer = torch.optim.Adam(
-            params=params,
-            betas=(0.9, 0.999),
+        # the camera-space ray directions only depend on the stage's camera intrinsics
+        camera_space_directions = get_camera_space_ray_directions(
+            current_stage_train_dataset.camera_intrinsics, device=sds_vol_mod.device
         )
 
-        # setup learning rate schedulers for the optimizer
-        lr_scheduler = torch.optim.lr_scheduler.ExponentialLR(
-            optimizer, gamma=lr_gamma
-        )
+        # every stage starts (again) from the base learning rate
+        current_stage_lr = learning_rate
+        for param_group in optimizer.param_groups:
+            param_group["lr"] = current_stage_lr
 
         # display logs related to this training stage:
         train_image_height, train_image_width = (
@@ -300,6 +344,12 @@ def train_sh_vox_grid_vol_mod_with_posed_images_and_sds(
         ]
         log_string = f"current stage learning rates: {current_stage_lrs} "
         log.info(log_string)
+        # the parameters of the voxel grid are updated in place (and only replaced when the grid
+        # is upsampled after the stage), so they are looked up once per stage
+        if not unet3d_mode:
+            sds_density = sds_vol_mod.thre3d_repr._densities
+            sds_features = sds_vol_mod.thre3d_repr._features
+
         last_time = time.perf_counter()
         # -------------------------------------------------------------------------------------
         #  Single Stage Training Loop                                                         |
@@ -312,153 +362,155 @@ def train_sh_vox_grid_vol_mod_with_posed_images_and_sds(
             # load a batch of images and poses (These could already be cached on GPU)
             # please check the `data.datasets` module
             total_loss = 0
+            # the scalar logs of the iteration are sent to wandb with a single call
+            log_dict = {}
             global_step = ((stage - 1) * num_iterations_per_stage) + stage_iteration
 
+            # (the unet generates the grid anew in every iteration)
             if unet3d_mode:
                 sds_density, sds_features = sds_vol_mod.thre3d_repr.get_densities_and_features()
-            else:
-                sds_density = sds_vol_mod.thre3d_repr._densities
-                sds_features = sds_vol_mod.thre3d_repr._features
 
             if global_step % new_frame_frequency == 0 or global_step == 1:
                 images, poses, indices = next(infinite_train_dl)
 
-                # cast rays for all the loaded images:
-                rays_list = []
-                unflattened_rays_list = []
-                for pose in poses:
-                    unflattened_rays = cast_rays(
-                            current_stage_train_dataset.camera_intrinsics,
-                            CameraPose(rotation=pose[:, :3], translation=pose[:, 3:]),
-                            device=sds_vol_mod.device,
-                        )
-                    casted_rays = flatten_rays(unflattened_rays)
-                    rays_list.append(casted_rays)
-                    unflattened_rays_list.append(unflattened_rays)
-
-                unflattened_rays = collate_rays_unflattened(unflattened_rays_list)
-
                 # images are of shape [B x C x H x W] and pixels are [B * H * W x C]
                 _, _, im_h, im_w = images.shape
 
-                # sample a subset of rays and pixels synchronously
+                # sample a subset of the images (drawn on the cpu, no device sync) first, so that
+                # the rays are only cast (in a single batched call) for the selected poses, and
+                # not for the whole image batch
                 batch_size_in_images = int(ray_batch_size / (im_h * im_w))
-                rays_batch, pixels_batch, index_batch, selected_idx_in_batch = sample_rays_and_pixels_synchronously(
-                        unflattened_rays, images, indices, batch_size_in_images
+                sampled_subset = torch.randperm(images.shape[0], dtype=torch.long)[:batch_size_in_images]
+                selected_idx_in_batch = sampled_subset.tolist()
+                index_batch = indices[sampled_subset]
+                rays_batch = flatten_rays(
+                    cast_rays_batched(
+                        current_stage_train_dataset.camera_intrinsics,
+                        poses[sampled_subset.to(poses.device)],
+                        device=sds_vol_mod.device,
+                        camera_space_directions=camera_space_directions,
                     )
+                )
+                pixels_batch = (
+                    images.index_select(0, sampled_subset.to(images.device))
+                    .to(sds_vol_mod.device, non_blocking=True)
+                    .permute(0, 2, 3, 1)
+                    .reshape(-1, images.shape[1])
+                )
 
-                # log inputs
-                wandb.log({"Input Image": wandb.Image(images[selected_idx_in_batch[0]])}, step=global_step)
+                # log inputs (the image only at the feedback frequency)
+                if global_step % feedback_freq == 0 or stage_iteration == 1:
+                    wandb.log({"Input Image": wandb.Image(images[selected_idx_in_batch[0]])}, step=global_step)
                 if directional_dataset:
-                    direction_batch = _get_dir_batch_from_poses(poses[selected_idx_in_batch])
-                    wandb.log({"Input Direction": dir_to_num_dict[direction_batch[0]]}, step=global_step)
-
-            # render a small chunk of rays and compute a loss on it
-            specular_rendered_batch_sds = sds_vol_mod.render_rays(rays_batch)
-            specular_rendered_pixels_batch_sds = specular_rendered_batch_sds.colour
-
-            # run sds loss training step!
-            if use_uncertainty:
-                logvars_batch = logvars[index_batch]
-                total_loss = total_loss + torch.mean(logvars_batch)
-            else:
-                logvars_batch = None
-
-            if do_sds:
-                total_loss = total_loss + sds_loss.training_step(specular_rendered_pixels_batch_sds,
-                                                                 im_h, im_w, 
-                                                                 directions=direction_batch,
-                                                                 global_step=global_step, 
-                                                                 logvars=logvars_batch)
-                current_sds_max_step = sds_loss.get_current_max_step_ratio()
-
-            if uncoupled_mode:
-                if uncoupled_l2_mode:
-                    specular_loss = mse_loss(specular_rendered_pixels_batch_sds, pixels_batch)
+                    direction_batch = get_dir_batch_from_poses(
+                        poses[selected_idx_in_batch], side_yaw_threshold=45.0
+                    )
+                    log_dict["Input Direction"] = dir_to_num_dict[direction_batch[0]]
+
+            # the forward passes (render, sds unet and the regularization losses) run under
+            # bf16 autocast when supported; the backward and the optimizer step stay outside
+            with sds_autocast():
+                # render a small chunk of rays and compute a loss on it
+                specular_rendered_batch_sds = render_sds_rays(rays_batch)
+                specular_rendered_pixels_batch_sds = specular_rendered_batch_sds.colour
+
+                # run sds loss training step!
+                if use_uncertainty:
+                    logvars_batch = logvars[index_batch]
+                    total_loss = total_loss + torch.mean(logvars_batch)
+                else:
+                    logvars_batch = None
+
+                if do_sds:
+                    total_loss = total_loss + sds_loss.training_step(specular_rendered_pixels_batch_sds,
+                                                                     im_h, im_w, 
+                                                                     directions=direction_batch,
+                                                                     global_step=global_step, 
+                                                                     logvars=logvars_batch)
+                    current_sds_max_step = sds_loss.get_current_max_step_ratio()
+
+                if uncoupled_mode:
+                    if uncoupled_l2_mode:
+                        specular_loss = mse_loss(specular_rendered_pixels_batch_sds, pixels_batch)
+                    else:
+                        specular_loss = l1_loss(specular_rendered_pixels_batch_sds, pixels_batch)
+                    total_loss = total_loss + specular_loss * density_correlation_weight
                 else:
-                    specular_loss = l1_loss(specular_rendered_pixels_batch_sds, pixels_batch)
-                total_loss = total_loss + specular_loss * density_correlation_weight
-            else:
-                ### insert losses that tie them together here ###
-                density_correlation_loss, cov_grid = _density_correlation_loss(sds_density=sds_density,
-                                                                     regular_density=regular_density)
-                total_loss = total_loss + density_correlation_loss * density_correlation_weight
-
-                if feature_correlation_weight > 0.0:
-                    feature_correlation_loss = _feature_correlation_loss(sds_features=sds_features,
-                                                                     regular_features=regular_features,
-                                                                     density_cov_grid=cov_grid)
-                    total_loss = total_loss + feature_correlation_loss * feature_correlation_weight
-
-            ### insert other losses here ###
-            if tv_density_weight > 0 and global_step % 1 == 0:
-                activation = torch.nn.ReLU()
-                activated_grid = activation(sds_vol_mod.thre3d_repr._densities)
-                tv_density_loss = _tv_loss_on_grid(activated_grid)
-                total_loss = total_loss + tv_density_loss * tv_density_weight
-            
-            if tv_features_weight > 0 and global_step % 1 == 0:
-                tv_features_loss = _tv_loss_on_grid(sds_vol_mod.thre3d_repr._features)
-                total_loss = total_loss + tv_features_loss * tv_features_weight
-
-            # optimization steps:
+                    ### insert losses that tie them together here ###
+                    density_correlation_loss = _density_correlation_loss(sds_density=sds_density,
+                                                                         regular_centered=regular_density_centered,
+                                                                         regular_var=regular_density_var)
+                    total_loss = total_loss + density_correlation_loss * density_correlation_weight
+
+                    if feature_correlation_weight > 0.0:
+                        feature_correlation_loss = _feature_correlation_loss(sds_features=sds_features,
+                                                                         regular_features_colors=regular_features_colors)
+                        total_loss = total_loss + feature_correlation_loss * feature_correlation_weight
+
+                ### insert other losses here ###
+                if tv_density_weight > 0 and global_step % 1 == 0:
+                    activated_grid = torch.relu(sds_density)
+                    tv_density_loss = _tv_loss_on_grid(activated_grid)
+                    total_loss = total_loss + tv_density_loss * tv_density_weight
+
+                if tv_features_weight > 0 and global_step % 1 == 0:
+                    tv_features_loss = _tv_loss_on_grid(sds_features)
+                    total_loss = total_loss + tv_features_loss * tv_features_weight
+
+            # optimization steps (the grads are released instead of being zero-filled):
+            optimizer.zero_grad(set_to_none=True)
             total_loss.backward()
             optimizer.step()
-            optimizer.zero_grad()
-
-            # wandb logging:
-            if use_uncertainty:
-                _log_variances_in_wandb(logvars, global_step)
-            if tv_density_weight > 0:
-                wandb.log({"tv_density_loss" : tv_density_loss.item()}, step=global_step)
-            if tv_features_weight > 0:
-                wandb.log({"tv_features_loss" : tv_features_loss.item()}, step=global_step)
-            if do_sds:
-                wandb.log({"current_sds_max_step" : current_sds_max_step}, step=global_step)
-            if not uncoupled_mode:
-                if feature_correlation_weight > 0:
-                    wandb.log({"feature_correlation_loss" : feature_correlation_loss.item()}, step=global_step)
-                wandb.log({"density_correlation_loss" : density_correlation_loss.item()}, step=global_step)
-            else:
-                wandb.log({"specular_loss" : specular_loss.item()}, step=global_step)
-            wandb.log({"total_loss" : total_loss}, step=global_step)
-            wandb.log({"first selected indx in batch" : index_batch[0]}, step=global_step)
-            lrs = [param_group["lr"] for param_group in optimizer.param_groups]
-            wandb.log({"learning rate": lrs[0]}, step=global_step)
 
             # ---------------------------------------------------------------------------------
 
             # rest of the code per iteration is related to saving/logging/feedback/testing
             time_spent_actually_training += time.perf_counter() - last_time
-            
-            # tensorboard summaries feedback
+
+            # wandb, tensorboard summaries and console loss feedback (the losses are
+            # only copied to the host on these steps, and then together, i.e. with a single sync)
             if (
                 global_step % summary_freq == 0
                 or stage_iteration == 1
                 or stage_iteration == num_iterations_per_stage
             ):
+                losses = {}
+                if tv_density_weight > 0:
+                    losses["tv_density_loss"] = tv_density_loss
+                if tv_features_weight > 0:
+                    losses["tv_features_loss"] = tv_features_loss
+                if not uncoupled_mode:
+                    if feature_correlation_weight > 0:
+                        losses["feature_correlation_loss"] = feature_correlation_loss
+                    losses["density_correlation_loss"] = density_correlation_loss
+                else:
+                    losses["specular_loss"] = specular_loss
+                losses["total_loss"] = total_loss
+                loss_values = dict(
+                    zip(losses, torch.stack([loss.detach() for loss in losses.values()]).tolist())
+                )
+
+                log_dict.update(loss_values)
+                if do_sds:
+                    log_dict["current_sds_max_step"] = current_sds_max_step
+                log_dict["first selected indx in batch"] = int(index_batch[0])
+                log_dict["learning rate"] = optimizer.param_groups[0]["lr"]
+                wandb.log(log_dict, step=global_step)
+
                 for summary_name, summary_value in (
-                    ("total_loss", total_loss),
+                    ("total_loss", loss_values["total_loss"]),
                     ("num_epochs", (ray_batch_size * global_step) / dataset_size),
                 ):
-                    if summary_value is not None:
-                        tensorboard_writer.add_scalar(
-                            summary_name, summary_value, global_step=global_step
-                        )
+                    tensorboard_writer.add_scalar(
+                        summary_name, summary_value, global_step=global_step
+                    )
 
-            # console loss feedback
-            if (
-                global_step % summary_freq == 0
-                or stage_iteration == 1
-                or stage_iteration == num_iterations_per_stage
-            ):
                 loss_info_string = (
                     f"Stage: {stage} "
                     f"Global Iteration: {global_step} "
                     f"Stage Iteration: {stage_iteration} "
-                    f"total_loss: {total_loss.item(): .3f} "
+                    f"total_loss: {loss_values['total_loss']: .3f} "
                 )
-
                 log.info(loss_info_string)
 
             # step the learning rate schedulers
@@ -478,10 +530,16 @@ def train_sh_vox_grid_vol_mod_with_posed_images_and_sds(
                     f"TIME CHECK: time spent actually training "
                     f"till now: {timedelta(seconds=time_spent_actually_training)}"
                 )
+                # the (matplotlib) variances plot is only logged with the rest of the feedback
+                if use_uncertainty:
+                    _log_variances_in_wandb(logvars, global_step)
                 with torch.no_grad():
+                    # the pose of index_batch[0] is already in the loaded batch (the poses don't
+                    # change with the stage's resolution), so it is copied to the host only once
+                    feedback_pose = poses[selected_idx_in_batch[0]].detach().cpu().numpy()
                     render_feedback_pose = CameraPose(
-                        rotation=train_dataset[index_batch[0]][1][:, :3].cpu().numpy(),
-                        translation=train_dataset[index_batch[0]][1][:, 3:].cpu().numpy(),
+                        rotation=feedback_pose[:, :3],
+                        translation=feedback_pose[:, 3:],
                     )
 
                     if feedback_freq < global_step:
@@ -536,6 +594,13 @@ def train_sh_vox_grid_vol_mod_with_posed_images_and_sds(
                     output_size=stagewise_voxel_grid_sizes[stage],
                     mode="trilinear",
                 )
+
+            # the upsampled grid has new parameters (of new shapes), so the adam state of
+            # the old ones is dropped and the grid's param group is pointed to the new ones
+            grid_param_group = optimizer.param_groups[0]
+            for param in grid_param_group["params"]:
+                optimizer.state.pop(param, None)
+            grid_param_group["params"] = list(sds_vol_mod.thre3d_repr.parameters())
     # -----------------------------------------------------------------------------------------
 
     # save the final trained model
@@ -568,92 +633,66 @@ def _make_dataloader_from_dataset(
     # dataloader -> https://pytorch.org/docs/stable/data.html#torch.utils.data.DataLoader
     # And, read the book titled "CUDA_BY_EXAMPLE" https://developer.nvidia.com/cuda-example
     # Takes not long, just about 1-2 weeks :). But worth it :+1: :+1: :smile:!
+    # in the cached_data_mode all the data already lives on the device, so no
+    # worker processes (or pinned host memory) are needed
+    use_workers = not dataset.cached_data_mode and num_workers > 0
     return DataLoader(
         dataset,
         batch_size=batch_size,
         shuffle=True,
         drop_last=True,
-        num_workers=0 if dataset.cached_data_mode else dataset,
-        pin_memory=not dataset.cached_data_mode and num_workers > 0,
-        prefetch_factor=num_workers
-        if not dataset.cached_data_mode and num_workers > 0
-        else 2,
-        persistent_workers=not dataset.cached_data_mode and num_workers > 0,
+        num_workers=num_workers if use_workers else 0,
+        pin_memory=use_workers,
+        # prefetching more than a few batches per worker has diminishing returns
+        prefetch_factor=min(max(2, num_workers), 4) if use_workers else 2,
+        persistent_workers=use_workers,
     )
 
-def _log_variances_in_wandb(logvars, global_step):
-    logvars_toplot = logvars.cpu().detach().numpy()
-    variances = np.exp(logvars_toplot)
-    indices = np.arange(variances.shape[0])
-    fig = plt.figure(figsize=(5, 2.5), dpi=300)
-    plt.bar(indices, variances)
-    plt.title(f"Variance per Pose at step {global_step}")
-    plt.xlabel("Pose index")
-    plt.ylabel("Variance")
-    plt.tight_layout()
-    wandb.log({"Variances per Pose": wandb.Image(plt)}, step=global_step)
-    plt.close(fig)
-
-def _density_correlation_loss(sds_density: Tensor,
-                              regular_density: Tensor):
+def _log_variances_in_wandb(logvars, global_step, bar_width: int = 4, height: int = 128):
+    # the bar chart (one bar_width wide bar per pose, scaled to the largest variance) is drawn
+    # directly into a numpy image, instead of being rasterized by matplotlib
+    variances = np.exp(logvars.detach().cpu().numpy())
+    max_variance = variances.max()
+    bar_heights = np.round(variances / max(max_variance, 1e-12) * height).astype(np.int64)
+    bars = np.arange(height)[::-1, None] < bar_heights[None, :]
+    bars = np.repeat(bars, bar_width, axis=1)
+    image = np.where(bars[..., None], np.array([31, 119, 180], dtype=np.uint8), np.uint8(255))
+    caption = f"Variance per Pose at step {global_step} (max: {max_variance:.4f})"
+    wandb.log({"Variances per Pose": wandb.Image(image, caption=caption)}, step=global_step)
+
+def _density_correlation_loss_eager(sds_density: Tensor,
+                                    regular_centered: Tensor,
+                                    regular_var: Tensor):
+    # the regular density is constant, so it comes in already centered (with its variance)
     eps = 0.0000001 # for numerical stability
 
+    # the mean is reduced once, and the centered grid is shared by the variance
+    # and the covariance
+    sds_centered = sds_density - sds_density.mean()
+
     # Calculate Denominator:
-    sds_var = torch.mean((sds_density - torch.mean(sds_density))**2)
-    regular_var = torch.mean((regular_density - torch.mean(regular_density))**2)
+    sds_var = sds_centered.square().mean()
     denominator = torch.sqrt(sds_var * regular_var)
 
     # Calculate Covariance:
-    covariance_grid = (sds_density - torch.mean(sds_density)) * \
-        (regular_density - torch.mean(regular_density))
-    #covariance = torch.mean(covariance_grid)
+    covariance = torch.mean(sds_centered * regular_centered)
 
     # Return Result:
-    correlation_grid = covariance_grid / (denominator + eps)
-    correlation = torch.mean(correlation_grid)
-    return 1.0 - correlation, correlation_grid.detach()
-
-def _feature_correlation_loss(sds_features: Tensor,
-                              regular_features: Tensor,
-                              density_cov_grid):
-    regular_features = regular_features.detach()
+    correlation = covariance / (denominator + eps)
+    return 1.0 - correlation
+
+def _feature_correlation_loss_eager(sds_features: Tensor,
+                                    regular_features_colors: Tensor):
+    # the regular_features_colors are the precomputed (detached) sigmoid of the regular features
     sds_features_colors = torch.sigmoid(sds_features)
-    regular_features_colors = torch.sigmoid(regular_features)
-    l2_diffs = torch.sum(sds_features_colors - regular_features_colors, dim=-1) ** 2
-    loss = torch.sum(l2_diffs)
+    # per-channel squared differences, averaged (so that the loss doesn't scale with the grid size).
+    # The (fp32) difference is formed directly, since the regular colours may be stored in bf16
+    loss = (sds_features_colors - regular_features_colors).square().mean()
     return loss
 
 
-def _get_dir_batch_from_poses(poses: Tensor):
-    dir_batch = []
-    num_poses = poses.shape[0]
-    for i in range(num_poses):
-        Rt = poses[i]
-        pitch, yaw = _pitch_yaw_from_Rt(Rt)
-
-        # determine view direction according to pitch, yaw
-        dir = 'front'
-        if yaw > 45.0:
-            dir = 'side'
-        if yaw > 120.0:
-            dir = 'back'
-        if pitch > 55.0:
-            dir = 'overhead'
-        
-        dir_batch.append(dir)
-    
-    return dir_batch
-        
-def _pitch_yaw_from_Rt(rotation: Tensor):
-    tx, ty, tz = rotation[:,-1].cpu().numpy()
-    tr = np.sqrt(tx**2 + ty**2)
-    pitch = np.arctan(tz / tr) * 180 / np.pi
-    yaw = np.arccos(rotation[0, 0].cpu().numpy()) * 180.0 / np.pi
-    return pitch, yaw
-
-def _tv_loss_on_grid(grid: Tensor):
-    tv0 = grid.diff(dim=0).abs()
-    tv1 = grid.diff(dim=1).abs()
-    tv2 = grid.diff(dim=2).abs()
-    return (tv0.mean() + tv1.mean() + tv2.mean()) / 3
-
+# the grid-sized pointwise chains of the regularization losses are fused by the compiler (when
+# supported). The grid shapes only change between stages, so the graphs are specialized to them
+_density_correlation_loss = maybe_compile(_density_correlation_loss_eager, dynamic=False)
+_feature_correlation_loss = maybe_compile(_feature_correlation_loss_eager, dynamic=False)
+_tv_loss_on_grid = maybe_compile(tv_loss_on_grid, fullgraph=True, dynamic=False)
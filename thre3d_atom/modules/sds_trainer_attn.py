@@ -37,7 +37,7 @@ from thre3d_atom.utils.constants import (
     CAMERA_INTRINSICS,
     HEMISPHERICAL_RADIUS,
 )
-from thre3d_atom.utils.imaging_utils import CameraPose, to8b
+from thre3d_atom.utils.imaging_utils import CameraPose, get_dir_batch_from_poses, to8b
 
 # All the TrainProcedures below follow this function-type
 from thre3d_atom.utils.logging import log
@@ -712,33 +712,3 @@ def _density_correlation_loss(sds_vol_mod: VolumetricModel,
     # Return Result:
     correlation = covariance / (denominator + eps)
     return 1.0 - correlation
-
-
-def get_dir_batch_from_poses(poses: Tensor):
-    dir_batch = []
-    num_poses = poses.shape[0]
-    for i in range(num_poses):
-        Rt = poses[i]
-        pitch, yaw = _pitch_yaw_from_Rt(Rt)
-
-        # determine view direction according to pitch, yaw
-        dir = 'front'
-        if yaw > 60.0:
-            dir = 'side'
-        if yaw > 120.0:
-            dir = 'back'
-        if pitch > 55.0:
-            dir = 'overhead'
-
-        dir_batch.append(dir)
-
-    return dir_batch
-
-
-def _pitch_yaw_from_Rt(rotation: Tensor):
-    # pitch = np.arccos(rotation[1, 1].cpu().numpy()) * 180.0 / np.pi
-    tx, ty, tz = rotation[:, -1].cpu().numpy()
-    tr = np.sqrt(tx ** 2 + ty ** 2)
-    pitch = np.arctan(tz / tr) * 180 / np.pi
-    yaw = np.arccos(rotation[0, 0].cpu().numpy()) * 180.0 / np.pi
-    return pitch, yaw
@@ -0,0 +1,224 @@
+import numpy as np
+import torch
+
+from thre3d_atom.modules.tests.test_volumetric_model import (
+    get_default_volumetric_model,
+)
+from thre3d_atom.modules.volumetric_model import (
+    VolumetricModel,
+    get_memory_budgeted_ray_chunk_size,
+)
+from thre3d_atom.rendering.volumetric.utils.misc import (
+    cast_rays,
+    cast_rays_batched,
+    get_camera_space_ray_directions,
+)
+from thre3d_atom.thre3d_reprs.renderers import (
+    render_sh_voxel_grid,
+    render_sh_voxel_grid_attn,
+    SHVoxGridRenderConfig,
+)
+from thre3d_atom.thre3d_reprs.voxels import VoxelGrid
+from thre3d_atom.utils.constants import EXTRA_ACCUMULATED_WEIGHTS
+from thre3d_atom.utils.imaging_utils import (
+    CameraBounds,
+    CameraIntrinsics,
+    CameraPath,
+    CameraPose,
+    _pose_spherical_batched,
+    get_dir_batch_from_poses,
+    get_thre360_animation_poses,
+    pose_spherical,
+    stack_camera_poses,
+)
+
+
+def _random_spherical_poses(num_poses: int):
+    yaws = np.random.uniform(0.0, 360.0, num_poses)
+    pitches = np.random.uniform(0.0, 180.0, num_poses)
+    radii = np.random.uniform(4.0, 5.0, num_poses)
+    return yaws, pitches, radii
+
+
+def _random_camera_path(num_poses: int):
+    return [
+        pose_spherical(yaw=yaw, pitch=pitch, radius=radius)
+        for yaw, pitch, radius in zip(*_random_spherical_poses(num_poses))
+    ]
+
+
+def test_get_camera_space_ray_directions(device: torch.device) -> None:
+    height, width, focal = camera_intrinsics = CameraIntrinsics(4, 6, 2.0)
+
+    directions = get_camera_space_ray_directions(camera_intrinsics, device=device)
+
+    # the directions pass through the pixel centres of the image plane at z = -1
+    assert directions.shape == (height, width, 3)
+    for y in range(height):
+        for x in range(width):
+            expected = torch.tensor(
+                [(x + 0.5 - width / 2) / focal, -(y + 0.5 - height / 2) / focal, -1.0],
+                device=device,
+            )
+            assert torch.allclose(directions[y, x], expected)
+
+
+def test_pose_spherical_batched_matches_pose_spherical() -> None:
+    yaws, pitches, radii = _random_spherical_poses(8)
+
+    camera_path = _pose_spherical_batched(
+        yaws=torch.tensor(yaws, dtype=torch.float32),
+        pitches=torch.tensor(pitches, dtype=torch.float32),
+        radii=torch.tensor(radii, dtype=torch.float32),
+    )
+
+    assert isinstance(camera_path, CameraPath) and len(camera_path) == 8
+    for batched_pose, yaw, pitch, radius in zip(camera_path, yaws, pitches, radii):
+        pose = pose_spherical(yaw=yaw, pitch=pitch, radius=radius)
+        assert torch.allclose(batched_pose.rotation, pose.rotation, atol=1e-5)
+        assert torch.allclose(batched_pose.translation, pose.translation, atol=1e-4)
+
+
+def test_stack_camera_poses(device: torch.device) -> None:
+    camera_path = _random_camera_path(5)
+
+    # numpy poses (as loaded from disk) are stacked the same way as the tensor ones
+    numpy_camera_path = [
+        CameraPose(rotation=pose.rotation.numpy(), translation=pose.translation.numpy())
+        for pose in camera_path
+    ]
+    for path in (camera_path, numpy_camera_path):
+        stacked_poses = stack_camera_poses(path, device=device)
+        assert stacked_poses.shape == (5, 3, 4) and stacked_poses.device.type == device.type
+        for stacked_pose, pose in zip(stacked_poses.cpu(), camera_path):
+            assert torch.equal(stacked_pose[:, :3], pose.rotation)
+            assert torch.equal(stacked_pose[:, 3:], pose.translation)
+
+    # the animation paths are handed through without restacking the per-pose views
+    animation_path = get_thre360_animation_poses(
+        hemispherical_radius=4.0, camera_pitch=60.0, num_poses=6
+    )
+    stacked_poses = stack_camera_poses(animation_path, device=device)
+    for stacked_pose, pose in zip(stacked_poses.cpu(), animation_path):
+        assert torch.equal(stacked_pose[:, :3], pose.rotation)
+        assert torch.equal(stacked_pose[:, 3:], pose.translation)
+
+
+def test_cast_rays_batched_matches_cast_rays(device: torch.device) -> None:
+    camera_intrinsics = CameraIntrinsics(12, 16, 20.0)
+    camera_path = _random_camera_path(4)
+    camera_space_directions = get_camera_space_ray_directions(
+        camera_intrinsics, device=device
+    )
+
+    for precomputed_directions in (None, camera_space_directions):
+        batched_rays = cast_rays_batched(
+            camera_intrinsics,
+            stack_camera_poses(camera_path),
+            device=device,
+            camera_space_directions=precomputed_directions,
+        )
+        assert batched_rays.origins.shape == batched_rays.directions.shape == (4, 12, 16, 3)
+        for frame, pose in enumerate(camera_path):
+            rays = cast_rays(camera_intrinsics, pose, device=device)
+            assert torch.allclose(batched_rays.origins[frame], rays.origins)
+            assert torch.allclose(batched_rays.directions[frame], rays.directions, atol=1e-6)
+
+
+def _single_pose_view_direction(pose: torch.Tensor, side_yaw_threshold: float) -> str:
+    # per-pose reference of the view-direction classification
+    tx, ty, tz = pose[:, -1].tolist()
+    pitch = np.arctan(tz / np.sqrt(tx ** 2 + ty ** 2)) * 180 / np.pi
+    yaw = np.arccos(pose[0, 0].item()) * 180.0 / np.pi
+    direction = "front"
+    if yaw > side_yaw_threshold:
+        direction = "side"
+    if yaw > 120.0:
+        direction = "back"
+    if pitch > 55.0:
+        direction = "overhead"
+    return direction
+
+
+def test_get_dir_batch_from_poses_matches_per_pose_classification(
+    device: torch.device,
+) -> None:
+    poses = stack_camera_poses(_random_camera_path(32), device=device)
+
+    for side_yaw_threshold in (45.0, 60.0):
+        dir_batch = get_dir_batch_from_poses(poses, side_yaw_threshold=side_yaw_threshold)
+        assert dir_batch == [
+            _single_pose_view_direction(pose, side_yaw_threshold) for pose in poses.cpu()
+        ]
+
+
+def test_get_memory_budgeted_ray_chunk_size(device: torch.device) -> None:
+    chunk_size = get_memory_budgeted_ray_chunk_size(
+        device, num_samples_per_ray=256, num_channels_per_sample=29
+    )
+    if device.type != "cuda":
+        assert chunk_size == 32768
+        return
+
+    assert 1024 <= chunk_size <= 2 ** 20
+    # more samples per ray leave room for fewer rays in the same memory
+    assert (
+        get_memory_budgeted_ray_chunk_size(
+            device, num_samples_per_ray=1024, num_channels_per_sample=29
+        )
+        <= chunk_size
+    )
+
+
+def _assert_batch_matches_per_pose_renders(batch_render, per_pose_renders) -> None:
+    for frame, render in enumerate(per_pose_renders):
+        assert torch.allclose(batch_render.depth[frame], render.depth, atol=1e-4)
+        assert torch.allclose(
+            batch_render.extra[EXTRA_ACCUMULATED_WEIGHTS][frame],
+            render.extra[EXTRA_ACCUMULATED_WEIGHTS],
+            atol=1e-5,
+        )
+
+
+def test_render_batch_with_attn_matches_per_pose_renders(device: torch.device) -> None:
+    camera_bounds = CameraBounds(0.5, 8.0)
+    voxel_grid = get_default_volumetric_model(camera_bounds, device).thre3d_repr
+    attn = torch.empty((*voxel_grid.densities.shape[:-1], 9), device=device)
+    voxel_grid = VoxelGrid(
+        densities=voxel_grid.densities,
+        features=voxel_grid.features,
+        voxel_size=voxel_grid.voxel_size,
+        attn=torch.nn.init.uniform_(attn, -10.0, 10.0),
+        **voxel_grid.get_config_dict(),
+    )
+    # noinspection PyTypeChecker
+    vol_mod = VolumetricModel(
+        thre3d_repr=voxel_grid,
+        render_procedure=render_sh_voxel_grid,
+        render_procedure_attn=render_sh_voxel_grid_attn,
+        render_config=SHVoxGridRenderConfig(
+            num_samples_per_ray=256,
+            camera_bounds=camera_bounds,
+            perturb_sampled_points=False,
+        ),
+        device=device,
+    )
+    camera_intrinsics = CameraIntrinsics(24, 32, 40.0)
+    camera_path = _random_camera_path(3)
+    camera_poses = stack_camera_poses(camera_path, device=device)
+
+    # the chunk size doesn't divide the rays of a frame, so the chunks span frame boundaries
+    batch_render, batch_attn_render = vol_mod.render_batch_with_attn(
+        camera_poses, camera_intrinsics, parallel_rays_chunk_size=500
+    )
+    per_pose_renders = [vol_mod.render(pose, camera_intrinsics) for pose in camera_path]
+    per_pose_attn_renders = [
+        vol_mod.render_attn(pose, camera_intrinsics) for pose in camera_path
+    ]
+
+    assert batch_render.colour.shape == (3, 24, 32, 3)
+    _assert_batch_matches_per_pose_renders(batch_render, per_pose_renders)
+    _assert_batch_matches_per_pose_renders(batch_attn_render, per_pose_attn_renders)
+    for frame, (render, attn_render) in enumerate(zip(per_pose_renders, per_pose_attn_renders)):
+        assert torch.allclose(batch_render.colour[frame], render.colour, atol=1e-5)
+        assert torch.allclose(batch_attn_render.attn[frame], attn_render.attn, atol=1e-5)
@@ -4,12 +4,14 @@ from pathlib import Path
 from typing import Dict, Any, Optional, Callable, Tuple
 
 import torch
+from torch import Tensor
 from torch.nn import Module
 from tqdm import tqdm
 
 from thre3d_atom.rendering.volumetric.render_interface import RenderOut, Rays, RenderOutAttn
 from thre3d_atom.rendering.volumetric.utils.misc import (
     cast_rays,
+    cast_rays_batched,
     flatten_rays,
     reshape_rendered_output,
     collate_rendered_output, reshape_rendered_output_attn, collate_rendered_output_attn,
@@ -22,7 +24,13 @@ from thre3d_atom.thre3d_reprs.constants import (
     THRE3D_REPR,
     RENDER_CONFIG_TYPE,
 )
-from thre3d_atom.thre3d_reprs.renderers import RenderProcedure, RenderConfig, render_sh_voxel_grid_attn
+from thre3d_atom.thre3d_reprs.renderers import (
+    RenderProcedure,
+    RenderConfig,
+    render_sh_voxel_grid_attn,
+    render_sh_voxel_grid_with_attn,
+    render_sh_voxel_grid_attn_pair,
+)
 from thre3d_atom.utils.constants import EXTRA_INFO
 from thre3d_atom.utils.imaging_utils import CameraIntrinsics, CameraPose
 
@@ -132,6 +140,41 @@ class VolumetricModel:
             self._thre3d_repr, rays, render_config, parallel_points_chunk_size, orig_densities
         )
 
+    def render_rays_with_attn(
+            self, rays: Rays, parallel_points_chunk_size: Optional[int] = None, **kwargs
+    ) -> Tuple[RenderOut, RenderOutAttn]:
+        """
+        renders the rays and the attention features of the underlying thre3d_repr in a single
+        pass (sharing the sampled points and the interpolated densities) ``differentiably''
+        Args:
+            rays: The rays to be rendered :)
+            parallel_points_chunk_size: used for point-based parallelism
+            **kwargs: any configuration parameters if required to be overridden
+        Returns:
+        """
+        render_config = self._update_render_config(self._render_config, kwargs)
+        return render_sh_voxel_grid_with_attn(
+            self._thre3d_repr, rays, render_config, parallel_points_chunk_size
+        )
+
+    def render_rays_attn_pair(
+            self, rays: Rays, other_attn: Tensor, parallel_points_chunk_size: Optional[int] = None, **kwargs
+    ) -> Tuple[RenderOutAttn, RenderOutAttn]:
+        """
+        renders the rays for the attn of the underlying thre3d_repr and for another attn grid
+        sharing its geometry, in a single pass ``differentiably''
+        Args:
+            rays: The rays to be rendered :)
+            other_attn: the other attn grid (same shape as the thre3d_repr's attn)
+            parallel_points_chunk_size: used for point-based parallelism
+            **kwargs: any configuration parameters if required to be overridden
+        Returns:
+        """
+        render_config = self._update_render_config(self._render_config, kwargs)
+        return render_sh_voxel_grid_attn_pair(
+            self._thre3d_repr, other_attn, rays, render_config, parallel_points_chunk_size
+        )
+
     def render(
             self,
             camera_pose: CameraPose,
@@ -252,6 +295,110 @@ class VolumetricModel:
 
         return rendered_output
 
+    def render_batch_with_attn(
+            self,
+            camera_poses: Tensor,
+            camera_intrinsics: CameraIntrinsics,
+            parallel_rays_chunk_size: Optional[int] = 32768,
+            parallel_points_chunk_size: Optional[int] = None,
+            gpu_render: bool = True,
+            verbose: bool = False,
+            camera_space_directions: Optional[Tensor] = None,
+            **kwargs,
+    ) -> Tuple[RenderOut, RenderOutAttn]:
+        """
+        renders the colour and the attention features of the underlying thre3d_repr for a whole
+        batch of cameras at once, in a single pass. The rays of all the cameras are flattened
+        together, so the ray-chunks span frame boundaries. Works in no_grad mode.
+        Args:
+            camera_poses: [N x 3 x 4] camera-to-world matrices of the render cameras
+            camera_intrinsics: camera intrinsics shared by all the render cameras
+            parallel_rays_chunk_size: chunk size used for parallel ray-rendering
+            parallel_points_chunk_size: chunk size used for points-based parallel processing
+            gpu_render: whether to keep the rendered output on the GPU or bring to cpu
+            verbose: whether to show progress bar for the render.
+            camera_space_directions: (optionally) precomputed camera-space ray directions [H x W x 3]
+            **kwargs: any overridden render configuration
+        Returns: rendered colour and attn outputs with a leading frames dimension [N x H x W x C] :)
+        """
+        progress_bar = tqdm if verbose else lambda x: x
+
+        flat_rays = flatten_rays(
+            cast_rays_batched(
+                camera_intrinsics,
+                camera_poses,
+                device=self._device,
+                camera_space_directions=camera_space_directions,
+            )
+        )
+
+        rendered_colour_chunks, rendered_attn_chunks = [], []
+        parallel_rays_chunk_size = (
+            len(flat_rays)
+            if parallel_rays_chunk_size is None
+            else parallel_rays_chunk_size
+        )
+        with torch.no_grad():
+            for chunk_index in progress_bar(
+                    range(0, len(flat_rays), parallel_rays_chunk_size)
+            ):
+                rendered_colour_chunk, rendered_attn_chunk = self.render_rays_with_attn(
+                    flat_rays[chunk_index: chunk_index + parallel_rays_chunk_size],
+                    parallel_points_chunk_size,
+                    **kwargs,
+                )
+                if not gpu_render:
+                    rendered_colour_chunk = rendered_colour_chunk.to(torch.device("cpu"))
+                    rendered_attn_chunk = rendered_attn_chunk.to(torch.device("cpu"))
+                rendered_colour_chunks.append(rendered_colour_chunk)
+                rendered_attn_chunks.append(rendered_attn_chunk)
+
+        return (
+            reshape_rendered_output(
+                collate_rendered_output(rendered_colour_chunks),
+                camera_intrinsics=camera_intrinsics,
+                num_frames=len(camera_poses),
+            ),
+            reshape_rendered_output_attn(
+                collate_rendered_output_attn(rendered_attn_chunks),
+                camera_intrinsics=camera_intrinsics,
+                num_frames=len(camera_poses),
+            ),
+        )
+
+
+def get_memory_budgeted_ray_chunk_size(
+    device: torch.device,
+    num_samples_per_ray: int,
+    num_channels_per_sample: int,
+    memory_fraction: float = 0.6,
+    default_chunk_size: int = 32768,
+    max_chunk_size: int = 2 ** 20,
+) -> int:
+    """
+    picks the largest parallel_rays_chunk_size whose per-sample intermediates fit in the given
+    fraction of the currently free GPU memory (instead of a fixed chunk size), so that the rays
+    are rendered in as few (and as large) chunks as possible.
+    Args:
+        device: device on which the rendering happens
+        num_samples_per_ray: number of samples taken along each ray
+        num_channels_per_sample: number of values interpolated per sample (features + density)
+        memory_fraction: fraction of the free memory that the ray-chunk may use
+        default_chunk_size: chunk size used when the free memory can't be queried (cpu)
+        max_chunk_size: upper limit on the chunk size
+    Returns: the chunk size (number of rays)
+    """
+    if device.type != "cuda":
+        return default_chunk_size
+
+    free_memory, _ = torch.cuda.mem_get_info(device)
+    # (4-byte) sample points, interpolated values and the handful of per-sample intermediates
+    # of the accumulation (depths, deltas, alphas, transmittances, weights); with a 2x safety
+    # factor for the temporaries alive during the interpolation
+    bytes_per_sample = 4 * (3 + num_channels_per_sample + 8) * 2
+    chunk_size = int(free_memory * memory_fraction) // (num_samples_per_ray * bytes_per_sample)
+    return max(1024, min(chunk_size, max_chunk_size))
+
 
 def create_volumetric_model_from_saved_model(
         model_path: Path,
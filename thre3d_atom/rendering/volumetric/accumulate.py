@@ -1,4 +1,4 @@
-from typing import Callable
+from typing import Callable, Dict, Tuple
 
 import torch
 from torch import Tensor
@@ -8,6 +8,10 @@ from thre3d_atom.rendering.volumetric.render_interface import (
     ProcessedPointsOnRays,
     RenderOut, RenderOutAttn,
 )
+from thre3d_atom.thre3d_reprs.fused_render import (
+    can_use_fused_accumulation,
+    fused_accumulate,
+)
 from thre3d_atom.utils.constants import (
     ZERO_PLUS,
     INFINITY,
@@ -19,13 +23,50 @@ from thre3d_atom.utils.constants import (
     EXTRA_SAMPLE_INTERVALS,
     EXTRA_DISPARITY,
 )
+from thre3d_atom.utils.misc import maybe_compile
 
 
 def density2occupancy_pb(densities: Tensor, deltas: Tensor) -> Tensor:
     """computes occupancy values from density values in the range [0, inf).
     The occupancy (being a probability) is always strictly between [0, 1].
-    This function is physically based, and can be derived from Lambert's law"""
-    return 1.0 - torch.exp(-(densities * deltas))
+    This function is physically based, and can be derived from Lambert's law.
+    Note that 1 - exp(-x) is computed as -expm1(-x): one kernel and no cancellation near 0"""
+    return -torch.expm1(-(densities * deltas))
+
+
+def _composite(alpha: Tensor, colour: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+    """alpha -> transmittance -> weights -> accumulated colour and weights.
+    Being a chain of elementwise ops, this is compiled (fused) if torch.compile is available"""
+    ones = torch.ones_like(alpha[:, :1])
+    weights = alpha * torch.cumprod(torch.cat([ones, 1.0 - alpha], -1), -1)[:, :-1]
+    # dims below: [N, NUM_COLOUR_CHANNELS]
+    colour_render = torch.sum(colour * weights[..., None], dim=-2)
+    # sum of weights along each ray, should ideally be 1.0 everywhere
+    acc_render = torch.sum(weights, dim=-1, keepdim=True)
+    return weights, colour_render, acc_render
+
+
+composite = maybe_compile(_composite, fullgraph=True, dynamic=True)
+
+
+def _should_fuse(
+    processed_points: ProcessedPointsOnRays,
+    rays: Rays,
+    stochastic_density_noise_std: float,
+    density2occupancy: Callable[[Tensor, Tensor], Tensor],
+    radiance_hdr_tone_map: Callable[[Tensor], Tensor],
+    extra_debug_info: bool,
+) -> bool:
+    """the fused kernel hard-codes the default (noise-free) occupancy and tone-map functions"""
+    return (
+        stochastic_density_noise_std == 0.0
+        and density2occupancy is density2occupancy_pb
+        and radiance_hdr_tone_map is torch.sigmoid
+        and not extra_debug_info
+        and can_use_fused_accumulation(
+            processed_points.points, processed_points.depths, rays.directions
+        )
+    )
 
 
 def accumulate_radiance_density_on_rays(
@@ -36,9 +77,32 @@ def accumulate_radiance_density_on_rays(
     radiance_hdr_tone_map: Callable[[Tensor], Tensor] = torch.sigmoid,
     white_bkgd: bool = True,
     extra_debug_info: bool = False,
+    fused: bool = False,
 ) -> RenderOut:
     dtype, device = processed_points.points.dtype, processed_points.points.device
 
+    if fused and _should_fuse(
+        processed_points,
+        rays,
+        stochastic_density_noise_std,
+        density2occupancy,
+        radiance_hdr_tone_map,
+        extra_debug_info,
+    ):
+        colour_render, depth_render, acc_render = fused_accumulate(
+            processed_points.points, processed_points.depths, rays.directions
+        )
+        if white_bkgd:
+            colour_render = colour_render + (1 - acc_render)
+        return RenderOut(
+            colour=colour_render,
+            depth=depth_render,
+            extra={
+                EXTRA_DISPARITY: _disparity(depth_render, acc_render),
+                EXTRA_ACCUMULATED_WEIGHTS: acc_render,
+            },
+        )
+
     # unpack the radiance and density from the processed points
     raw_radiance, raw_density = (
         processed_points.points[..., :-1],
@@ -62,17 +126,10 @@ def accumulate_radiance_density_on_rays(
     )
     alpha = density2occupancy(raw_density + density_noise, deltas)
 
-    # compute the radiance weights for accumulation along the ray
-    ones = torch.ones((alpha.shape[0], 1), dtype=dtype, device=device)
-    weights = alpha * torch.cumprod(torch.cat([ones, 1.0 - alpha], -1), -1)[:, :-1]
-
+    # compute the radiance weights for accumulation along the ray and
     # accumulate the predicted radiance values of the samples using the computed alphas
     colour = radiance_hdr_tone_map(raw_radiance)
-    # dims below: [N, NUM_COLOUR_CHANNELS]
-    colour_render = torch.sum(colour * weights[..., None], dim=-2)
-
-    # sum of weights along each ray, should ideally be 1.0 everywhere
-    acc_render = torch.sum(weights, dim=-1, keepdim=True)
+    weights, colour_render, acc_render = composite(alpha, colour)
 
     if white_bkgd:
         # add a white background if requested. Mathematically, note that we assume
@@ -120,9 +177,57 @@ def accumulate_radiance_density_on_rays_attn(
     radiance_hdr_tone_map: Callable[[Tensor], Tensor] = torch.sigmoid,
     white_bkgd: bool = True,
     extra_debug_info: bool = False,
+    fused: bool = False,
 ) -> RenderOutAttn:
+    attn_render, depth_render, extra_dict = accumulate_attn_channels_on_rays(
+        processed_points,
+        rays,
+        stochastic_density_noise_std=stochastic_density_noise_std,
+        density2occupancy=density2occupancy,
+        radiance_hdr_tone_map=radiance_hdr_tone_map,
+        white_bkgd=white_bkgd,
+        extra_debug_info=extra_debug_info,
+        fused=fused,
+    )
+    return RenderOutAttn(attn=attn_render, depth=depth_render, extra=extra_dict)
+
+
+def accumulate_attn_channels_on_rays(
+    processed_points: ProcessedPointsOnRays,
+    rays: Rays,
+    stochastic_density_noise_std: float = 1.0,
+    density2occupancy: Callable[[Tensor, Tensor], Tensor] = density2occupancy_pb,
+    radiance_hdr_tone_map: Callable[[Tensor], Tensor] = torch.sigmoid,
+    white_bkgd: bool = True,
+    extra_debug_info: bool = False,
+    fused: bool = False,
+) -> Tuple[Tensor, Tensor, Dict[str, Tensor]]:
+    """same as `accumulate_radiance_density_on_rays_attn`, but for any number of attn channels
+    (e.g. several attn grids sharing the densities). Returns the raw attn render, depth render
+    and extra renders instead of a RenderOutAttn (which holds a single attn channel)"""
     dtype, device = processed_points.points.dtype, processed_points.points.device
 
+    if fused and _should_fuse(
+        processed_points,
+        rays,
+        stochastic_density_noise_std,
+        density2occupancy,
+        radiance_hdr_tone_map,
+        extra_debug_info,
+    ):
+        # background is always 0.0 for the attn renders
+        attn_render, depth_render, acc_render = fused_accumulate(
+            processed_points.points, processed_points.depths, rays.directions
+        )
+        return (
+            attn_render,
+            depth_render,
+            {
+                EXTRA_DISPARITY: _disparity(depth_render, acc_render),
+                EXTRA_ACCUMULATED_WEIGHTS: acc_render,
+            },
+        )
+
     # unpack the radiance and density from the processed points
     raw_radiance, raw_density = (
         processed_points.points[..., :-1],
@@ -146,17 +251,10 @@ def accumulate_radiance_density_on_rays_attn(
     )
     alpha = density2occupancy(raw_density + density_noise, deltas)
 
-    # compute the radiance weights for accumulation along the ray
-    ones = torch.ones((alpha.shape[0], 1), dtype=dtype, device=device)
-    weights = alpha * torch.cumprod(torch.cat([ones, 1.0 - alpha], -1), -1)[:, :-1]
-
+    # compute the radiance weights for accumulation along the ray and
     # accumulate the predicted radiance values of the samples using the computed alphas
     colour = radiance_hdr_tone_map(raw_radiance)
-    # dims below: [N, NUM_COLOUR_CHANNELS]
-    colour_render = torch.sum(colour * weights[..., None], dim=-2)
-
-    # sum of weights along each ray, should ideally be 1.0 everywhere
-    acc_render = torch.sum(weights, dim=-1, keepdim=True)
+    weights, colour_render, acc_render = composite(alpha, colour)
 
     if white_bkgd:
         # add a white background if requested. Mathematically, note that we assume
@@ -191,9 +289,11 @@ def accumulate_radiance_density_on_rays_attn(
             }
         )
 
-    return RenderOutAttn(
-        attn=colour_render,
-        depth=depth_render,
-        extra=extra_dict,
-    )
+    return colour_render, depth_render, extra_dict
+
 
+def _disparity(depth_render: Tensor, acc_render: Tensor) -> Tensor:
+    return 1.0 / torch.maximum(
+        torch.full(acc_render.shape, ZERO_PLUS, device=depth_render.device),
+        depth_render / acc_render,
+    )
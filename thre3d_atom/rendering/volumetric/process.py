@@ -1,8 +1,9 @@
 from functools import partial
-from typing import Optional
+from typing import Optional, Tuple
 
 import numpy as np
 import torch
+from torch import Tensor
 
 from thre3d_atom.rendering.volumetric.render_interface import (
     SampledPointsOnRays,
@@ -172,3 +173,149 @@ def process_points_with_sh_voxel_grid_attn(
         processed_points,
         sampled_points.depths,
     )
+
+
+def process_points_with_sh_voxel_grid_and_attn(
+    sampled_points: SampledPointsOnRays,
+    rays: Rays,
+    voxel_grid: VoxelGrid,
+    render_diffuse: bool = False,
+    parallel_points_chunk_size: Optional[int] = None,
+) -> Tuple[ProcessedPointsOnRays, ProcessedPointsOnRays]:
+    """processes the sampled points for both the radiance and the attn render in one go, so
+    that the densities are interpolated (and the outside-points are filtered) only once"""
+    dtype, device = sampled_points.points.dtype, sampled_points.points.device
+
+    # extract shape information
+    num_rays, num_samples_per_ray, num_coords = sampled_points.points.shape
+
+    # obtain interpolated features, attn and densities from the voxel_grid:
+    flat_sampled_points = sampled_points.points.reshape(-1, num_coords)
+    if parallel_points_chunk_size is None:
+        interpolated_features = voxel_grid.forward_with_attn(flat_sampled_points)
+    else:
+        interpolated_features = batchify(
+            voxel_grid.forward_with_attn,
+            collate_fn=partial(torch.cat, dim=0),
+            chunk_size=parallel_points_chunk_size,
+        )(flat_sampled_points)
+
+    # unpack sh_coeffs, attn_sh_coeffs and density features:
+    num_attn_features = voxel_grid.attn.shape[-1]
+    sh_coeffs, attn_sh_coeffs, raw_densities = (
+        interpolated_features[..., : -(num_attn_features + 1)],
+        interpolated_features[..., -(num_attn_features + 1):-1],
+        interpolated_features[..., -1:],
+    )
+
+    # compute view_dirs
+    viewdirs = rays.directions / rays.directions.norm(dim=-1, keepdim=True)
+    viewdirs_tiled = (
+        viewdirs[:, None, :].repeat(1, num_samples_per_ray, 1).reshape(-1, num_coords)
+    )
+
+    # evaluate the spherical harmonics with the viewdirs for both renders
+    raw_radiances = []
+    for coeffs, num_channels in ((sh_coeffs, NUM_COLOUR_CHANNELS), (attn_sh_coeffs, NUM_ATTN_CHANNELS)):
+        coeffs = coeffs.reshape(coeffs.shape[0], num_channels, -1)
+        if render_diffuse:
+            # if rendering the diffuse variant, then we only use the degree 0 features
+            coeffs = coeffs[..., :1]
+        sh_degree = int(np.sqrt(coeffs.shape[-1])) - 1
+        raw_radiances.append(
+            evaluate_spherical_harmonics(
+                degree=sh_degree,
+                sh_coeffs=coeffs,
+                viewdirs=viewdirs_tiled,
+            )
+        )
+
+    # filter out radiance and density values outside the AABB of the voxel grid
+    # fmt: off
+    inside_points_mask = voxel_grid.test_inside_volume(flat_sampled_points)
+    zero_densities = torch.zeros_like(raw_densities, dtype=dtype, device=device)
+    filtered_raw_densities = torch.where(inside_points_mask, raw_densities, zero_densities)
+    # fmt: on
+
+    processed_points = []
+    for raw_radiance in raw_radiances:
+        minus_infinity_radiance = torch.full(raw_radiance.shape, -INFINITY, dtype=dtype, device=device)
+        filtered_raw_radiance = torch.where(inside_points_mask, raw_radiance, minus_infinity_radiance)
+        processed_points.append(
+            ProcessedPointsOnRays(
+                torch.cat([filtered_raw_radiance, filtered_raw_densities], dim=-1).reshape(
+                    num_rays, num_samples_per_ray, -1
+                ),
+                sampled_points.depths,
+            )
+        )
+
+    return processed_points[0], processed_points[1]
+
+
+def process_points_with_sh_voxel_grid_attn_pair(
+    sampled_points: SampledPointsOnRays,
+    rays: Rays,
+    voxel_grid: VoxelGrid,
+    packed_attn_pair_grid: Tensor,
+    parallel_points_chunk_size: Optional[int] = None,
+) -> ProcessedPointsOnRays:
+    """processes the sampled points for the attn renders of the voxel_grid's attn and of another
+    attn grid (defined over the same geometry, packed together with `VoxelGrid.pack_attn_pair_grid`)
+    in one go. The processed points hold the two attn radiances followed by the (shared) density:
+    [N_rays x N_samples x <1 + 1 + 1>]"""
+    dtype, device = sampled_points.points.dtype, sampled_points.points.device
+
+    # extract shape information
+    num_rays, num_samples_per_ray, num_coords = sampled_points.points.shape
+
+    # obtain interpolated attn (of both grids) and densities from the voxel_grid:
+    flat_sampled_points = sampled_points.points.reshape(-1, num_coords)
+    forward_fn = partial(
+        voxel_grid.forward_attn_pair, packed_attn_pair_grid=packed_attn_pair_grid
+    )
+    if parallel_points_chunk_size is None:
+        interpolated_features = forward_fn(flat_sampled_points)
+    else:
+        interpolated_features = batchify(
+            forward_fn,
+            collate_fn=partial(torch.cat, dim=0),
+            chunk_size=parallel_points_chunk_size,
+        )(flat_sampled_points)
+
+    # unpack the attn sh_coeffs of both grids and density features:
+    attn_sh_coeffs, raw_densities = (
+        interpolated_features[..., :-1],
+        interpolated_features[..., -1:],
+    )
+
+    # compute view_dirs
+    viewdirs = rays.directions / rays.directions.norm(dim=-1, keepdim=True)
+    viewdirs_tiled = (
+        viewdirs[:, None, :].repeat(1, num_samples_per_ray, 1).reshape(-1, num_coords)
+    )
+
+    # evaluate the spherical harmonics of both the attn grids together
+    attn_sh_coeffs = attn_sh_coeffs.reshape(attn_sh_coeffs.shape[0], 2 * NUM_ATTN_CHANNELS, -1)
+    sh_degree = int(np.sqrt(attn_sh_coeffs.shape[-1])) - 1
+    raw_attn = evaluate_spherical_harmonics(
+        degree=sh_degree,
+        sh_coeffs=attn_sh_coeffs,
+        viewdirs=viewdirs_tiled,
+    )
+
+    # filter out radiance and density values outside the AABB of the voxel grid
+    # fmt: off
+    inside_points_mask = voxel_grid.test_inside_volume(flat_sampled_points)
+    minus_infinity_attn = torch.full(raw_attn.shape, -INFINITY, dtype=dtype, device=device)
+    filtered_raw_attn = torch.where(inside_points_mask, raw_attn, minus_infinity_attn)
+    zero_densities = torch.zeros_like(raw_densities, dtype=dtype, device=device)
+    filtered_raw_densities = torch.where(inside_points_mask, raw_densities, zero_densities)
+    # fmt: on
+
+    return ProcessedPointsOnRays(
+        torch.cat([filtered_raw_attn, filtered_raw_densities], dim=-1).reshape(
+            num_rays, num_samples_per_ray, -1
+        ),
+        sampled_points.depths,
+    )
@@ -200,3 +200,25 @@ def sample_aabb_bound_uniform_points_on_rays(
         num_samples=num_samples,
         perturb=perturb,
     )
+
+
+def sample_occupied_aabb_bound_uniform_points_on_rays(
+    rays: Rays,
+    bounds: CameraBounds,
+    num_samples: int,
+    aabb: AxisAlignedBoundingBox,
+    perturb: bool = True,
+) -> SampledPointsOnRays:
+    """samples the points inside the (tight) occupied aabb of a grid, except for the last sample of
+    every ray which is kept at the far bound. The accumulation treats the interval after the last
+    sample as infinitely long, so a last sample inside the grid would be (almost) fully opaque and
+    paint over the background."""
+    inside_points = sample_aabb_bound_uniform_points_on_rays(
+        rays, bounds=bounds, num_samples=num_samples - 1, aabb=aabb, perturb=perturb
+    )
+    far_depths = torch.clip(inside_points.depths[:, -1:], min=bounds.far)
+    far_points = rays.origins[:, None, :] + rays.directions[:, None, :] * far_depths[..., None]
+    return SampledPointsOnRays(
+        torch.cat([inside_points.points, far_points], dim=1),
+        torch.cat([inside_points.depths, far_depths], dim=-1),
+    )
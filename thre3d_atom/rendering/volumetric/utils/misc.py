@@ -1,4 +1,4 @@
-from typing import Sequence, Tuple, Any, List
+from typing import Sequence, Tuple, Any, List, Optional, Dict
 
 import numpy as np
 import torch
@@ -24,6 +24,40 @@ def cast_rays(
         pose = CameraPose(pose.rotation.to(device), pose.translation.to(device))
 
     # cast the rays for the given CameraPose
+    dirs = get_camera_space_ray_directions(camera_intrinsics, device)
+
+    rays_d = (pose.rotation @ dirs[..., None])[..., 0]
+    rays_o = torch.broadcast_to(pose.translation.squeeze(), rays_d.shape)
+    return Rays(rays_o, rays_d)
+
+
+def cast_rays_batched(
+    camera_intrinsics: CameraIntrinsics,
+    poses: Tensor,
+    device: torch.device = torch.device("cpu"),
+    camera_space_directions: Optional[Tensor] = None,
+) -> Rays:
+    """casts the rays for a whole batch of camera poses at once.
+    The poses are [N x 3 x 4] camera-to-world matrices ([R | t]) and
+    the returned rays are of shape [N x H x W x NUM_COORD_DIMENSIONS].
+    The camera-space ray directions only depend on the camera intrinsics, so they
+    can be precomputed (`get_camera_space_ray_directions`) and reused across calls"""
+    poses = poses.to(device=device, dtype=torch.float32)
+    dirs = (
+        get_camera_space_ray_directions(camera_intrinsics, device)
+        if camera_space_directions is None
+        else camera_space_directions
+    )
+
+    rays_d = torch.einsum("nij,hwj->nhwi", poses[:, :, :3], dirs)
+    rays_o = torch.broadcast_to(poses[:, None, None, :, 3], rays_d.shape)
+    return Rays(rays_o, rays_d)
+
+
+def get_camera_space_ray_directions(
+    camera_intrinsics: CameraIntrinsics, device: torch.device = torch.device("cpu")
+) -> Tensor:
+    """directions of the rays through the pixel centres in camera space [H x W x 3]"""
     height, width, focal = camera_intrinsics
     # note the specific use of torch.float32. Which means, even if the poses have higher
     # precision (float64), the casted rays will have 32-bit precision only.
@@ -44,10 +78,7 @@ def cast_rays(
         ],
         -1,
     )
-
-    rays_d = (pose.rotation @ dirs[..., None])[..., 0]
-    rays_o = torch.broadcast_to(pose.translation.squeeze(), rays_d.shape)
-    return Rays(rays_o, rays_d)
+    return dirs
 
 
 def flatten_rays(rays: Rays) -> Rays:
@@ -74,6 +105,37 @@ def collate_rays_unflattened(rays_list: Sequence[Rays]) -> Rays:
     )
 
 
+# device memory budget of the per-pose ray bundles cached by the trainers
+# (a 512 x 512 bundle takes ~6 MB)
+MAX_CACHED_RAYS_BYTES = 256 * 1024 ** 2
+
+
+class RayCache:
+    """per-dataset-index cache of casted (unflattened) rays. New bundles are only cached while
+    the (upper bound of the) device memory taken by the cached bundles stays within max_bytes"""
+
+    def __init__(self, max_bytes: int = MAX_CACHED_RAYS_BYTES) -> None:
+        self._max_bytes = max_bytes
+        self._num_bytes = 0
+        self._rays: Dict[int, Rays] = {}
+
+    def __contains__(self, index: int) -> bool:
+        return index in self._rays
+
+    def get(self, index: int) -> Optional[Rays]:
+        return self._rays.get(index)
+
+    def put(self, index: int, rays: Rays) -> None:
+        if index in self._rays:
+            return
+        num_bytes = sum(
+            tensor.numel() * tensor.element_size() for tensor in (rays.origins, rays.directions)
+        )
+        if self._num_bytes + num_bytes <= self._max_bytes:
+            self._rays[index] = rays
+            self._num_bytes += num_bytes
+
+
 def compute_expected_density_scale_for_relu_field_grid(
     grid_world_size: Tuple[float, float, float]
 ) -> float:
@@ -143,15 +205,19 @@ def sample_rays_and_pixels_synchronously(
     indices: list,
     sample_size: int,
 ) -> tuple[Rays, Any, list[list[Any] | Any] | list[Any] | Any, Any]:
-    dtype, device = pixels.dtype, pixels.device
-    permutation = torch.randperm(pixels.shape[0], dtype=torch.long, device=device)
-    sampled_subset = permutation[:sample_size]
-    rays_origins, rays_directions = rays.origins, rays.directions
-    selected_rays_origins = rays_origins[sampled_subset, :]
-    selected_rays_directions = rays_directions[sampled_subset, :]
+    # only a handful of images are sampled, so the (tiny) permutation is drawn on the cpu
+    # (no device sync for the returned indices); the selected rays and images are then
+    # gathered on the device the rays live on, so only the selected images are transferred
+    device = rays.origins.device
+    sampled_subset = torch.randperm(pixels.shape[0], dtype=torch.long)[:sample_size]
+    device_subset = sampled_subset.to(device, non_blocking=True)
+    selected_rays_origins = rays.origins.index_select(0, device_subset)
+    selected_rays_directions = rays.directions.index_select(0, device_subset)
     flattened_selected_rays = flatten_rays(Rays(selected_rays_origins, selected_rays_directions))
-    selected_pixels = pixels[sampled_subset, :]
-    selected_indices = indices[sampled_subset.to('cpu')]
+    selected_pixels = pixels.index_select(0, sampled_subset.to(pixels.device)).to(
+        device, non_blocking=True
+    )
+    selected_indices = indices[sampled_subset]
     if sample_size == 1:
         selected_indices = [selected_indices]
     selected_pixels = selected_pixels.permute(0, 2, 3, 1).reshape(-1, pixels.shape[1])
@@ -164,17 +230,21 @@ def sample_rays_directions_and_pixels_synchronously(
     indices: list,
     sample_size: int,
 ) -> Tuple[Rays, Tensor]:
-    dtype, device = pixels.dtype, pixels.device
-    permutation = torch.randperm(pixels.shape[0], dtype=torch.long, device=device)
-    sampled_subset = permutation[:sample_size]
-    rays_origins, rays_directions = rays.origins, rays.directions
-    selected_rays_origins = rays_origins[sampled_subset, :]
-    selected_rays_directions = rays_directions[sampled_subset, :]
+    # only a handful of images are sampled, so the (tiny) permutation is drawn on the cpu
+    # (no device sync for the returned indices); the selected rays and images are then
+    # gathered on the device the rays live on, so only the selected images are transferred
+    device = rays.origins.device
+    sampled_subset = torch.randperm(pixels.shape[0], dtype=torch.long)[:sample_size]
+    device_subset = sampled_subset.to(device, non_blocking=True)
+    selected_rays_origins = rays.origins.index_select(0, device_subset)
+    selected_rays_directions = rays.directions.index_select(0, device_subset)
     flattened_selected_rays = flatten_rays(Rays(selected_rays_origins, selected_rays_directions))
-    selected_pixels = pixels[sampled_subset, :]
+    selected_pixels = pixels.index_select(0, sampled_subset.to(pixels.device)).to(
+        device, non_blocking=True
+    )
     selected_pixels = selected_pixels.permute(0, 2, 3, 1).reshape(-1, pixels.shape[1])
     selected_directions = directions[sampled_subset]
-    selected_indices = indices[sampled_subset.to('cpu')]
+    selected_indices = indices[sampled_subset]
     if sample_size == 1:
         selected_directions = [selected_directions]
         selected_indices = [selected_indices]
@@ -220,9 +290,14 @@ def collate_rendered_output_attn(rendered_chunks: Sequence[RenderOutAttn]) -> Re
     return RenderOutAttn(attn=attn, depth=depth, extra=extra)
 
 def reshape_rendered_output(
-    rendered_output: RenderOut, camera_intrinsics: CameraIntrinsics
+    rendered_output: RenderOut,
+    camera_intrinsics: CameraIntrinsics,
+    num_frames: Optional[int] = None,
 ) -> RenderOut:
     new_shape = (camera_intrinsics.height, camera_intrinsics.width, -1)
+    if num_frames is not None:
+        # batched (multi-camera) renders have a leading frames dimension
+        new_shape = (num_frames, *new_shape)
     return RenderOut(
         colour=rendered_output.colour.reshape(*new_shape),
         depth=rendered_output.depth.reshape(*new_shape),
@@ -233,9 +308,14 @@ def reshape_rendered_output(
     )
 
 def reshape_rendered_output_attn(
-    rendered_output: RenderOutAttn, camera_intrinsics: CameraIntrinsics
+    rendered_output: RenderOutAttn,
+    camera_intrinsics: CameraIntrinsics,
+    num_frames: Optional[int] = None,
 ) -> RenderOutAttn:
     new_shape = (camera_intrinsics.height, camera_intrinsics.width, -1)
+    if num_frames is not None:
+        # batched (multi-camera) renders have a leading frames dimension
+        new_shape = (num_frames, *new_shape)
     return RenderOutAttn(
         attn=rendered_output.attn.reshape(*new_shape),
         depth=rendered_output.depth.reshape(*new_shape),
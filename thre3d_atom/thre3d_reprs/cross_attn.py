@@ -173,7 +173,7 @@ class AttentionStore(AttentionControl):
 
     def forward(self, attn, is_cross: bool, place_in_unet: str):
         key = f"{place_in_unet}_{'cross' if is_cross else 'self'}"
-        if attn.shape[1] <= 32 ** 2:  # avoid memory overhead
+        if attn.shape[1] <= self.max_num_pixels and (is_cross or not self.cross_only):  # avoid memory overhead
             self.step_store[key].append(attn)
         return attn
 
@@ -196,8 +196,16 @@ class AttentionStore(AttentionControl):
         self.step_store = self.get_empty_store()
         self.attention_store = {}
 
-    def __init__(self):
+    def __init__(self, cross_only: bool = False, max_num_pixels: int = 32 ** 2):
+        """
+        Args:
+            cross_only: only keep the cross-attention maps (the self-attention maps
+                        are by far the largest ones, and are not needed for the token maps)
+            max_num_pixels: only keep the maps of the layers with at most these many pixels
+        """
         super(AttentionStore, self).__init__()
+        self.cross_only = cross_only
+        self.max_num_pixels = max_num_pixels
         self.step_store = self.get_empty_store()
         self.attention_store = {}
 
@@ -0,0 +1,121 @@
+// Fused volumetric accumulation (sigma -> alpha -> transmittance -> composited output)
+// for inference-time rendering of SH-based voxel grids. Each thread marches along one ray
+// keeping the transmittance and the accumulated values in registers, so the per-sample
+// intermediate tensors (deltas, alphas, cumprods, weights) never touch global memory.
+#include <torch/extension.h>
+#include <ATen/cuda/CUDAContext.h>
+
+#include <cuda.h>
+#include <cuda_runtime.h>
+
+#define MAX_CHANNELS 8
+#define THREADS_PER_BLOCK 256
+
+template <typename scalar_t>
+__global__ void fused_accumulate_kernel(
+    const scalar_t* __restrict__ points,        // [N x S x (C + 1)] radiance + density
+    const scalar_t* __restrict__ depths,        // [N x S]
+    const scalar_t* __restrict__ ray_norms,     // [N]
+    const int num_rays,
+    const int num_samples,
+    const int num_channels,
+    const float infinity,
+    const float termination_threshold,
+    scalar_t* __restrict__ colour_out,          // [N x C]
+    scalar_t* __restrict__ depth_out,           // [N]
+    scalar_t* __restrict__ acc_out) {           // [N]
+    const int ray = blockIdx.x * blockDim.x + threadIdx.x;
+    if (ray >= num_rays) {
+        return;
+    }
+
+    const int point_stride = num_channels + 1;
+    const scalar_t* ray_points = points + (size_t)ray * num_samples * point_stride;
+    const scalar_t* ray_depths = depths + (size_t)ray * num_samples;
+    const float norm = static_cast<float>(ray_norms[ray]);
+
+    float colour[MAX_CHANNELS];
+    for (int c = 0; c < num_channels; ++c) {
+        colour[c] = 0.0f;
+    }
+    float transmittance = 1.0f, depth = 0.0f, acc = 0.0f;
+
+    for (int s = 0; s < num_samples; ++s) {
+        const float sample_depth = static_cast<float>(ray_depths[s]);
+        const float delta = (s < num_samples - 1)
+            ? (static_cast<float>(ray_depths[s + 1]) - sample_depth) * norm
+            : infinity * norm;
+        const scalar_t* point = ray_points + s * point_stride;
+        const float alpha = -expm1f(-static_cast<float>(point[num_channels]) * delta);
+        const float weight = alpha * transmittance;
+
+        for (int c = 0; c < num_channels; ++c) {
+            // sigmoid tone-map of the raw radiance
+            const float radiance = static_cast<float>(point[c]);
+            colour[c] += weight / (1.0f + __expf(-radiance));
+        }
+        depth += weight * sample_depth;
+        acc += weight;
+
+        // early ray termination once (almost) no light makes it through
+        transmittance *= (1.0f - alpha);
+        if (transmittance < termination_threshold) {
+            break;
+        }
+    }
+
+    for (int c = 0; c < num_channels; ++c) {
+        colour_out[(size_t)ray * num_channels + c] = static_cast<scalar_t>(colour[c]);
+    }
+    depth_out[ray] = static_cast<scalar_t>(depth);
+    acc_out[ray] = static_cast<scalar_t>(acc);
+}
+
+std::vector<torch::Tensor> fused_accumulate(
+    torch::Tensor points,
+    torch::Tensor depths,
+    torch::Tensor ray_norms,
+    double infinity,
+    double termination_threshold) {
+    TORCH_CHECK(points.is_cuda(), "points must be a CUDA tensor");
+    TORCH_CHECK(points.dim() == 3, "points must be of shape [N x S x (C + 1)]");
+    TORCH_CHECK(points.size(2) - 1 <= MAX_CHANNELS, "too many radiance channels for the fused kernel");
+    TORCH_CHECK(depths.is_cuda() && ray_norms.is_cuda(), "depths and ray_norms must be CUDA tensors");
+    TORCH_CHECK(
+        depths.scalar_type() == points.scalar_type() && ray_norms.scalar_type() == points.scalar_type(),
+        "points, depths and ray_norms must have the same dtype");
+
+    points = points.contiguous();
+    depths = depths.contiguous();
+    ray_norms = ray_norms.contiguous();
+
+    const int num_rays = points.size(0);
+    const int num_samples = points.size(1);
+    const int num_channels = points.size(2) - 1;
+
+    auto colour = torch::empty({num_rays, num_channels}, points.options());
+    auto depth = torch::empty({num_rays, 1}, points.options());
+    auto acc = torch::empty({num_rays, 1}, points.options());
+
+    const int blocks = (num_rays + THREADS_PER_BLOCK - 1) / THREADS_PER_BLOCK;
+    AT_DISPATCH_FLOATING_TYPES_AND_HALF(points.scalar_type(), "fused_accumulate", ([&] {
+        fused_accumulate_kernel<scalar_t><<<blocks, THREADS_PER_BLOCK, 0, at::cuda::getCurrentCUDAStream()>>>(
+            points.data_ptr<scalar_t>(),
+            depths.data_ptr<scalar_t>(),
+            ray_norms.data_ptr<scalar_t>(),
+            num_rays,
+            num_samples,
+            num_channels,
+            static_cast<float>(infinity),
+            static_cast<float>(termination_threshold),
+            colour.data_ptr<scalar_t>(),
+            depth.data_ptr<scalar_t>(),
+            acc.data_ptr<scalar_t>());
+    }));
+
+    return {colour, depth, acc};
+}
+
+PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
+    m.def("fused_accumulate", &fused_accumulate, "fused volumetric accumulation along rays (CUDA)");
+}
@@ -0,0 +1,72 @@
+""" python-side handle for the fused (inference-only) CUDA accumulation kernel in fused_render.cu """
+from pathlib import Path
+from typing import Any, Optional, Tuple
+
+import torch
+from torch import Tensor
+
+from thre3d_atom.utils.constants import INFINITY
+from thre3d_atom.utils.logging import log
+
+# transmittance below which the rays are terminated early by the fused kernel
+EARLY_TERMINATION_THRESHOLD = 1e-3
+
+_fused_render_module: Optional[Any] = None
+_fused_render_unavailable = False
+
+
+def _load_fused_render_module() -> Optional[Any]:
+    """JIT compiles (only once per process) the fused CUDA kernel.
+    Returns None if it can't be built, in which case the pytorch path is used"""
+    global _fused_render_module, _fused_render_unavailable
+    if _fused_render_module is not None or _fused_render_unavailable:
+        return _fused_render_module
+
+    try:
+        from torch.utils.cpp_extension import load
+
+        _fused_render_module = load(
+            name="thre3d_fused_render",
+            sources=[str(Path(__file__).parent / "fused_render.cu")],
+            verbose=False,
+        )
+    except Exception as ex:  # missing nvcc / build toolchain etc.
+        log.warning(f"Couldn't build the fused render kernel, using pytorch fallback: {ex}")
+        _fused_render_unavailable = True
+    return _fused_render_module
+
+
+def can_use_fused_accumulation(*tensors: Tensor) -> bool:
+    """the fused kernel is inference-only and needs all of its inputs to live on the GPU"""
+    if not torch.cuda.is_available():
+        return False
+    for tensor in tensors:
+        if not tensor.is_cuda or (torch.is_grad_enabled() and tensor.requires_grad):
+            return False
+    return _load_fused_render_module() is not None
+
+
+def fused_accumulate(
+    points: Tensor, depths: Tensor, ray_directions: Tensor
+) -> Tuple[Tensor, Tensor, Tensor]:
+    """
+    sigma -> alpha -> transmittance -> (sigmoid tone-mapped) radiance accumulation in one kernel
+    Args:
+        points: processed points [N_rays x N_samples x (C + 1)] (raw radiance followed by raw density)
+        depths: depths of the samples [N_rays x N_samples]
+        ray_directions: (unnormalized) ray directions [N_rays x 3]
+    Returns: colour [N_rays x C], depth [N_rays x 1] and accumulated weights [N_rays x 1]
+    """
+    # the kernel reads all of its inputs with a single dtype, so bring them to a common one
+    # (e.g. half precision points looked-up in an fp16 grid and fp32 depths -> fp32)
+    dtype = torch.promote_types(
+        torch.promote_types(points.dtype, depths.dtype), ray_directions.dtype
+    )
+    colour, depth, acc = _load_fused_render_module().fused_accumulate(
+        points.to(dtype),
+        depths.to(dtype),
+        ray_directions.norm(dim=-1).to(dtype),
+        INFINITY,
+        EARLY_TERMINATION_THRESHOLD,
+    )
+    return colour, depth, acc
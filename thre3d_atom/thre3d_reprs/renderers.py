@@ -1,6 +1,6 @@
 import dataclasses
 from functools import partial
-from typing import Callable, Optional, Any
+from typing import Callable, Optional, Any, Tuple
 
 import torch
 from torch import Tensor
@@ -9,15 +9,18 @@ from torch.nn import Module
 from thre3d_atom.rendering.volumetric.accumulate import (
     density2occupancy_pb,
     accumulate_radiance_density_on_rays, accumulate_radiance_density_on_rays_attn,
+    accumulate_attn_channels_on_rays,
 )
 from thre3d_atom.rendering.volumetric.process import process_points_with_sh_voxel_grid, \
-    process_points_with_sh_voxel_grid_attn
+    process_points_with_sh_voxel_grid_attn, process_points_with_sh_voxel_grid_and_attn, \
+    process_points_with_sh_voxel_grid_attn_pair
 from thre3d_atom.rendering.volumetric.render_interface import RenderOut, Rays, render, RenderOutAttn, render_attn
 from thre3d_atom.rendering.volumetric.sample import (
     sample_aabb_bound_uniform_points_on_rays,
+    sample_occupied_aabb_bound_uniform_points_on_rays,
     sample_uniform_points_on_rays,
 )
-from thre3d_atom.thre3d_reprs.voxels import VoxelGrid
+from thre3d_atom.thre3d_reprs.voxels import VoxelGrid, AxisAlignedBoundingBox
 from thre3d_atom.utils.imaging_utils import CameraBounds
 
 # All the rendering procedures below follow this functional type
@@ -34,6 +37,9 @@ class SHVoxGridRenderConfig:
     perturb_sampled_points: bool = True
     optimized_sampling: bool = False
     linear_disparity_sampling: bool = False
+    # precomputed AABB of the occupied region of the grid. If set, samples are only
+    # placed inside it (empty-space skipping for static, inference-only renders)
+    occupied_aabb: Optional[AxisAlignedBoundingBox] = None
 
     # AccumulationConfig
     density2occupancy: Callable[[Tensor, Tensor], Tensor] = density2occupancy_pb
@@ -45,6 +51,29 @@ class SHVoxGridRenderConfig:
     render_diffuse: bool = False
     render_num_samples_per_ray: int = 1024
     parallel_rays_chunk_size: int = 32768
+    # use the fused CUDA accumulation kernel (inference only, falls back to pytorch otherwise)
+    fused_accumulation: bool = False
+
+
+def _select_sampler_function(
+    voxel_grid: VoxelGrid, render_config: SHVoxGridRenderConfig
+) -> Callable[..., Any]:
+    if render_config.occupied_aabb is not None:
+        return partial(
+            sample_occupied_aabb_bound_uniform_points_on_rays,
+            aabb=render_config.occupied_aabb,
+            perturb=render_config.perturb_sampled_points,
+        )
+    if render_config.optimized_sampling:
+        return partial(
+            sample_aabb_bound_uniform_points_on_rays,
+            aabb=voxel_grid.aabb,
+            perturb=render_config.perturb_sampled_points,
+        )
+    return partial(
+        sample_uniform_points_on_rays,
+        perturb=render_config.perturb_sampled_points,
+    )
 
 
 def render_sh_voxel_grid(
@@ -63,17 +92,7 @@ def render_sh_voxel_grid(
     Returns: rendered output per ray (RenderOut) :)
     """
     # select the sampler function based on whether optimized sampling is requested:
-    if render_config.optimized_sampling:
-        sampler_function = partial(
-            sample_aabb_bound_uniform_points_on_rays,
-            aabb=voxel_grid.aabb,
-            perturb=render_config.perturb_sampled_points,
-        )
-    else:
-        sampler_function = partial(
-            sample_uniform_points_on_rays,
-            perturb=render_config.perturb_sampled_points,
-        )
+    sampler_function = _select_sampler_function(voxel_grid, render_config)
     # prepare the processor_function
     point_processor_function = partial(
         process_points_with_sh_voxel_grid,
@@ -89,6 +108,7 @@ def render_sh_voxel_grid(
         radiance_hdr_tone_map=render_config.radiance_hdr_tone_map,
         white_bkgd=render_config.white_bkgd,
         extra_debug_info=False,
+        fused=render_config.fused_accumulation,
     )
 
     # render the output using the render-interface
@@ -120,17 +140,7 @@ def render_sh_voxel_grid_attn(
     Returns: rendered output per ray (RenderOut) :)
     """
     # select the sampler function based on whether optimized sampling is requested:
-    if render_config.optimized_sampling:
-        sampler_function = partial(
-            sample_aabb_bound_uniform_points_on_rays,
-            aabb=voxel_grid.aabb,
-            perturb=render_config.perturb_sampled_points,
-        )
-    else:
-        sampler_function = partial(
-            sample_uniform_points_on_rays,
-            perturb=render_config.perturb_sampled_points,
-        )
+    sampler_function = _select_sampler_function(voxel_grid, render_config)
     # prepare the processor_function
     point_processor_function = partial(
         process_points_with_sh_voxel_grid_attn,
@@ -147,6 +157,7 @@ def render_sh_voxel_grid_attn(
         radiance_hdr_tone_map=render_config.radiance_hdr_tone_map,
         white_bkgd=render_config.white_bkgd,
         extra_debug_info=False,
+        fused=render_config.fused_accumulation,
     )
 
     # render the output using the render-interface
@@ -160,3 +171,105 @@ def render_sh_voxel_grid_attn(
         point_processor_fn=point_processor_function,
         accumulator_fn=accumulator_function,
     )
+
+
+def render_sh_voxel_grid_with_attn(
+    voxel_grid: VoxelGrid,
+    rays: Rays,
+    render_config: SHVoxGridRenderConfig,
+    parallel_points_chunk_size: Optional[int] = None,
+) -> Tuple[RenderOut, RenderOutAttn]:
+    """
+    renders an SH-based voxel grid and its attention features in a single pass. The points are
+    sampled on the rays (and the densities interpolated) only once and are shared by both renders.
+    Args:
+        voxel_grid: the VoxelGrid being rendered (needs to have the attn features)
+        rays: the rays (aka. probes) used for rendering
+        render_config: configuration used by this render_procedure
+        parallel_points_chunk_size: size of each chunk, in case sample/point based parallel processing is required
+    Returns: rendered output per ray (RenderOut) and rendered attn per ray (RenderOutAttn) :)
+    """
+    assert (
+        len(rays.origins.shape) == len(rays.directions.shape) == 2
+    ), f"Please note that the RENDER interface only works with FLAT RAYS!"
+
+    sampler_function = _select_sampler_function(voxel_grid, render_config)
+    sampled_points = sampler_function(
+        rays, render_config.camera_bounds, render_config.num_samples_per_ray
+    )
+    processed_points, processed_attn_points = process_points_with_sh_voxel_grid_and_attn(
+        sampled_points,
+        rays,
+        voxel_grid=voxel_grid,
+        render_diffuse=render_config.render_diffuse,
+        parallel_points_chunk_size=parallel_points_chunk_size,
+    )
+
+    accumulator_kwargs = dict(
+        stochastic_density_noise_std=render_config.stochastic_density_noise_std,
+        density2occupancy=render_config.density2occupancy,
+        radiance_hdr_tone_map=render_config.radiance_hdr_tone_map,
+        white_bkgd=render_config.white_bkgd,
+        extra_debug_info=False,
+        fused=render_config.fused_accumulation,
+    )
+    return (
+        accumulate_radiance_density_on_rays(processed_points, rays, **accumulator_kwargs),
+        accumulate_radiance_density_on_rays_attn(
+            processed_attn_points, rays, **accumulator_kwargs
+        ),
+    )
+
+
+def render_sh_voxel_grid_attn_pair(
+    voxel_grid: VoxelGrid,
+    other_attn: Tensor,
+    rays: Rays,
+    render_config: SHVoxGridRenderConfig,
+    parallel_points_chunk_size: Optional[int] = None,
+) -> Tuple[RenderOutAttn, RenderOutAttn]:
+    """
+    renders the attn of an SH-based voxel grid and another attn grid defined over the same geometry
+    (i.e. same resolution and densities) in a single pass. The points are sampled on the rays, looked-up
+    in the grids and accumulated only once (the two attn renders share the weights along the rays).
+    Args:
+        voxel_grid: the VoxelGrid being rendered (needs to have the attn features)
+        other_attn: the second [W x D x H x A] attn grid, rendered with the voxel_grid's densities
+        rays: the rays (aka. probes) used for rendering
+        render_config: configuration used by this render_procedure
+        parallel_points_chunk_size: size of each chunk, in case sample/point based parallel processing is required
+    Returns: rendered attn per ray (RenderOutAttn) of the voxel_grid's attn and of the other_attn :)
+    """
+    assert (
+        len(rays.origins.shape) == len(rays.directions.shape) == 2
+    ), f"Please note that the RENDER interface only works with FLAT RAYS!"
+
+    sampler_function = _select_sampler_function(voxel_grid, render_config)
+    sampled_points = sampler_function(
+        rays, render_config.camera_bounds, render_config.num_samples_per_ray
+    )
+    # the packed grid is built once here, and not per chunk of points
+    processed_points = process_points_with_sh_voxel_grid_attn_pair(
+        sampled_points,
+        rays,
+        voxel_grid=voxel_grid,
+        packed_attn_pair_grid=voxel_grid.pack_attn_pair_grid(other_attn),
+        parallel_points_chunk_size=parallel_points_chunk_size,
+    )
+    # both the attn channels are accumulated together (with the shared weights)
+    attn_render, depth_render, extra_dict = accumulate_attn_channels_on_rays(
+        processed_points,
+        rays,
+        stochastic_density_noise_std=render_config.stochastic_density_noise_std,
+        density2occupancy=render_config.density2occupancy,
+        radiance_hdr_tone_map=render_config.radiance_hdr_tone_map,
+        white_bkgd=render_config.white_bkgd,
+        extra_debug_info=False,
+        fused=render_config.fused_accumulation,
+    )
+
+    attn, other_attn_render = attn_render.chunk(2, dim=-1)
+    return (
+        RenderOutAttn(attn=attn, depth=depth_render, extra=extra_dict),
+        RenderOutAttn(attn=other_attn_render, depth=depth_render, extra=dict(extra_dict)),
+    )
@@ -9,6 +9,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 import time
+from collections import OrderedDict
 from torch.cuda.amp import custom_bwd, custom_fwd
 
 def seed_everything(seed):
@@ -40,6 +41,44 @@ def seed_everything(seed):
     #torch.backends.cudnn.benchmark = True
 
 
+def _half_precision_dtype() -> torch.dtype:
+    # bf16 keeps fp32's range (no overflow in the attention logits), but needs Ampere or newer
+    if torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return torch.float16
+
+
+# a run only uses a handful of prompts (e.g. the directional variants of one prompt)
+MAX_CACHED_TEXT_EMBEDS = 16
+
+
+def _as_cache_key(prompt):
+    return prompt if isinstance(prompt, str) else tuple(prompt)
+
+
+class TextEmbedsCache:
+    """LRU cache of the text embeddings per (prompt, negative_prompt). The text encoder is frozen,
+    so the embeddings of a prompt never change"""
+
+    def __init__(self, max_size: int = MAX_CACHED_TEXT_EMBEDS) -> None:
+        self._max_size = max_size
+        self._cache = OrderedDict()
+
+    def get(self, prompt, negative_prompt):
+        cache_key = (_as_cache_key(prompt), _as_cache_key(negative_prompt))
+        text_embeddings = self._cache.get(cache_key)
+        if text_embeddings is not None:
+            self._cache.move_to_end(cache_key)
+        return text_embeddings
+
+    def put(self, prompt, negative_prompt, text_embeddings) -> None:
+        cache_key = (_as_cache_key(prompt), _as_cache_key(negative_prompt))
+        self._cache[cache_key] = text_embeddings
+        self._cache.move_to_end(cache_key)
+        if len(self._cache) > self._max_size:
+            self._cache.popitem(last=False)
+
+
 class StableDiffusion(nn.Module):
     def __init__(self, device,
                  sd_version='2.1',
@@ -99,6 +138,8 @@ class StableDiffusion(nn.Module):
 
         self.alphas = self.scheduler.alphas_cumprod.to(self.device) # for convenience
 
+        self._text_embeds_cache = TextEmbedsCache()
+
         print(f'[INFO] loaded stable diffusion!')
 
     def get_max_step_ratio(self):
@@ -107,6 +148,10 @@ class StableDiffusion(nn.Module):
     def get_text_embeds(self, prompt, negative_prompt):
         # prompt, negative_prompt: [str]
 
+        text_embeddings = self._text_embeds_cache.get(prompt, negative_prompt)
+        if text_embeddings is not None:
+            return text_embeddings
+
         # Tokenize text and get embeddings
         text_input = self.tokenizer(prompt, padding='max_length', max_length=self.tokenizer.model_max_length, truncation=True, return_tensors='pt')
 
@@ -121,18 +166,26 @@ class StableDiffusion(nn.Module):
 
         # Cat for final embeddings
         text_embeddings = torch.cat([uncond_embeddings, text_embeddings])
+        self._text_embeds_cache.put(prompt, negative_prompt, text_embeddings)
         return text_embeddings
 
     def get_attn_map(self, prompt, pred_rgb, timestamp=0, indices_to_fetch=[7], guidance_scale=100,  logvar=None):
         prompt = [prompt]
         batch_size = len(prompt)
-        controller = ca.AttentionStore()
+        # only the (16 x 16) cross-attention maps are aggregated into the token maps below,
+        # so the (much larger) self-attention and higher resolution maps are not kept around
+        controller = ca.AttentionStore(cross_only=True, max_num_pixels=16 ** 2)
         ca.register_attention_control(self.unet, controller)
         # interp to 512x512 to be fed into vae.
 
-        with torch.no_grad():
+        # (outside of the autocast, so that the cached embeddings stay in full precision)
+        text_embeddings = self.get_text_embeds(prompt, '')
+
+        # the attention maps are only a (no-grad) target, so the UNet forward can run in half precision
+        with torch.no_grad(), torch.autocast(
+            self.device.type, dtype=_half_precision_dtype(), enabled=self.device.type == "cuda"
+        ):
             orig_im_h, orig_im_w = pred_rgb.shape[-2:]
-            text_embeddings = self.get_text_embeds(prompt, '')
             pred_rgb_512 = F.interpolate(pred_rgb, (512, 512), mode='bilinear', align_corners=False)
             t = torch.randint(self.min_step, self.max_step + 1, [1], dtype=torch.long, device=self.device)
             if timestamp > 0:
@@ -154,7 +207,12 @@ class StableDiffusion(nn.Module):
                     attention_store=controller,
                     indices_to_alter=indices_to_fetch, orig_im_h=orig_im_h, orig_im_w=orig_im_h
                 )
-        return attn_maps, t.item()
+        # hand the (target) attention maps back in full precision
+        if attn_maps is not None:
+            attn_maps = [attn_map.float() for attn_map in attn_maps]
+        # t is returned as a (device) tensor: calling .item() here would block the host until the
+        # UNet forward is done, which defeats running this on a side stream
+        return attn_maps, t
 
 
     def train_step(self, text_embeddings, pred_rgb, guidance_scale=100, global_step=-1, logvar=None):
@@ -5,6 +5,7 @@ from diffusers import AutoencoderKL, UNet2DConditionModel, PNDMScheduler, DDIMSc
 import matplotlib.pyplot as plt
 
 from thre3d_atom.thre3d_reprs.cross_attn import AttentionStore
+from thre3d_atom.thre3d_reprs.sd import TextEmbedsCache
 
 # suppress partial model loading warning
 logging.set_verbosity_error()
@@ -90,12 +91,18 @@ class StableDiffusion(nn.Module):
         self.max_step = int(self.num_train_timesteps * 0.98)
         self.alphas = self.scheduler.alphas_cumprod.to(self.device)  # for convenience
 
+        self._text_embeds_cache = TextEmbedsCache()
+
         print(f'[INFO] loaded stable diffusion!')
 
     def get_text_embeds(self, prompt, negative_prompt):
         # prompt, negative_prompt: [str]
         batch_size = len(prompt)
 
+        text_embeddings = self._text_embeds_cache.get(prompt, negative_prompt)
+        if text_embeddings is not None:
+            return text_embeddings
+
         # Tokenize text and get embeddings
         text_input = self.tokenizer(prompt, padding='max_length', max_length=self.tokenizer.model_max_length,
                                     truncation=True, return_tensors='pt')
@@ -113,11 +120,14 @@ class StableDiffusion(nn.Module):
 
         # Cat for final embeddings
         text_embeddings = torch.cat([uncond_embeddings, text_embeddings])
+        self._text_embeds_cache.put(prompt, negative_prompt, text_embeddings)
         return text_embeddings
 
     def get_attn_map(self, prompt, pred_rgb, timestamp=0, indices_to_alter=[7], guidance_scale=100,  logvar=None):
         batch_size = len(prompt)
-        controller = ca.AttentionStore()
+        # only the (16 x 16) cross-attention maps are aggregated into the token maps below,
+        # so the (much larger) self-attention and higher resolution maps are not kept around
+        controller = ca.AttentionStore(cross_only=True, max_num_pixels=16 ** 2)
         ca.register_attention_control(self.unet, controller)
         # interp to 512x512 to be fed into vae.
 
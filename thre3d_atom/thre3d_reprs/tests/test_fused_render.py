@@ -0,0 +1,70 @@
+import pytest
+import torch
+
+from thre3d_atom.rendering.volumetric.accumulate import (
+    accumulate_radiance_density_on_rays,
+)
+from thre3d_atom.rendering.volumetric.render_interface import (
+    ProcessedPointsOnRays,
+    Rays,
+)
+from thre3d_atom.thre3d_reprs.fused_render import (
+    can_use_fused_accumulation,
+    fused_accumulate,
+)
+from thre3d_atom.utils.constants import EXTRA_ACCUMULATED_WEIGHTS
+
+
+def _random_processed_points(
+    num_rays: int, num_samples: int, device: torch.device
+) -> ProcessedPointsOnRays:
+    # radiance followed by a (post-activated, i.e. non-negative) density per sample
+    radiance = torch.empty(num_rays, num_samples, 3, device=device).uniform_(-5.0, 5.0)
+    density = torch.empty(num_rays, num_samples, 1, device=device).uniform_(0.0, 5.0)
+    depths = torch.linspace(2.0, 6.0, num_samples, device=device)
+    depths = depths[None, :].repeat(num_rays, 1)
+    return ProcessedPointsOnRays(torch.cat([radiance, density], dim=-1), depths)
+
+
+def _random_rays(num_rays: int, device: torch.device) -> Rays:
+    return Rays(
+        origins=torch.zeros(num_rays, 3, device=device),
+        directions=torch.randn(num_rays, 3, device=device),
+    )
+
+
+@pytest.mark.skipif(
+    not torch.cuda.is_available()
+    or not can_use_fused_accumulation(torch.empty(0, device="cuda")),
+    reason="the fused accumulation kernel needs CUDA and a build toolchain",
+)
+@pytest.mark.parametrize("points_dtype", [torch.float32, torch.float16])
+def test_fused_accumulate_matches_pytorch_accumulation(
+    points_dtype: torch.dtype,
+) -> None:
+    # GIVEN: random processed points on rays (possibly looked-up in an fp16 grid)
+    device = torch.device("cuda")
+    num_rays, num_samples = 1024, 128
+    processed_points = _random_processed_points(num_rays, num_samples, device)
+    rays = _random_rays(num_rays, device)
+    half_points = ProcessedPointsOnRays(
+        processed_points.points.to(points_dtype), processed_points.depths
+    )
+
+    # WHEN: accumulated with the fused kernel and with the pytorch path
+    with torch.no_grad():
+        colour, depth, acc = fused_accumulate(
+            half_points.points, half_points.depths, rays.directions
+        )
+        expected = accumulate_radiance_density_on_rays(
+            ProcessedPointsOnRays(half_points.points.float(), half_points.depths),
+            rays,
+            stochastic_density_noise_std=0.0,
+            white_bkgd=False,
+        )
+
+    # THEN: both agree up to the early ray termination of the kernel
+    assert colour.dtype == depth.dtype == acc.dtype == torch.float32
+    assert torch.allclose(colour, expected.colour, atol=1e-2)
+    assert torch.allclose(depth, expected.depth, atol=1e-1)
+    assert torch.allclose(acc, expected.extra[EXTRA_ACCUMULATED_WEIGHTS], atol=1e-2)
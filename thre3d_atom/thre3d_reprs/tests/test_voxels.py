@@ -5,9 +5,14 @@ import numpy as np
 import torch
 from tqdm import tqdm
 
+from thre3d_atom.rendering.volumetric.sample import (
+    sample_occupied_aabb_bound_uniform_points_on_rays,
+)
 from thre3d_atom.rendering.volumetric.utils.misc import cast_rays, flatten_rays
 from thre3d_atom.thre3d_reprs.renderers import (
     render_sh_voxel_grid,
+    render_sh_voxel_grid_attn,
+    render_sh_voxel_grid_attn_pair,
     SHVoxGridRenderConfig,
 )
 from thre3d_atom.thre3d_reprs.voxels import (
@@ -207,3 +212,123 @@ def test_render_speed(device: torch.device) -> None:
 
     avg_render_time = np.mean(render_times).item()
     print(f"total time taken for rendering: {avg_render_time} ms")
+
+
+def _random_voxel_grid(
+    grid_size: int, device: torch.device, attn: torch.Tensor = None
+) -> VoxelGrid:
+    densities = torch.empty((grid_size, grid_size, grid_size, 1), device=device)
+    densities = torch.nn.init.uniform_(densities, -10.0, 10.0)
+    features = torch.empty((grid_size, grid_size, grid_size, 3), device=device)
+    features = torch.nn.init.uniform_(features, -10.0, 10.0)
+    return VoxelGrid(
+        densities=densities,
+        features=features,
+        voxel_size=VoxelSize(2.0 / grid_size, 2.0 / grid_size, 2.0 / grid_size),
+        density_preactivation=torch.nn.Identity(),
+        density_postactivation=torch.nn.ReLU(),
+        attn=attn,
+    )
+
+
+def test_render_attn_pair_matches_separate_attn_renders(device: torch.device) -> None:
+    # GIVEN: two attn grids over the same geometry
+    grid_size = 16
+    edit_attn = torch.empty((grid_size, grid_size, grid_size, 1), device=device).uniform_(-5.0, 5.0)
+    object_attn = torch.empty_like(edit_attn).uniform_(-5.0, 5.0)
+    edit_grid = _random_voxel_grid(grid_size, device, attn=edit_attn)
+    object_grid = VoxelGrid(
+        densities=edit_grid.densities,
+        features=edit_grid.features,
+        voxel_size=edit_grid.voxel_size,
+        attn=object_attn,
+        **edit_grid.get_config_dict(),
+    )
+    render_config = SHVoxGridRenderConfig(
+        num_samples_per_ray=64,
+        camera_bounds=CameraBounds(2.0, 6.0),
+        perturb_sampled_points=False,
+    )
+    rays = flatten_rays(
+        cast_rays(
+            CameraIntrinsics(32, 32, 40.0),
+            pose_spherical(yaw=30.0, pitch=-20.0, radius=4.0),
+            device=device,
+        )
+    )
+
+    # WHEN: rendered in a single pass and with two separate renders
+    with torch.no_grad():
+        edit_pair, object_pair = render_sh_voxel_grid_attn_pair(
+            edit_grid, object_attn, rays, render_config, parallel_points_chunk_size=1024
+        )
+        edit_render = render_sh_voxel_grid_attn(edit_grid, rays, render_config)
+        object_render = render_sh_voxel_grid_attn(object_grid, rays, render_config)
+
+    # THEN: the renders are the same
+    assert torch.allclose(edit_pair.attn, edit_render.attn, atol=1e-5)
+    assert torch.allclose(object_pair.attn, object_render.attn, atol=1e-5)
+    assert torch.allclose(edit_pair.depth, edit_render.depth, atol=1e-4)
+
+
+def test_get_occupied_aabb(device: torch.device) -> None:
+    # GIVEN: an empty grid with a single occupied block of voxels
+    grid_size = 16
+    voxel_grid = _random_voxel_grid(grid_size, device)
+    voxel_grid.densities.data.fill_(-10.0)
+    assert voxel_grid.get_occupied_aabb() == voxel_grid.aabb
+    voxel_grid.densities.data[4:8, 5:10, 6:12] = 10.0
+
+    # WHEN: the occupied aabb is computed
+    occupied_aabb = voxel_grid.get_occupied_aabb()
+
+    # THEN: it is the block padded by a voxel on either side (voxel edge = 0.125)
+    for (low, high), expected in zip(
+        occupied_aabb, ((-0.625, 0.125), (-0.5, 0.375), (-0.375, 0.625))
+    ):
+        assert np.isclose(low, expected[0]) and np.isclose(high, expected[1])
+
+    # AND: the rays sampled inside it keep their last sample at the far bound
+    camera_bounds = CameraBounds(2.0, 6.0)
+    rays = flatten_rays(
+        cast_rays(
+            CameraIntrinsics(32, 32, 40.0),
+            pose_spherical(yaw=30.0, pitch=-20.0, radius=4.0),
+            device=device,
+        )
+    )
+    sampled_points = sample_occupied_aabb_bound_uniform_points_on_rays(
+        rays, camera_bounds, num_samples=64, aabb=occupied_aabb, perturb=False
+    )
+    assert sampled_points.depths.shape == (len(rays.origins), 64)
+    assert torch.all(sampled_points.depths[:, -1] >= camera_bounds.far)
+    assert not voxel_grid.test_inside_volume(sampled_points.points[:, -1]).any()
+
+
+def test_packed_grid_matches_unpacked_grid(device: torch.device) -> None:
+    # GIVEN: a grid with (multi-channel) SH attn features and random points in and around it
+    grid_size = 16
+    attn = torch.empty((grid_size, grid_size, grid_size, 9), device=device).uniform_(-5.0, 5.0)
+    voxel_grid = _random_voxel_grid(grid_size, device, attn=attn)
+    points = torch.empty((4096, 3), device=device).uniform_(-1.2, 1.2)
+
+    # WHEN: the points are looked-up before and after packing the grid for inference
+    with torch.no_grad():
+        unpacked_outputs = (
+            voxel_grid(points),
+            voxel_grid.forward_attn(points),
+            voxel_grid.forward_with_attn(points),
+        )
+        voxel_grid.pack_grid_for_inference_()
+        packed_outputs = (
+            voxel_grid(points),
+            voxel_grid.forward_attn(points),
+            voxel_grid.forward_with_attn(points),
+        )
+        voxel_grid.unpack_grid_()
+
+    # THEN: the outputs are the same
+    assert [output.shape[-1] for output in packed_outputs] == [3 + 1, 9 + 1, 3 + 9 + 1]
+    for packed_output, unpacked_output in zip(packed_outputs, unpacked_outputs):
+        assert packed_output.shape == unpacked_output.shape
+        assert torch.allclose(packed_output, unpacked_output, atol=1e-5)
@@ -108,6 +108,7 @@ class VoxelGrid(Module):
         self._tunable = tunable
         self.attn = attn
         self.orig_densities = densities
+        self._packed_inference_grid: Optional[Tensor] = None
 
         if tunable:
             self._densities = torch.nn.Parameter(self._densities)
@@ -129,6 +130,61 @@ class VoxelGrid(Module):
         # setup the bounding box planes
         self._aabb = self._setup_bounding_box_planes()
 
+    def cast_grid_storage_(self, dtype: torch.dtype = torch.float16) -> None:
+        """casts the stored grid values (densities, features and attn) in-place to the given dtype.
+        Meant for inference-only rendering where halving the bytes of the grid halves the memory
+        traffic of the trilinear lookups. The interpolated values are cast back to the dtype
+        of the query points, so everything downstream (incl. accumulation) stays in full precision."""
+        self._densities.data = self._densities.data.to(dtype)
+        self._features.data = self._features.data.to(dtype)
+        self.orig_densities = self.orig_densities.to(dtype)
+        if self.attn is not None:
+            self.attn.data = self.attn.data.to(dtype)
+
+    @staticmethod
+    def _interpolate_grid(grid: Tensor, normalized_points: Tensor) -> Tensor:
+        """single (hardware trilinear) grid_sample lookup of a [X x Y x Z x C] grid
+        at the [N x 3] normalized points. Returns [N x C]"""
+        # note the weird z, y, x convention of PyTorch's grid_sample.
+        # reference ->
+        # https://discuss.pytorch.org/t/surprising-convention-for-grid-sample-coordinates/79997/3
+        return VoxelGrid._interpolate_permuted_grid(
+            grid[None, ...].permute(0, 4, 3, 2, 1), normalized_points
+        )
+
+    @staticmethod
+    def _interpolate_permuted_grid(grid: Tensor, normalized_points: Tensor) -> Tensor:
+        """same as `_interpolate_grid`, but for an already permuted [1 x C x Z x Y x X] grid"""
+        return (
+            grid_sample(grid, normalized_points[None, None, None, ...], align_corners=False)
+            .permute(0, 2, 3, 4, 1)
+            .reshape(-1, grid.shape[1])
+        )
+
+    def pack_grid_for_inference_(self) -> None:
+        """packs the (preactivated) features, attn and densities of a static grid into a single
+        [1 x C x Z x Y x X] tensor whose channels are contiguous per voxel, so that `forward_with_attn`
+        fetches all the channels of a voxel corner in one grid_sample instead of three separate
+        lookups over three separately strided grids. Must be called again (or the packed grid
+        dropped with `unpack_grid_`) if the grid values are modified afterwards."""
+        with torch.no_grad():
+            packed_grid = torch.cat(
+                [
+                    self._feature_preactivation(self._features),
+                    self._feature_preactivation(self.attn),
+                    self._density_preactivation(
+                        self._densities * self._expected_density_scale
+                    ),
+                ],
+                dim=-1,
+            )
+        # the [X x Y x Z x C] contiguous storage is only permuted (not copied) to PyTorch's
+        # z, y, x convention, so the channels of a voxel stay adjacent in memory
+        self._packed_inference_grid = packed_grid.contiguous()[None, ...].permute(0, 4, 3, 2, 1)
+
+    def unpack_grid_(self) -> None:
+        self._packed_inference_grid = None
+
     def add_attn_params(self, attn):
         self.attn = torch.nn.Parameter(attn)
     def update_orig_densities(self):
@@ -222,6 +278,43 @@ class VoxelGrid(Module):
             z_range=height_z_range,
         )
 
+    def get_occupied_aabb(self, density_threshold: float = 1e-2) -> AxisAlignedBoundingBox:
+        """
+        computes the (tight) axis-aligned bounding box of the occupied voxels of the grid. Rays can then
+        be sampled only inside this box, skipping the empty space around the object. Meant to be computed
+        once for a static grid (e.g. before rendering an animation).
+        Args:
+            density_threshold: voxels with (activated) densities above this value are considered occupied
+        Returns: the occupied AABB (the full AABB of the grid if nothing is occupied)
+        """
+        with torch.no_grad():
+            densities = self._density_postactivation(
+                self._density_preactivation(
+                    self._densities.float() * self._expected_density_scale
+                )
+            )[..., 0]
+            occupancy = densities > density_threshold
+            if not occupancy.any():
+                return self._aabb
+
+            occupied_ranges = []
+            for axis, (coordinate_range, voxel_edge) in enumerate(
+                zip(self._aabb, self._voxel_size)
+            ):
+                occupied_along_axis = torch.nonzero(
+                    occupancy.movedim(axis, 0).flatten(1).any(dim=-1)
+                )
+                # pad by a voxel on either side to account for the trilinear interpolation
+                low_index = occupied_along_axis.min().item() - 1
+                high_index = occupied_along_axis.max().item() + 2
+                occupied_ranges.append(
+                    (
+                        max(coordinate_range[0] + low_index * voxel_edge, coordinate_range[0]),
+                        min(coordinate_range[0] + high_index * voxel_edge, coordinate_range[1]),
+                    )
+                )
+        return AxisAlignedBoundingBox(*occupied_ranges)
+
     def _normalize_points(self, points: Tensor) -> Tensor:
         normalized_points = torch.empty_like(points, device=points.device)
         for coordinate_index, coordinate_range in enumerate(self._aabb):
@@ -296,41 +389,34 @@ class VoxelGrid(Module):
                  whether the `self._radiance_transfer_function` is None.
         """
         # obtain the range-normalized points for interpolation
-        normalized_points = self._normalize_points(points)
+        # (in the grid's storage precision, which could be lower for inference)
+        normalized_points = self._normalize_points(points).to(self._features.dtype)
 
-        # interpolate and compute densities
-        # Note the pre- and post-activations :)
-        preactivated_densities = self._density_preactivation(
-            self._densities * self._expected_density_scale
-        )  # note the use of the expected density scale
-        interpolated_densities = (
-            grid_sample(
-                # note the weird z, y, x convention of PyTorch's grid_sample.
-                # reference ->
-                # https://discuss.pytorch.org/t/surprising-convention-for-grid-sample-coordinates/79997/3
-                preactivated_densities[None, ...].permute(0, 4, 3, 2, 1),
-                normalized_points[None, None, None, ...],
-                align_corners=False,
+        if self._packed_inference_grid is not None:
+            # one lookup for all the channels of the packed grid (the attn channels are unused)
+            interpolated = self._interpolate_permuted_grid(
+                self._packed_inference_grid, normalized_points
             )
-            .permute(0, 2, 3, 4, 1)
-            .squeeze()
-        )[
-            ..., None
-        ]  # note this None is required because of the squeeze operation :sweat_smile:
-        interpolated_densities = self._density_postactivation(interpolated_densities)
-
-        # interpolate and compute features
-        preactivated_features = self._feature_preactivation(self._features)
-        interpolated_features = (
-            grid_sample(
-                preactivated_features[None, ...].permute(0, 4, 3, 2, 1),
-                normalized_points[None, None, None, ...],
-                align_corners=False,
+            num_attn_channels = self.attn.shape[-1]
+            interpolated_densities = self._density_postactivation(interpolated[..., -1:])
+            interpolated_features = self._feature_postactivation(
+                interpolated[..., : -(num_attn_channels + 1)]
+            )
+        else:
+            # interpolate and compute densities
+            # Note the pre- and post-activations :)
+            preactivated_densities = self._density_preactivation(
+                self._densities * self._expected_density_scale
+            )  # note the use of the expected density scale
+            interpolated_densities = self._density_postactivation(
+                self._interpolate_grid(preactivated_densities, normalized_points)
+            )
+
+            # interpolate and compute features
+            preactivated_features = self._feature_preactivation(self._features)
+            interpolated_features = self._feature_postactivation(
+                self._interpolate_grid(preactivated_features, normalized_points)
             )
-            .permute(0, 2, 3, 4, 1)
-            .squeeze()
-        )
-        interpolated_features = self._feature_postactivation(interpolated_features)
 
         # apply the radiance transfer function if it is not None and if view-directions are available
         if self._radiance_transfer_function is not None and viewdirs is not None:
@@ -339,7 +425,9 @@ class VoxelGrid(Module):
             )
 
         # return a unified tensor containing interpolated features and densities
-        return torch.cat([interpolated_features, interpolated_densities], dim=-1)
+        return torch.cat([interpolated_features, interpolated_densities], dim=-1).to(
+            points.dtype
+        )
 
     def forward_attn(self, points: Tensor, viewdirs: Optional[Tensor] = None,orig_densities=False) -> Tensor:
         """
@@ -353,48 +441,36 @@ class VoxelGrid(Module):
                  whether the `self._radiance_transfer_function` is None.
         """
         # obtain the range-normalized points for interpolation
-        normalized_points = self._normalize_points(points)
+        # (in the grid's storage precision, which could be lower for inference)
+        normalized_points = self._normalize_points(points).to(self._features.dtype)
 
-        # interpolate and compute densities
-        # Note the pre- and post-activations :)
-        if orig_densities:
-            preactivated_densities = self._density_preactivation(
-            self.orig_densities * self._expected_density_scale
-        )
+        if self._packed_inference_grid is not None and not orig_densities:
+            # attn and densities are the trailing channels of the packed grid
+            interpolated = self._interpolate_permuted_grid(
+                self._packed_inference_grid[:, -(self.attn.shape[-1] + 1):], normalized_points
+            )
+            interpolated_densities = self._density_postactivation(interpolated[..., -1:])
+            interpolated_features = self._feature_postactivation(interpolated[..., :-1])
         else:
-            preactivated_densities = self._density_preactivation(
-                self._densities * self._expected_density_scale
-            )  # note the use of the expected density scale
-        interpolated_densities = (
-            grid_sample(
-                # note the weird z, y, x convention of PyTorch's grid_sample.
-                # reference ->
-                # https://discuss.pytorch.org/t/surprising-convention-for-grid-sample-coordinates/79997/3
-                preactivated_densities[None, ...].permute(0, 4, 3, 2, 1),
-                normalized_points[None, None, None, ...],
-                align_corners=False,
+            # interpolate and compute densities
+            # Note the pre- and post-activations :)
+            if orig_densities:
+                preactivated_densities = self._density_preactivation(
+                    self.orig_densities * self._expected_density_scale
+                )
+            else:
+                preactivated_densities = self._density_preactivation(
+                    self._densities * self._expected_density_scale
+                )  # note the use of the expected density scale
+            interpolated_densities = self._density_postactivation(
+                self._interpolate_grid(preactivated_densities, normalized_points)
             )
-            .permute(0, 2, 3, 4, 1)
-            .squeeze()
-        )[
-            ..., None
-        ]  # note this None is required because of the squeeze operation :sweat_smile:
-        interpolated_densities = self._density_postactivation(interpolated_densities)
-
-        # interpolate and compute features
-        preactivated_features = self._feature_preactivation(self.attn)
-        interpolated_features = (
-            grid_sample(
-                preactivated_features[None, ...].permute(0, 4, 3, 2, 1),
-                normalized_points[None, None, None, ...],
-                align_corners=False,
+
+            # interpolate and compute features
+            preactivated_features = self._feature_preactivation(self.attn)
+            interpolated_features = self._feature_postactivation(
+                self._interpolate_grid(preactivated_features, normalized_points)
             )
-            .permute(0, 2, 3, 4, 1)
-            .squeeze()
-        )[
-            ..., None
-        ]
-        interpolated_features = self._feature_postactivation(interpolated_features)
 
         # apply the radiance transfer function if it is not None and if view-directions are available
         if self._radiance_transfer_function is not None and viewdirs is not None:
@@ -403,7 +479,96 @@ class VoxelGrid(Module):
             )
 
         # return a unified tensor containing interpolated features and densities
-        return torch.cat([interpolated_features, interpolated_densities], dim=-1)
+        return torch.cat([interpolated_features, interpolated_densities], dim=-1).to(
+            points.dtype
+        )
+
+    def forward_with_attn(self, points: Tensor) -> Tensor:
+        """
+        computes both the features and the attn features at the requested 3D points, sharing the
+        (single) density interpolation between the two
+        Args:
+            points: Tensor of shape [N x 3 (NUM_COORD_DIMENSIONS)]
+        Returns: Tensor of shape [N x <F + A + 1> (number of features + attn features + density)]
+        """
+        # obtain the range-normalized points for interpolation
+        # (in the grid's storage precision, which could be lower for inference)
+        normalized_points = self._normalize_points(points).to(self._features.dtype)
+
+        if self._packed_inference_grid is not None:
+            # single lookup into the packed channel-contiguous grid
+            interpolated = self._interpolate_permuted_grid(
+                self._packed_inference_grid, normalized_points
+            )
+            num_attn_channels = self.attn.shape[-1]
+            return torch.cat(
+                [
+                    self._feature_postactivation(interpolated[..., : -(num_attn_channels + 1)]),
+                    self._feature_postactivation(interpolated[..., -(num_attn_channels + 1):-1]),
+                    self._density_postactivation(interpolated[..., -1:]),
+                ],
+                dim=-1,
+            ).to(points.dtype)
+
+        preactivated_densities = self._density_preactivation(
+            self._densities * self._expected_density_scale
+        )  # note the use of the expected density scale
+        interpolated_densities = self._density_postactivation(
+            self._interpolate_grid(preactivated_densities, normalized_points)
+        )
+        interpolated_features = self._feature_postactivation(
+            self._interpolate_grid(self._feature_preactivation(self._features), normalized_points)
+        )
+        interpolated_attn = self._feature_postactivation(
+            self._interpolate_grid(self._feature_preactivation(self.attn), normalized_points)
+        )
+
+        return torch.cat(
+            [interpolated_features, interpolated_attn, interpolated_densities], dim=-1
+        ).to(points.dtype)
+
+    def pack_attn_pair_grid(self, other_attn: Tensor) -> Tensor:
+        """
+        packs the (preactivated) attn of this grid, another attn grid defined over the same
+        geometry (same resolution and densities) and the densities into a single [1 x C x Z x Y x X]
+        grid for `forward_attn_pair`. Differentiable w.r.t. both the attn grids; meant to be built
+        once per render (and not per chunk of points), since it copies all the three grids
+        Args:
+            other_attn: Tensor of shape [W x D x H x A] (same shape as this grid's attn)
+        Returns: packed Tensor of shape [1 x <A + A + 1> x H x D x W]
+        """
+        packed_grid = torch.cat(
+            [
+                self._feature_preactivation(self.attn),
+                self._feature_preactivation(other_attn),
+                self._density_preactivation(
+                    self._densities * self._expected_density_scale
+                ),  # note the use of the expected density scale
+            ],
+            dim=-1,
+        )
+        return packed_grid[None, ...].permute(0, 4, 3, 2, 1)
+
+    def forward_attn_pair(self, points: Tensor, packed_attn_pair_grid: Tensor) -> Tensor:
+        """
+        computes the attn features of this grid and of another attn grid defined over the same
+        geometry at the requested 3D points. Both attn grids and the densities are fetched with a
+        single grid lookup
+        Args:
+            points: Tensor of shape [N x 3 (NUM_COORD_DIMENSIONS)]
+            packed_attn_pair_grid: the output of `pack_attn_pair_grid`
+        Returns: Tensor of shape [N x <A + A + 1> (attn + other attn + density)]
+        """
+        normalized_points = self._normalize_points(points).to(self._features.dtype)
+
+        interpolated = self._interpolate_permuted_grid(packed_attn_pair_grid, normalized_points)
+        return torch.cat(
+            [
+                self._feature_postactivation(interpolated[..., :-1]),
+                self._density_postactivation(interpolated[..., -1:]),
+            ],
+            dim=-1,
+        ).to(points.dtype)
 
 
 def scale_voxel_grid_with_required_output_size(
@@ -30,6 +30,17 @@ class CameraBounds(NamedTuple):
     far: float
 
 
+class CameraPath(list):
+    """a list of CameraPoses which also keeps all of them packed in a single [N x 3 x 4]
+    ([R | t]) tensor. The poses are views into this tensor"""
+
+    def __init__(self, poses: Tensor) -> None:
+        super().__init__(
+            CameraPose(rotation=c2w[:, :3], translation=c2w[:, 3:]) for c2w in poses
+        )
+        self.poses = poses
+
+
 # ----------------------------------------------------------------------------------
 # Miscellaneous utility functions
 # ----------------------------------------------------------------------------------
@@ -196,16 +207,60 @@ def pose_spherical(
 # ----------------------------------------------------------------------------------
 
 
+def _pose_spherical_batched(yaws: Tensor, pitches: Tensor, radii: Tensor) -> CameraPath:
+    """vectorized version of `pose_spherical`. All the poses are built in a single
+    [N x 3 x 4] tensor on the device of the inputs (angles are in degrees)"""
+    yaws, pitches = yaws / 180.0 * np.pi, pitches / 180.0 * np.pi
+    cos_y, sin_y = torch.cos(yaws), torch.sin(yaws)
+    cos_p, sin_p = torch.cos(pitches), torch.sin(pitches)
+    zeros = torch.zeros_like(yaws)
+
+    # rotation = rotate_yaw @ rotate_pitch
+    rotations = torch.stack(
+        [
+            torch.stack([cos_y, -sin_y * cos_p, sin_y * sin_p], dim=-1),
+            torch.stack([sin_y, cos_y * cos_p, -cos_y * sin_p], dim=-1),
+            torch.stack([zeros, sin_p, cos_p], dim=-1),
+        ],
+        dim=-2,
+    )
+    # translation = rotation @ [0, 0, radius]
+    translations = rotations[..., 2:] * radii[:, None, None]
+    return CameraPath(torch.cat([rotations, translations], dim=-1))
+
+
+def stack_camera_poses(
+    camera_poses: Sequence[CameraPose], device=torch.device("cpu")
+) -> Tensor:
+    """packs the camera poses into a single contiguous [N x 3 x 4] ([R | t]) tensor on the device,
+    so that the rays of all of them can be cast with one batched matmul (one H2D copy at most)"""
+    if isinstance(camera_poses, CameraPath):
+        # already packed (e.g. the animation paths), no need to re-stack the per-pose views
+        return camera_poses.poses.to(device=device, dtype=torch.float32, non_blocking=True)
+    return torch.stack(
+        [
+            torch.cat(
+                [torch.as_tensor(pose.rotation), torch.as_tensor(pose.translation)],
+                dim=-1,
+            )
+            for pose in camera_poses
+        ]
+    ).to(device=device, dtype=torch.float32, non_blocking=True)
+
+
 def get_thre360_animation_poses(
-    hemispherical_radius: float, camera_pitch: float, num_poses: int
-) -> Sequence[CameraPose]:
-    return [
-        pose_spherical(yaw, pitch, hemispherical_radius)
-        for (pitch, yaw) in zip(
-            [camera_pitch] * (num_poses - 1),
-            np.linspace(0, 360, num_poses)[:-1],
-        )
-    ]
+    hemispherical_radius: float,
+    camera_pitch: float,
+    num_poses: int,
+    device=torch.device("cpu"),
+) -> CameraPath:
+    # note that we discard the final one so that video-loop looks smooth
+    yaws = torch.linspace(0, 360, num_poses, dtype=torch.float32, device=device)[:-1]
+    return _pose_spherical_batched(
+        yaws=yaws,
+        pitches=torch.full_like(yaws, camera_pitch),
+        radii=torch.full_like(yaws, hemispherical_radius),
+    )
 
 
 def get_thre360_spiral_animation_poses(
@@ -213,25 +268,51 @@ def get_thre360_spiral_animation_poses(
     vertical_camera_height: float,
     num_rounds: int,
     num_poses: int,
-) -> Sequence[CameraPose]:
+    device=torch.device("cpu"),
+) -> CameraPath:
     # note that we discard the final one so that video-loop looks smooth
-    horizontal_radii = np.linspace(*horizontal_radius_range, num_poses)[:-1]
-    hemispherical_radii = [
-        np.sqrt((horizontal_radius**2) + (vertical_camera_height**2))
-        for horizontal_radius in horizontal_radii
-    ]
-    yaws = np.linspace(0, 360 * num_rounds, num_poses)[:-1]
-    pitches = [
-        math.atan(horizontal_radius / vertical_camera_height) * 180 / math.pi
-        for horizontal_radius in horizontal_radii
-    ]
-
-    return [
-        pose_spherical(yaw, pitch, hemispherical_radius)
-        for (yaw, pitch, hemispherical_radius) in zip(
-            yaws, pitches, hemispherical_radii
-        )
-    ]
+    horizontal_radii = torch.linspace(
+        *horizontal_radius_range, num_poses, dtype=torch.float32, device=device
+    )[:-1]
+    hemispherical_radii = torch.sqrt(
+        (horizontal_radii**2) + (vertical_camera_height**2)
+    )
+    yaws = torch.linspace(
+        0, 360 * num_rounds, num_poses, dtype=torch.float32, device=device
+    )[:-1]
+    pitches = torch.atan(horizontal_radii / vertical_camera_height) * 180 / math.pi
+
+    return _pose_spherical_batched(
+        yaws=yaws, pitches=pitches, radii=hemispherical_radii
+    )
 
 
 # ----------------------------------------------------------------------------------
+# View directions (used for the view-dependent prompts)
+# ----------------------------------------------------------------------------------
+
+
+def _pitch_yaw_from_Rt(poses: Tensor) -> Tuple[Tensor, Tensor]:
+    """pitch and yaw (in degrees) of the [B x 3 x 4] camera poses"""
+    tx, ty, tz = poses[:, :, -1].unbind(dim=-1)
+    tr = torch.sqrt(tx ** 2 + ty ** 2)
+    pitch = torch.atan(tz / tr) * 180 / np.pi
+    yaw = torch.acos(poses[:, 0, 0]) * 180.0 / np.pi
+    return pitch, yaw
+
+
+def get_dir_batch_from_poses(poses: Tensor, side_yaw_threshold: float = 60.0) -> Sequence[str]:
+    """classifies the [B x 3 x 4] camera poses into "overhead", "back", "side" or "front" views.
+    The pitch and yaw of all the poses are computed together on their device, so that the
+    whole batch is copied to the cpu (a single sync) only for the classification"""
+    pitch, yaw = _pitch_yaw_from_Rt(poses.detach())
+    pitch, yaw = torch.stack([pitch, yaw]).cpu().numpy()
+
+    dir_batch = np.where(
+        pitch > 55.0,
+        "overhead",
+        np.where(
+            yaw > 120.0, "back", np.where(yaw > side_yaw_threshold, "side", "front")
+        ),
+    )
+    return dir_batch.tolist()
@@ -19,3 +19,18 @@ def mse2psnr(x: Any) -> Any:
         # fmt: on
     else:
         return -10.0 * math.log(x) / math.log(10.0) if x != 0.0 else math.inf
+
+
+def _mean_abs(diff: Tensor) -> Tensor:
+    # the l1-norm reduces |diff| in one kernel, i.e. without allocating a grid-sized abs() copy
+    return torch.linalg.vector_norm(diff, ord=1) / diff.numel()
+
+
+def tv_loss_on_grid(grid: Tensor) -> Tensor:
+    """total variation (mean absolute neighbour difference along the three grid axes)
+    of a [X x Y x Z x C] grid. The differences and the reductions are fused
+    (and the grid read once) when wrapped in `maybe_compile`"""
+    tv0 = _mean_abs(grid[1:] - grid[:-1])
+    tv1 = _mean_abs(grid[:, 1:] - grid[:, :-1])
+    tv2 = _mean_abs(grid[:, :, 1:] - grid[:, :, :-1])
+    return (tv0 + tv1 + tv2) / 3
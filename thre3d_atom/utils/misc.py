@@ -2,6 +2,7 @@ from pathlib import Path
 from typing import Callable, Sequence, Any, Optional, Tuple, List
 
 import numpy as np
+import torch
 import yaml
 from easydict import EasyDict
 from tqdm import tqdm
@@ -35,6 +36,14 @@ def batchify(
     return batchified_processor_fn
 
 
+def maybe_compile(fn: Callable[..., Any], **compile_kwargs) -> Callable[..., Any]:
+    """wraps the given function with `torch.compile` when the installed pytorch
+    supports it (>= 2.0). Otherwise, the function is returned as is (eager mode)"""
+    if hasattr(torch, "compile"):
+        return torch.compile(fn, **compile_kwargs)
+    return fn
+
+
 def compute_thre3d_grid_sizes(
     final_required_resolution: Tuple[int, int, int],
     num_stages: int,
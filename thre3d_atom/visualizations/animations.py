@@ -1,19 +1,27 @@
-from typing import Sequence, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Sequence, Optional, Any, Dict, Tuple
 import imageio
 
 import numpy as np
 import torch
+from torch import Tensor
 import matplotlib.pyplot as plt
 from matplotlib import colors, cm
 from thre3d_atom.thre3d_reprs.cross_attn import text_under_image
-from thre3d_atom.modules.sds_trainer import _get_dir_batch_from_poses
-from thre3d_atom.modules.volumetric_model import VolumetricModel
+from thre3d_atom.modules.volumetric_model import (
+    VolumetricModel,
+    get_memory_budgeted_ray_chunk_size,
+)
+from thre3d_atom.rendering.volumetric.utils.misc import get_camera_space_ray_directions
+from thre3d_atom.thre3d_reprs.voxels import AxisAlignedBoundingBox
 from thre3d_atom.utils.constants import EXTRA_ACCUMULATED_WEIGHTS, NUM_COLOUR_CHANNELS
 from thre3d_atom.utils.imaging_utils import (
     CameraPose,
     CameraIntrinsics,
+    get_dir_batch_from_poses,
     scale_camera_intrinsics,
     postprocess_depth_map,
+    stack_camera_poses,
     to8b,
 )
 from thre3d_atom.utils.logging import log
@@ -28,6 +36,7 @@ def render_camera_path_for_volumetric_model(
     image_save_freq: Optional[int] = None,
     image_save_path: Optional[str] = None,
     output_only: bool = True,
+    occupied_aabb: Optional[AxisAlignedBoundingBox] = None,
 ) -> np.array:
     if render_scale_factor is not None:
         # Render downsampled images for speed if requested
@@ -36,6 +45,8 @@ def render_camera_path_for_volumetric_model(
         )
 
     overridden_config_dict = {}
+    if occupied_aabb is not None:
+        overridden_config_dict.update({"occupied_aabb": occupied_aabb})
     if overridden_num_samples_per_ray is not None:
         overridden_config_dict.update(
             {"num_samples_per_ray": overridden_num_samples_per_ray}
@@ -151,6 +162,10 @@ def render_camera_path_for_volumetric_model_attn_blend(
         image_save_freq: Optional[int] = None,
         image_save_path: Optional[str] = None,
         output_only: bool = True,
+        frames_batch_size: int = 8,
+        occupied_aabb: Optional[AxisAlignedBoundingBox] = None,
+        video_writer: Optional[Any] = None,
+        precomputed_cam_rays: Optional[Tensor] = None,
 ) -> np.array:
     if render_scale_factor is not None:
         # Render downsampled images for speed if requested
@@ -158,83 +173,139 @@ def render_camera_path_for_volumetric_model_attn_blend(
             camera_intrinsics, render_scale_factor
         )
 
-    overridden_config_dict = {}
+    # inference-only render, so the fused CUDA accumulation kernel can be used (if available).
+    # It also terminates the rays early, once their transmittance has become negligible
+    overridden_config_dict = {"fused_accumulation": True}
+    if occupied_aabb is not None:
+        overridden_config_dict.update({"occupied_aabb": occupied_aabb})
     if overridden_num_samples_per_ray is not None:
         overridden_config_dict.update(
             {"num_samples_per_ray": overridden_num_samples_per_ray}
         )
 
+    # size the ray-chunks based on the free GPU memory rather than a fixed chunk size
+    parallel_rays_chunk_size = get_memory_budgeted_ray_chunk_size(
+        vol_mod.device,
+        num_samples_per_ray=overridden_config_dict.get(
+            "num_samples_per_ray", vol_mod.render_config.num_samples_per_ray
+        ),
+        # features + attn + density
+        num_channels_per_sample=(
+            vol_mod.thre3d_repr.features.shape[-1] + vol_mod.thre3d_repr.attn.shape[-1] + 1
+        ),
+    )
+
+    # stack all the camera poses into a single [N x 3 x 4] tensor so that the frames
+    # can be rendered a batch of cameras at a time instead of one camera at a time
+    camera_poses = stack_camera_poses(camera_path, device=vol_mod.device)
+
+    # the intrinsics (and hence the camera-space ray directions) are the same for all the
+    # frames, so only the per-frame rotation of these directions needs to be done in the loop
+    if precomputed_cam_rays is None:
+        precomputed_cam_rays = get_camera_space_ray_directions(
+            camera_intrinsics, device=vol_mod.device
+        )
+
+    # if a video_writer is given, the frames are handed over to a background thread for
+    # encoding (overlapped with rendering the next frames) instead of being collected in memory
+    encoder = ThreadPoolExecutor(max_workers=1) if video_writer is not None else None
+    pending_writes = []
+
+    # the rendered maps are downloaded into (page-locked) host memory on a separate copy stream,
+    # so that the download (and the cpu post-processing) of one batch of frames overlaps with
+    # the rendering of the next batch. Note that pytorch's caching host allocator recycles the
+    # pinned buffers, which makes this double-buffered in practice.
+    copy_stream = torch.cuda.Stream() if vol_mod.device.type == "cuda" else None
+
     rendered_frames, attn_frames = [], []
-    total_frames = len(camera_path) + 1
-    for frame_num, render_pose in enumerate(camera_path):
-        log.info(f"rendering frame number: ({frame_num + 1}/{total_frames})")
-        rendered_output = vol_mod.render(
-            render_pose,
-            camera_intrinsics,
-            gpu_render=False,
-            verbose=True,
-            **overridden_config_dict,
+
+    def post_process_batch(batch_start: int, host_maps: Dict[str, Tensor], copied: Any) -> None:
+        if copied is not None:
+            copied.synchronize()
+
+        for batch_index in range(len(host_maps["colour"])):
+            frame_num = batch_start + batch_index
+            colour_frame = host_maps["colour"][batch_index].numpy()
+            attn_frame = host_maps["attn"][batch_index].squeeze(-1).numpy()
+
+            # apply post-processing to the depth frame
+            colour_frame = to8b(colour_frame)
+
+            depth_frame = host_maps["depth"][batch_index].numpy()
+            acc_frame = host_maps["acc"][batch_index].numpy()
+            depth_frame = postprocess_depth_map(depth_frame, acc_map=acc_frame)
+
+            cmp = cm.get_cmap('jet')
+            #cmp = _shift_cmap(cmp, 0.5)
+            norm = colors.Normalize(vmin=np.min(attn_frame), vmax=np.max(attn_frame))
+            attn_frame = (cmp(norm(attn_frame))[:, :, :3])
+            attn_frame = to8b(attn_frame)
+
+            if output_only:
+                frame = colour_frame
+            else:
+                frame = np.concatenate([colour_frame, depth_frame, attn_frame], axis=1)
+
+            if encoder is not None:
+                pending_writes.append(encoder.submit(video_writer.append_data, frame))
+            else:
+                rendered_frames.append(frame)
+                attn_frames.append(attn_frame)
+
+            # save image if necessary (used for plots and stuff)
+            if image_save_freq != None:
+                if frame_num % image_save_freq == 0:
+                    imageio.imwrite(
+                        image_save_path / f"color_{frame_num}.png",
+                        colour_frame,
+                    )
+                    imageio.imwrite(
+                        image_save_path / f"attn_{frame_num}.png",
+                        attn_frame,
+                    )
+
+    in_flight_batch = None
+    total_frames = len(camera_poses)
+    for batch_start in range(0, total_frames, frames_batch_size):
+        batch_poses = camera_poses[batch_start: batch_start + frames_batch_size]
+        log.info(
+            f"rendering frame numbers: ({batch_start + 1}-"
+            f"{batch_start + len(batch_poses)}/{total_frames})"
         )
-        rendered_attn = vol_mod.render_attn(
-            render_pose,
+        # colour and attn are rendered in one pass that shares the ray samples and densities
+        rendered_output, rendered_attn = vol_mod.render_batch_with_attn(
+            batch_poses,
             camera_intrinsics,
-            gpu_render=False,
+            parallel_rays_chunk_size=parallel_rays_chunk_size,
+            gpu_render=True,
             verbose=True,
+            camera_space_directions=precomputed_cam_rays,
             **overridden_config_dict,
         )
-        colour_frame = rendered_output.colour.numpy()
-        attn_frame = rendered_attn.attn.squeeze(-1).cpu().numpy()
+        host_maps, copied = _download_maps_async(
+            {
+                "colour": rendered_output.colour,
+                "depth": rendered_output.depth,
+                "acc": rendered_output.extra[EXTRA_ACCUMULATED_WEIGHTS],
+                "attn": rendered_attn.attn,
+            },
+            copy_stream,
+        )
 
-        # apply post-processing to the depth frame
-        colour_frame = to8b(colour_frame)
+        # post-process the previous batch while this one is being downloaded
+        if in_flight_batch is not None:
+            post_process_batch(*in_flight_batch)
+        in_flight_batch = (batch_start, host_maps, copied)
 
-        depth_frame = rendered_output.depth.numpy()
-        acc_frame = rendered_output.extra[EXTRA_ACCUMULATED_WEIGHTS].numpy()
-        depth_frame = postprocess_depth_map(depth_frame, acc_map=acc_frame)
-
-        def shift_cmap(cmap, frac):
-            """Shifts a colormap by a certain fraction.
-            Keyword arguments:
-            cmap -- the colormap to be shifted. Can be a colormap name or a Colormap object
-            frac -- the fraction of the colorbar by which to shift (must be between 0 and 1)
-            """
-            N = 256
-            if isinstance(cmap, str):
-                cmap = plt.get_cmap(cmap)
-            n = cmap.name
-            x = np.linspace(0, 1, N)
-            out = np.roll(x, int(N * frac))
-            new_cmap = colors.LinearSegmentedColormap.from_list(f'{n}_s', cmap(out))
-            return new_cmap
-        
-        cmp = cm.get_cmap('jet')
-        #cmp = shift_cmap(cmp, 0.5)
-        norm = colors.Normalize(vmin=np.min(attn_frame), vmax=np.max(attn_frame))
-        attn_frame = (cmp(norm(attn_frame))[:, :, :3])
-        #attn_frame_save = (0.5 * attn_frame) + (0.5 * rendered_output.colour.numpy())
-        attn_frame = to8b(attn_frame)
-
-        if output_only:
-            frame = colour_frame
-        else:
-            frame = np.concatenate([colour_frame, depth_frame, attn_frame], axis=1)
-            
-        rendered_frames.append(frame)
-        attn_frames.append(attn_frame)
-
-        # save image if necessary (used for plots and stuff)
-        if image_save_freq != None:
-            if frame_num % image_save_freq == 0:
-                imageio.imwrite(
-                image_save_path / f"color_{frame_num}.png",
-                colour_frame,
-                 )
-                
-                imageio.imwrite(
-                image_save_path / f"attn_{frame_num}.png",
-                attn_frame,
-                 )
+    if in_flight_batch is not None:
+        post_process_batch(*in_flight_batch)
 
+    if encoder is not None:
+        # wait for the encoding to finish (and surface any errors from the writer thread)
+        for pending_write in pending_writes:
+            pending_write.result()
+        encoder.shutdown()
+        return None, None
 
     return np.stack(rendered_frames), attn_frames
 
@@ -280,7 +351,7 @@ def render_camera_path_for_volumetric_model_attn(
         # apply post-processing to the depth frame
         colour_frame = to8b(colour_frame)
         depth_frame = postprocess_depth_map(depth_frame, acc_map=acc_frame)
-        #dir = _get_dir_batch_from_poses(torch.from_numpy(
+        #dir = get_dir_batch_from_poses(torch.from_numpy(
         #    np.hstack((render_pose.rotation, render_pose.translation))
         #).unsqueeze(0).to(device))[0]
         #m_prompt = prompt + f", {dir} view"
@@ -305,3 +376,40 @@ def render_camera_path_for_volumetric_model_attn(
         rendered_frames.append(frame)
 
     return np.stack(rendered_frames), f_attn
+
+
+def _shift_cmap(cmap, frac):
+    """Shifts a colormap by a certain fraction.
+    Keyword arguments:
+    cmap -- the colormap to be shifted. Can be a colormap name or a Colormap object
+    frac -- the fraction of the colorbar by which to shift (must be between 0 and 1)
+    """
+    N = 256
+    if isinstance(cmap, str):
+        cmap = plt.get_cmap(cmap)
+    n = cmap.name
+    x = np.linspace(0, 1, N)
+    out = np.roll(x, int(N * frac))
+    new_cmap = colors.LinearSegmentedColormap.from_list(f'{n}_s', cmap(out))
+    return new_cmap
+
+
+def _download_maps_async(
+    device_maps: Dict[str, Tensor], copy_stream: Optional[Any]
+) -> Tuple[Dict[str, Tensor], Optional[Any]]:
+    """starts copying the given (rendered) maps into pinned host memory on the copy_stream.
+    Returns the host tensors and an event to synchronize on before reading them"""
+    if copy_stream is None:
+        return {name: value.cpu() for name, value in device_maps.items()}, None
+
+    copy_stream.wait_stream(torch.cuda.current_stream())
+    host_maps = {}
+    with torch.cuda.stream(copy_stream):
+        for name, value in device_maps.items():
+            host_maps[name] = torch.empty(value.shape, dtype=value.dtype, pin_memory=True)
+            host_maps[name].copy_(value, non_blocking=True)
+            # don't let the caching allocator reuse this memory before the copy is done
+            value.record_stream(copy_stream)
+        copied = torch.cuda.Event()
+        copied.record(copy_stream)
+    return host_maps, copied